@@ -4,31 +4,42 @@ Please note, this only defines an app factory that returns an app. If you're
 looking for the main entrypoint go to server.py
 """
 
-import asyncio
 import logging
 import shutil
 import tempfile
 import typing as t
 import uuid
 from contextlib import asynccontextmanager
+from datetime import timedelta
 
 import aiotrino
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.datastructures import State
+from fastapi.responses import PlainTextResponse
+from fsspec.core import url_to_fs
 from metrics_tools.compute.result import (
     DummyImportAdapter,
     FakeLocalImportAdapter,
     TrinoImportAdapter,
 )
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from .cache import setup_fake_cache_export_manager, setup_trino_cache_export_manager
+from .cache import (
+    FileExportCacheIndex,
+    setup_fake_cache_export_manager,
+    setup_trino_cache_export_manager,
+)
 from .cluster import (
     ClusterManager,
     KubeClusterFactory,
     LocalClusterFactory,
     make_new_cluster_with_defaults,
 )
+from .instrumentation import refresh_metrics, render_metrics
+from .job_log import JobUpdateLog
+from .manifest import JobManifestStore
+from .result_cache import BatchResultCache, FileBatchResultCacheIndex
 from .service import MetricsCalculationService
 from .types import (
     AppConfig,
@@ -36,7 +47,6 @@ from .types import (
     ClusterStartRequest,
     EmptyResponse,
     ExportedTableLoadRequest,
-    JobStatusResponse,
     JobSubmitRequest,
 )
 
@@ -58,6 +68,11 @@ def default_lifecycle(config: AppConfig):
             temp_dir = tempfile.mkdtemp()
             logger.debug(f"Created temp dir {temp_dir}")
         if not config.debug_cache:
+            cache_index = None
+            if config.export_cache_index_path:
+                cache_index = FileExportCacheIndex.from_url(
+                    config.export_cache_index_path
+                )
             trino_connection = aiotrino.dbapi.connect(
                 host=config.trino_host,
                 port=config.trino_port,
@@ -69,6 +84,15 @@ def default_lifecycle(config: AppConfig):
                 config.gcs_bucket,
                 config.hive_catalog,
                 config.hive_schema,
+                max_concurrent_exports=config.max_concurrent_exports,
+                cache_index=cache_index,
+                max_export_age=timedelta(days=config.export_cache_max_age_days),
+                stale_export_grace_period=timedelta(
+                    minutes=config.stale_export_grace_period_minutes
+                ),
+                freshness_check_interval=timedelta(
+                    seconds=config.export_freshness_check_seconds
+                ),
             )
             import_adapter = TrinoImportAdapter(
                 db=trino_connection,
@@ -84,7 +108,9 @@ def default_lifecycle(config: AppConfig):
             else:
                 logger.warning("Loading dummy cache export manager (writes nothing)")
                 import_adapter = DummyImportAdapter()
-            cache_export_manager = await setup_fake_cache_export_manager()
+            cache_export_manager = await setup_fake_cache_export_manager(
+                max_concurrent_exports=config.max_concurrent_exports,
+            )
 
         cluster_manager = None
         if not config.debug_cluster:
@@ -101,6 +127,16 @@ def default_lifecycle(config: AppConfig):
                 config.gcs_secret,
                 config.worker_duckdb_path,
                 cluster_factory,
+                cache_budget_bytes=(
+                    config.worker_cache_budget_mb * 1024 * 1024
+                    if config.worker_cache_budget_mb
+                    else None
+                ),
+                parquet_cache_dir=config.worker_parquet_cache_dir or None,
+                result_row_group_size=config.worker_result_row_group_size,
+                result_compression=config.worker_result_compression,
+                explain_slow_queries=config.worker_explain_slow_queries,
+                explain_slow_query_seconds=config.worker_explain_slow_query_seconds,
             )
         else:
             logger.warning("Loading fake cluster manager")
@@ -109,6 +145,33 @@ def default_lifecycle(config: AppConfig):
                 cluster_factory,
             )
 
+        result_fs, _ = url_to_fs(f"gs://{config.gcs_bucket}")
+        result_cache = None
+        if config.result_cache_ttl_hours > 0:
+            result_cache = BatchResultCache(
+                result_fs,
+                max_age=timedelta(hours=config.result_cache_ttl_hours),
+                budget_bytes=(
+                    config.result_cache_budget_mb * 1024 * 1024
+                    if config.result_cache_budget_mb
+                    else None
+                ),
+                index=(
+                    FileBatchResultCacheIndex.from_url(config.result_cache_index_path)
+                    if config.result_cache_index_path
+                    else None
+                ),
+            )
+            await result_cache.load_index()
+
+        manifest_store = None
+        if config.job_manifest_path:
+            manifest_store = JobManifestStore.from_url(config.job_manifest_path)
+
+        update_log = None
+        if config.job_update_log_dir:
+            update_log = JobUpdateLog(config.job_update_log_dir)
+
         mcs = MetricsCalculationService.setup(
             id=str(uuid.uuid4()),
             gcs_bucket=config.gcs_bucket,
@@ -116,6 +179,13 @@ def default_lifecycle(config: AppConfig):
             cluster_manager=cluster_manager,
             cache_manager=cache_export_manager,
             import_adapter=import_adapter,
+            render_workers=config.query_render_workers,
+            result_cache=result_cache,
+            max_running_tasks=config.max_running_tasks or None,
+            result_fs=result_fs,
+            manifest_store=manifest_store,
+            update_log=update_log,
+            status_interval=config.job_status_interval_seconds,
         )
         try:
             yield {
@@ -158,6 +228,12 @@ def setup_app(lifespan: t.Callable[[FastAPI], t.Any]):
         """Liveness endpoint"""
         return {"status": "Service is running"}
 
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        """Runtime metrics in the prometheus text format"""
+        await refresh_metrics()
+        return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
     @app.post("/cluster/start")
     async def start_cluster(
         request: Request,
@@ -196,6 +272,15 @@ def setup_app(lifespan: t.Callable[[FastAPI], t.Any]):
         service = get_mcs(request)
         return await service.submit_job(input)
 
+    @app.post("/job/cancel/{job_id}")
+    async def cancel_job(
+        request: Request,
+        job_id: str,
+    ):
+        """Cancel a job and any of its outstanding tasks"""
+        service = get_mcs(request)
+        return await service.cancel_job(job_id)
+
     @app.get("/job/status/{job_id}")
     async def get_job_status(
         request: Request,
@@ -213,25 +298,21 @@ def setup_app(lifespan: t.Callable[[FastAPI], t.Any]):
         websocket: WebSocket,
         job_id: str,
     ):
-        """Websocket endpoint for job status updates"""
+        """Websocket endpoint for job status updates. The full status is sent
+        first followed by coalesced deltas until the job is final."""
         service = get_mcs(websocket)
-        update_queue: asyncio.Queue[JobStatusResponse] = asyncio.Queue()
 
         await websocket.accept()
 
-        async def listener(job_status_response: JobStatusResponse):
-            logger.debug(f"Received job status update: {job_status_response}")
-            await update_queue.put(job_status_response)
-
-        stop_listening = service.listen_for_job_updates(job_id, listener)
-
+        stream = service.stream_job_status(job_id)
         try:
-            while True:
-                update = await update_queue.get()
-                await websocket.send_text(update.model_dump_json())
-        except WebSocketDisconnect:
-            stop_listening()
+            async for message in stream:
+                await websocket.send_text(message.model_dump_json(exclude_none=True))
             await websocket.close()
+        except WebSocketDisconnect:
+            logger.debug(f"job[{job_id}] status listener disconnected")
+        finally:
+            await stream.aclose()
 
     @app.post("/cache/manual")
     async def add_existing_exported_table_references(
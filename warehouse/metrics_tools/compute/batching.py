@@ -0,0 +1,125 @@
+"""Sizes the batches of a job so that its tasks take roughly the same time.
+
+The cost of a sample date grows with the number of rows in its rolling window.
+A fixed number of days per batch therefore makes the batches over recent
+history much slower than the batches over early history and the slowest batch
+sets the time the whole job takes. Each sample date is weighted by the rows in
+its window, using the daily row counts of the job's dependencies when they're
+available. Batches are planned one at a time from the days whose weights add
+up to the current target weight. As tasks complete, their durations update the
+estimated seconds per unit of weight so that the remaining days are coalesced
+into larger batches or split into smaller ones to take the target time.
+"""
+
+import math
+import typing as t
+from datetime import date, datetime, timedelta
+
+from metrics_tools.definition import PeerMetricDependencyRef
+
+UNIT_DAYS = {
+    "day": 1,
+    "week": 7,
+    "month": 30,
+    "quarter": 91,
+    "year": 365,
+}
+
+
+def window_days(ref: PeerMetricDependencyRef) -> int:
+    """The approximate number of days in the rolling window of a metric. Time
+    aggregations only read the rows of the sample date's own period."""
+    window = ref.get("window")
+    unit = ref.get("unit")
+    if not window or not unit:
+        return 1
+    return window * UNIT_DAYS.get(unit, 1)
+
+
+def day_weights(
+    days: t.List[datetime], row_counts: t.Dict[date, int], window: int
+) -> t.List[float]:
+    """The number of rows in the rolling window of each sample date. Days are
+    weighted at least 1 so that empty windows still have a cost. The days must
+    be in ascending order."""
+    if not days:
+        return []
+    first = days[0].date() - timedelta(days=window - 1)
+    length = (days[-1].date() - first).days + 1
+    cumulative = [0]
+    for offset in range(length):
+        count = row_counts.get(first + timedelta(days=offset), 0)
+        cumulative.append(cumulative[-1] + count)
+
+    weights: t.List[float] = []
+    for day in days:
+        index = (day.date() - first).days + 1
+        weights.append(float(max(cumulative[index] - cumulative[index - window], 1)))
+    return weights
+
+
+class AdaptiveBatchPlanner:
+    """Plans batches of sample dates whose tasks should each take about
+    `target_task_seconds`.
+
+    Until a task has completed the target weight is the mean weight of
+    `initial_batch_size` days. Every completed task updates a moving average of
+    the seconds per unit of weight, weighted towards the latest tasks because
+    the batches move through the job's days in order.
+    """
+
+    def __init__(
+        self,
+        days: t.List[datetime],
+        weights: t.List[float],
+        initial_batch_size: int,
+        target_task_seconds: float,
+        smoothing: float = 0.5,
+    ):
+        assert len(days) == len(weights), "every day must have a weight"
+        assert target_task_seconds > 0, "target_task_seconds must be positive"
+        self._days = days
+        self._weights = weights
+        self._next = 0
+        self._target_task_seconds = target_task_seconds
+        self._smoothing = smoothing
+        mean_weight = sum(weights) / len(weights) if weights else 1.0
+        self.target_weight = max(initial_batch_size, 1) * mean_weight
+        self.seconds_per_weight: t.Optional[float] = None
+
+    @property
+    def has_remaining(self) -> bool:
+        return self._next < len(self._days)
+
+    def next_batch(self) -> t.Tuple[t.List[datetime], float]:
+        """Returns the next batch of days and its total weight. A batch always
+        has at least one day even if that day alone exceeds the target."""
+        assert self.has_remaining, "no days remaining"
+        start = self._next
+        total = 0.0
+        while self._next < len(self._days):
+            weight = self._weights[self._next]
+            if self._next > start and total + weight > self.target_weight:
+                break
+            total += weight
+            self._next += 1
+        return (self._days[start : self._next], total)
+
+    def observe(self, weight: float, seconds: float):
+        """Updates the target weight from the duration of a completed task"""
+        if weight <= 0 or seconds <= 0:
+            return
+        rate = seconds / weight
+        if self.seconds_per_weight is None:
+            self.seconds_per_weight = rate
+        else:
+            self.seconds_per_weight = (
+                self._smoothing * rate + (1 - self._smoothing) * self.seconds_per_weight
+            )
+        self.target_weight = self._target_task_seconds / self.seconds_per_weight
+
+    def estimated_remaining_batches(self) -> int:
+        remaining = sum(self._weights[self._next :])
+        if remaining <= 0:
+            return 0
+        return math.ceil(remaining / self.target_weight)
@@ -2,21 +2,58 @@ import abc
 import asyncio
 import copy
 import logging
+import os
 import queue
+import time
 import typing as t
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
 from aiotrino.dbapi import Connection
+from fsspec import AbstractFileSystem
+from fsspec.core import url_to_fs
+from prometheus_client import Counter, Gauge, Histogram
 from pydantic import BaseModel
 from pyee.asyncio import AsyncIOEventEmitter
 from sqlglot import exp
 from sqlmesh.core.dialect import parse_one
 
-from .types import ColumnsDefinition, ExportReference, ExportType, TableReference
+from .instrumentation import DEFAULT_BUCKETS, REGISTRY
+from .types import (
+    ColumnsDefinition,
+    ExportCacheEntry,
+    ExportCacheManifest,
+    ExportReference,
+    ExportRequirements,
+    ExportType,
+    TableReference,
+)
 
 logger = logging.getLogger(__name__)
 
+EXPORT_QUEUE_DEPTH = Gauge(
+    "mcs_export_queue_depth",
+    "Export requests waiting in the export queue",
+    registry=REGISTRY,
+)
+EXPORTS_IN_PROGRESS = Gauge(
+    "mcs_exports_in_progress",
+    "Exports of dependency tables that are running",
+    registry=REGISTRY,
+)
+EXPORTS = Counter(
+    "mcs_exports",
+    "Export requests of dependency tables by how they were resolved",
+    ["result"],
+    registry=REGISTRY,
+)
+EXPORT_SECONDS = Histogram(
+    "mcs_export_seconds",
+    "Time spent exporting a dependency table, excluding time in the queue",
+    buckets=DEFAULT_BUCKETS,
+    registry=REGISTRY,
+)
+
 
 class ExportCacheCompletedQueueItem(BaseModel):
     table: str
@@ -26,6 +63,37 @@ class ExportCacheCompletedQueueItem(BaseModel):
 class ExportCacheQueueItem(BaseModel):
     execution_time: datetime
     table: str
+    requirements: t.Optional[ExportRequirements] = None
+
+    @property
+    def key(self) -> str:
+        return export_cache_key(self.table, self.requirements)
+
+
+def export_cache_key(
+    table: str, requirements: t.Optional[ExportRequirements] = None
+) -> str:
+    """The key of an export in the cache. Exports of the full table are keyed
+    by the table name. Pruned exports include the projection and range."""
+    if requirements is None or not requirements.is_pruned():
+        return table
+    return f"{table}#{requirements.cache_key()}"
+
+
+def export_cache_key_table(key: str) -> str:
+    """The table that was exported for a given cache key"""
+    return key.partition("#")[0]
+
+
+def export_reference_requirements(
+    export_reference: ExportReference,
+) -> ExportRequirements:
+    """The requirements that an export was pruned to. Exports of the full
+    table have empty requirements"""
+    requirements = export_reference.source_metadata.get("requirements")
+    if requirements is None:
+        return ExportRequirements()
+    return ExportRequirements.model_validate(requirements)
 
 
 class ExportError(Exception):
@@ -36,20 +104,45 @@ class ExportError(Exception):
 
 class DBExportAdapter(abc.ABC):
     async def export_table(
-        self, table: str, execution_time: datetime
+        self,
+        table: str,
+        execution_time: datetime,
+        requirements: t.Optional[ExportRequirements] = None,
     ) -> ExportReference:
+        """Exports the table. If requirements are given the adapter may export
+        only the required columns and time ranges of the table."""
         raise NotImplementedError()
 
-    async def clean_export_table(self, table: str):
+    async def clean_export_table(self, export_reference: ExportReference):
         raise NotImplementedError()
 
+    async def table_freshness(self, table: str) -> t.Optional[str]:
+        """Returns a token that changes whenever the table's data changes. If
+        the adapter can't determine this `None` is returned and cached exports
+        of the table are never invalidated."""
+        return None
+
+    async def daily_row_counts(
+        self,
+        table: str,
+        column: str,
+        start: t.Optional[datetime] = None,
+        end: t.Optional[datetime] = None,
+    ) -> t.Optional[t.Dict[date, int]]:
+        """Returns the number of rows of the table for each day of the time
+        column. `None` is returned if the adapter can't count the rows."""
+        return None
+
 
 class FakeExportAdapter(DBExportAdapter):
     def __init__(self, log_override: t.Optional[logging.Logger] = None):
         self.logger = log_override or logger
 
     async def export_table(
-        self, table: str, execution_time: datetime
+        self,
+        table: str,
+        execution_time: datetime,
+        requirements: t.Optional[ExportRequirements] = None,
     ) -> ExportReference:
         self.logger.info(f"fake exporting table: {table}")
         return ExportReference(
@@ -59,7 +152,7 @@ class FakeExportAdapter(DBExportAdapter):
             columns=ColumnsDefinition(columns=[]),
         )
 
-    async def clean_export_table(self, table: str):
+    async def clean_export_table(self, export_reference: ExportReference):
         pass
 
 
@@ -79,7 +172,10 @@ class TrinoExportAdapter(DBExportAdapter):
         self.logger = log_override or logger
 
     async def export_table(
-        self, table: str, execution_time: datetime
+        self,
+        table: str,
+        execution_time: datetime,
+        requirements: t.Optional[ExportRequirements] = None,
     ) -> ExportReference:
         columns: t.List[t.Tuple[str, str]] = []
 
@@ -90,6 +186,20 @@ class TrinoExportAdapter(DBExportAdapter):
             column_type = row[1]
             columns.append((column_name, column_type))
 
+        if requirements and requirements.columns is not None:
+            required_columns = {column.lower() for column in requirements.columns}
+            pruned_columns = [
+                (column_name, column_type)
+                for column_name, column_type in columns
+                if column_name.lower() in required_columns
+            ]
+            if pruned_columns:
+                columns = pruned_columns
+            else:
+                self.logger.warning(
+                    f"no required columns found in {table}. exporting all columns"
+                )
+
         table_exp = exp.to_table(table)
         self.logger.debug(f"retrieved columns for {table} export: {columns}")
         export_table_name = f"export_{table_exp.this.this}_{uuid.uuid4().hex}"
@@ -150,6 +260,12 @@ class TrinoExportAdapter(DBExportAdapter):
         select = t.cast(exp.Select, insert_query.expression)
         select.set("expressions", column_selects)
 
+        # Only export the time ranges that are required
+        if requirements:
+            conditions = self.time_range_conditions(columns, requirements)
+            if conditions:
+                select.where(*conditions, copy=False)
+
         # Execute the insert query which will populate the export table
         await self.run_query(insert_query.sql(dialect="trino"))
 
@@ -160,6 +276,83 @@ class TrinoExportAdapter(DBExportAdapter):
             columns=ColumnsDefinition(columns=columns, dialect="trino"),
         )
 
+    def time_range_conditions(
+        self, columns: t.List[t.Tuple[str, str]], requirements: ExportRequirements
+    ) -> t.List[exp.Expression]:
+        """Creates the filters for the required time ranges. The ranges are
+        padded by a day so that differences in time zone handling between trino
+        and duckdb can't drop any rows."""
+        column_names = {column_name.lower(): column_name for column_name, _ in columns}
+        conditions: t.List[exp.Expression] = []
+        for time_range in requirements.time_ranges:
+            column_name = column_names.get(time_range.column.lower())
+            if not column_name:
+                continue
+            column = exp.to_identifier(column_name)
+            if time_range.start:
+                start = time_range.start - timedelta(days=1)
+                conditions.append(
+                    exp.GTE(
+                        this=column.copy(),
+                        expression=exp.cast(
+                            exp.Literal.string(start.strftime("%Y-%m-%d %H:%M:%S")),
+                            exp.DataType.Type.TIMESTAMP,
+                        ),
+                    )
+                )
+            if time_range.end:
+                end = time_range.end + timedelta(days=1)
+                conditions.append(
+                    exp.LTE(
+                        this=column.copy(),
+                        expression=exp.cast(
+                            exp.Literal.string(end.strftime("%Y-%m-%d %H:%M:%S")),
+                            exp.DataType.Type.TIMESTAMP,
+                        ),
+                    )
+                )
+        return conditions
+
+    async def daily_row_counts(
+        self,
+        table: str,
+        column: str,
+        start: t.Optional[datetime] = None,
+        end: t.Optional[datetime] = None,
+    ) -> t.Optional[t.Dict[date, int]]:
+        day = exp.cast(exp.column(column), exp.DataType.Type.DATE)
+        query = (
+            exp.select(day.as_("day"), exp.Count(this=exp.Star()).as_("row_count"))
+            .from_(exp.to_table(table))
+            .group_by(day.copy())
+        )
+        if start:
+            query = query.where(
+                exp.GTE(
+                    this=day.copy(),
+                    expression=exp.cast(
+                        exp.Literal.string(start.strftime("%Y-%m-%d")),
+                        exp.DataType.Type.DATE,
+                    ),
+                )
+            )
+        if end:
+            query = query.where(
+                exp.LTE(
+                    this=day.copy(),
+                    expression=exp.cast(
+                        exp.Literal.string(end.strftime("%Y-%m-%d")),
+                        exp.DataType.Type.DATE,
+                    ),
+                )
+            )
+        try:
+            result = await self.run_query(query.sql(dialect="trino"))
+        except Exception as e:
+            self.logger.warning(f"unable to count the daily rows of {table}: {e}")
+            return None
+        return {row[0]: row[1] for row in result if row[0] is not None}
+
     async def run_query(self, query: str):
         cursor = await self.db.cursor()
         self.logger.info(f"Executing SQL: {query}")
@@ -205,8 +398,101 @@ class TrinoExportAdapter(DBExportAdapter):
             column_select,
         )
 
-    async def clean_export_table(self, table: str):
-        pass
+    async def table_freshness(self, table: str) -> t.Optional[str]:
+        """Uses the latest iceberg snapshot id of the table as the freshness
+        token. Tables that aren't iceberg tables don't have a `$snapshots`
+        table so we don't have a token for them."""
+        table_exp = exp.to_table(table)
+        snapshots_table = exp.table_(
+            exp.to_identifier(f"{table_exp.name}$snapshots", quoted=True),
+            db=table_exp.db or None,
+            catalog=table_exp.catalog or None,
+        )
+        query = (
+            exp.select("snapshot_id")
+            .from_(snapshots_table)
+            .order_by("committed_at DESC")
+            .limit(1)
+        )
+        try:
+            result = await self.run_query(query.sql(dialect="trino"))
+        except Exception as e:
+            self.logger.warning(f"unable to determine freshness of {table}: {e}")
+            return None
+        if not result:
+            return None
+        return str(result[0][0])
+
+    async def clean_export_table(self, export_reference: ExportReference):
+        """Drops the hive table for the export and deletes the exported files"""
+        gcs_path = export_reference.payload["gcs_path"]
+        export_table_name = os.path.basename(gcs_path.rstrip("/"))
+
+        await self.run_query(
+            f'DROP TABLE IF EXISTS "{self.hive_catalog}"."{self.hive_schema}"."{export_table_name}"'
+        )
+
+        # The hive table is external so dropping it leaves the files in place
+        fs, path = url_to_fs(gcs_path)
+        if await asyncio.to_thread(fs.exists, path):
+            await asyncio.to_thread(fs.rm, path, recursive=True)
+        self.logger.info(f"cleaned export {export_table_name} at {gcs_path}")
+
+
+class ExportCacheIndex(abc.ABC):
+    """Durable storage for the export cache so that exports survive restarts
+    of the metrics calculation service"""
+
+    async def load(self) -> t.List[ExportCacheEntry]:
+        raise NotImplementedError()
+
+    async def save(self, entries: t.List[ExportCacheEntry]):
+        raise NotImplementedError()
+
+
+class FileExportCacheIndex(ExportCacheIndex):
+    """Stores the export cache index as a json manifest on any fsspec
+    filesystem. In production this is a gcs path next to the exports."""
+
+    @classmethod
+    def from_url(cls, url: str, log_override: t.Optional[logging.Logger] = None):
+        fs, path = url_to_fs(url)
+        return cls(fs, path, log_override=log_override)
+
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        path: str,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.fs = fs
+        self.path = path
+        self.logger = log_override or logger
+
+    async def load(self) -> t.List[ExportCacheEntry]:
+        return await asyncio.to_thread(self._load)
+
+    async def save(self, entries: t.List[ExportCacheEntry]):
+        await asyncio.to_thread(self._save, entries)
+
+    def _load(self) -> t.List[ExportCacheEntry]:
+        if not self.fs.exists(self.path):
+            self.logger.info(f"no export cache index found at {self.path}")
+            return []
+        with self.fs.open(self.path, "r") as f:
+            manifest = ExportCacheManifest.model_validate_json(f.read())
+        self.logger.info(
+            f"loaded {len(manifest.entries)} export cache entries from {self.path}"
+        )
+        return manifest.entries
+
+    def _save(self, entries: t.List[ExportCacheEntry]):
+        manifest = ExportCacheManifest(entries=entries)
+        parent = os.path.dirname(self.path)
+        if parent:
+            self.fs.makedirs(parent, exist_ok=True)
+        with self.fs.open(self.path, "w") as f:
+            f.write(manifest.model_dump_json())
 
 
 def setup_trino_cache_export_manager(
@@ -215,6 +501,11 @@ def setup_trino_cache_export_manager(
     hive_catalog: str,
     hive_schema: str,
     preloaded_exported_map: t.Optional[t.Dict[str, ExportReference]] = None,
+    max_concurrent_exports: int = 4,
+    cache_index: t.Optional[ExportCacheIndex] = None,
+    max_export_age: t.Optional[timedelta] = None,
+    stale_export_grace_period: timedelta = timedelta(hours=1),
+    freshness_check_interval: timedelta = timedelta(minutes=1),
     log_override: t.Optional[logging.Logger] = None,
 ):
     adapter = TrinoExportAdapter(
@@ -223,18 +514,33 @@ def setup_trino_cache_export_manager(
     return CacheExportManager.setup(
         export_adapter=adapter,
         preloaded_exported_map=preloaded_exported_map,
+        max_concurrent_exports=max_concurrent_exports,
+        cache_index=cache_index,
+        max_export_age=max_export_age,
+        stale_export_grace_period=stale_export_grace_period,
+        freshness_check_interval=freshness_check_interval,
         log_override=log_override,
     )
 
 
 def setup_fake_cache_export_manager(
     preloaded_exported_map: t.Optional[t.Dict[str, ExportReference]] = None,
+    max_concurrent_exports: int = 4,
+    cache_index: t.Optional[ExportCacheIndex] = None,
+    max_export_age: t.Optional[timedelta] = None,
+    stale_export_grace_period: timedelta = timedelta(hours=1),
+    freshness_check_interval: timedelta = timedelta(minutes=1),
     log_override: t.Optional[logging.Logger] = None,
 ):
     adapter = FakeExportAdapter()
     return CacheExportManager.setup(
         export_adapter=adapter,
         preloaded_exported_map=preloaded_exported_map,
+        max_concurrent_exports=max_concurrent_exports,
+        cache_index=cache_index,
+        max_export_age=max_export_age,
+        stale_export_grace_period=stale_export_grace_period,
+        freshness_check_interval=freshness_check_interval,
         log_override=log_override,
     )
 
@@ -250,6 +556,19 @@ class CacheExportManager:
     trigger the database export. Once the export is completed any consumers of
     this export manager can listen for the `exported_table` event to know when
     the export is complete.
+
+    If a cache index is provided, the known exports are persisted to it and
+    reloaded on start so that a restart of the service doesn't force every
+    table to be exported again. Entries older than `max_export_age` expire
+    and are cleaned like superseded exports.
+
+    Cached exports are also checked against the export adapter's freshness
+    token for the source table. If the table has changed since it was exported
+    the export is considered stale and is exported again. The freshness of a
+    table is checked at most once every `freshness_check_interval` so that
+    most jobs don't wait on the database. Superseded exports are recorded in
+    the cache index until they're cleaned so that exports still in their grace
+    period when the service stops are cleaned after the next start.
     """
 
     export_queue_task: asyncio.Task
@@ -261,11 +580,21 @@ class CacheExportManager:
         cls,
         export_adapter: DBExportAdapter,
         preloaded_exported_map: t.Optional[t.Dict[str, ExportReference]] = None,
+        max_concurrent_exports: int = 4,
+        cache_index: t.Optional[ExportCacheIndex] = None,
+        max_export_age: t.Optional[timedelta] = None,
+        stale_export_grace_period: timedelta = timedelta(hours=1),
+        freshness_check_interval: timedelta = timedelta(minutes=1),
         log_override: t.Optional[logging.Logger] = None,
     ):
         cache = cls(
             export_adapter,
             preloaded_exported_map=preloaded_exported_map,
+            max_concurrent_exports=max_concurrent_exports,
+            cache_index=cache_index,
+            max_export_age=max_export_age,
+            stale_export_grace_period=stale_export_grace_period,
+            freshness_check_interval=freshness_check_interval,
             log_override=log_override,
         )
         await cache.start()
@@ -275,9 +604,30 @@ class CacheExportManager:
         self,
         export_adapter: DBExportAdapter,
         preloaded_exported_map: t.Optional[t.Dict[str, ExportReference]] = None,
+        max_concurrent_exports: int = 4,
+        cache_index: t.Optional[ExportCacheIndex] = None,
+        max_export_age: t.Optional[timedelta] = None,
+        stale_export_grace_period: timedelta = timedelta(hours=1),
+        freshness_check_interval: timedelta = timedelta(minutes=1),
         log_override: t.Optional[logging.Logger] = None,
     ):
+        assert max_concurrent_exports > 0, "max_concurrent_exports must be positive"
+        self.max_concurrent_exports = max_concurrent_exports
         self.exported_map: t.Dict[str, ExportReference] = preloaded_exported_map or {}
+        now = datetime.now()
+        self.exported_at: t.Dict[str, datetime] = {
+            table: now for table in self.exported_map.keys()
+        }
+        self.cache_index = cache_index
+        self.cache_index_lock = asyncio.Lock()
+        self.max_export_age = max_export_age
+        self.stale_export_grace_period = stale_export_grace_period
+        self.freshness_check_interval = freshness_check_interval
+        # The last time the freshness of each table was checked
+        self.freshness_checked_at: t.Dict[str, datetime] = {}
+        # Superseded exports whose files haven't been cleaned yet
+        self.superseded_exports: t.List[ExportCacheEntry] = []
+        self.clean_tasks: t.Set[asyncio.Task] = set()
         self.export_adapter = export_adapter
         self.exported_map_lock = asyncio.Lock()
         self.export_queue: asyncio.Queue[ExportCacheQueueItem] = asyncio.Queue()
@@ -287,23 +637,70 @@ class CacheExportManager:
         self.stop_signal = asyncio.Event()
         self.logger = log_override or logger
         self.event_emitter = AsyncIOEventEmitter()
+        EXPORT_QUEUE_DEPTH.set_function(self.export_queue.qsize)
 
     async def start(self):
+        await self.load_cache_index()
         self.export_queue_task = asyncio.create_task(self.export_queue_loop())
 
     async def stop(self):
         self.stop_signal.set()
         await self.export_queue_task
+        # Pending cleanups are abandoned rather than risk deleting files a job
+        # may still be reading. The superseded exports remain in the cache
+        # index so they're cleaned after the next start.
+        for task in self.clean_tasks:
+            task.cancel()
 
     async def export_queue_loop(self):
+        """Consumes the export queue and runs up to `max_concurrent_exports`
+        exports at the same time. Exports are single-flight per cache key: if
+        a table (with the same requirements) is already being exported any
+        additional queue items for it are dropped and the requesters are
+        notified by the in-flight export's `exported_table` event."""
         in_progress: t.Set[str] = set()
         errors: t.Dict[str, t.List[Exception]] = {}
+        export_semaphore = asyncio.Semaphore(self.max_concurrent_exports)
+        export_tasks: t.Set[asyncio.Task] = set()
 
-        async def export_table(table: str, execution_time: datetime) -> ExportReference:
+        async def export_table(item: ExportCacheQueueItem):
             try:
-                return await self._export_table_for_cache(table, execution_time)
-            except Exception as e:
-                raise ExportError(table, e)
+                async with export_semaphore:
+                    EXPORTS_IN_PROGRESS.inc()
+                    started = time.monotonic()
+                    try:
+                        export_reference = await self._export_table_for_cache(
+                            item.table, item.execution_time, item.requirements
+                        )
+                    finally:
+                        EXPORTS_IN_PROGRESS.dec()
+                        EXPORT_SECONDS.observe(time.monotonic() - started)
+            except Exception as error:
+                self.logger.error(f"Error exporting table {item.table}: {error}")
+                EXPORTS.labels(result="failed").inc()
+
+                # Save the error for later
+                table_errors = errors.get(item.key, [])
+                table_errors.append(error)
+                errors[item.key] = table_errors
+
+                self.event_emitter.emit("exported_table", key=item.key, error=error)
+            else:
+                EXPORTS.labels(result="exported").inc()
+                # Store the reference before notifying listeners so that any
+                # request that arrives after this point is a cache hit
+                await self.add_export_table_reference(item.key, export_reference)
+                await self.supersede_covered_export_references(
+                    item.key, item.requirements
+                )
+                self.event_emitter.emit(
+                    "exported_table",
+                    key=item.key,
+                    export_reference=export_reference,
+                )
+            finally:
+                in_progress.discard(item.key)
+                self.export_queue.task_done()
 
         while not self.stop_signal.is_set():
             try:
@@ -314,34 +711,49 @@ class CacheExportManager:
                 continue
             except RuntimeError:
                 break
-            if item.table in in_progress:
+            if item.key in in_progress:
                 # The table is already being exported. Skip this in the queue
+                EXPORTS.labels(result="shared").inc()
+                self.export_queue.task_done()
+                continue
+            if item.key in errors:
+                # The table has already errored. Report the previous error
+                # instead of attempting the export again
+                self.event_emitter.emit(
+                    "exported_table", key=item.key, error=errors[item.key][-1]
+                )
+                self.export_queue.task_done()
                 continue
-            if item.table in errors:
-                # The table has already errored. Skip this in the queue
+            export_reference = await self.get_export_table_reference(item.key)
+            if export_reference is not None:
+                # The table finished exporting after this item was queued
+                EXPORTS.labels(result="shared").inc()
+                self.event_emitter.emit(
+                    "exported_table",
+                    key=item.key,
+                    export_reference=export_reference,
+                )
+                self.export_queue.task_done()
                 continue
 
-            in_progress.add(item.table)
-            try:
-                export_reference = await export_table(item.table, item.execution_time)
-            except ExportError as e:
-                table = e.table
-                error = e.error
-                self.logger.error(f"Error exporting table {table}: {error}")
+            in_progress.add(item.key)
+            task = asyncio.create_task(export_table(item))
+            export_tasks.add(task)
+            task.add_done_callback(export_tasks.discard)
 
-                # Save the error for later
-                table_errors = errors.get(table, [])
-                table_errors.append(error)
-                errors[table] = table_errors
+        # Allow any in flight exports to finish before shutting down
+        if export_tasks:
+            await asyncio.gather(*export_tasks, return_exceptions=True)
 
-                in_progress.remove(table)
-                self.event_emitter.emit("exported_table", table=table, error=error)
-                self.export_queue.task_done()
-                continue
-            self.event_emitter.emit(
-                "exported_table", table=item.table, export_reference=export_reference
-            )
-            self.export_queue.task_done()
+    async def daily_row_counts(
+        self,
+        table: str,
+        column: str,
+        start: t.Optional[datetime] = None,
+        end: t.Optional[datetime] = None,
+    ) -> t.Optional[t.Dict[date, int]]:
+        """The number of rows for each day of a table's time column"""
+        return await self.export_adapter.daily_row_counts(table, column, start, end)
 
     async def add_export_table_reference(
         self, table: str, export_reference: ExportReference
@@ -351,8 +763,11 @@ class CacheExportManager:
     async def add_export_table_references(
         self, table_map: t.Dict[str, ExportReference]
     ):
+        now = datetime.now()
         async with self.exported_map_lock:
             self.exported_map.update(table_map)
+            self.exported_at.update({table: now for table in table_map.keys()})
+        await self.save_cache_index()
 
     async def inspect_export_table_references(self):
         async with self.exported_map_lock:
@@ -363,64 +778,292 @@ class CacheExportManager:
             reference = self.exported_map.get(table)
             if not reference:
                 return None
-            return copy.deepcopy(reference)
+            if not self.is_expired(self.exported_at.get(table)):
+                return copy.deepcopy(reference)
+            self.logger.info(f"cached export for {table} has expired")
+            self._supersede_export_reference(table, datetime.now())
+        await self.save_cache_index()
+        return None
+
+    async def get_covering_export_table_reference(
+        self, table: str, requirements: t.Optional[ExportRequirements] = None
+    ):
+        """Finds any cached export of the table that contains everything that
+        is needed by the requirements. This allows pruned exports of a wider
+        range to be reused for jobs that only need part of that range."""
+        requirements = requirements or ExportRequirements()
+        covering: t.Optional[ExportReference] = None
+        expired: t.List[str] = []
+        now = datetime.now()
+        async with self.exported_map_lock:
+            for key, reference in list(self.exported_map.items()):
+                if export_cache_key_table(key) != table:
+                    continue
+                if self.is_expired(self.exported_at.get(key)):
+                    self._supersede_export_reference(key, now)
+                    expired.append(key)
+                    continue
+                if export_reference_requirements(reference).covers(requirements):
+                    covering = copy.deepcopy(reference)
+                    break
+        if expired:
+            self.logger.info(f"cached exports of {table} have expired: {expired}")
+            await self.save_cache_index()
+        return covering
+
+    async def supersede_covered_export_references(
+        self, key: str, requirements: t.Optional[ExportRequirements] = None
+    ):
+        """Removes the cached exports of the same table that are covered by the
+        export for the given key. Those exports are no longer served so their
+        files are cleaned after the grace period."""
+        requirements = requirements or ExportRequirements()
+        table = export_cache_key_table(key)
+        now = datetime.now()
+        superseded: t.List[str] = []
+        async with self.exported_map_lock:
+            for other_key, reference in list(self.exported_map.items()):
+                if other_key == key or export_cache_key_table(other_key) != table:
+                    continue
+                if requirements.covers(export_reference_requirements(reference)):
+                    self._supersede_export_reference(other_key, now)
+                    superseded.append(other_key)
+        if not superseded:
+            return
+        self.logger.info(f"cached exports superseded by {key}: {superseded}")
+        await self.save_cache_index()
+
+    def _supersede_export_reference(self, key: str, superseded_at: datetime):
+        """Removes an export from the cache and schedules the cleaning of its
+        files. This must be called with the `exported_map_lock` held."""
+        reference = self.exported_map.pop(key)
+        self._schedule_superseded_export_clean(
+            ExportCacheEntry(
+                table=key,
+                export_reference=reference,
+                exported_at=self.exported_at.pop(key, superseded_at),
+                superseded_at=superseded_at,
+            )
+        )
 
-    async def _export_table_for_cache(self, table: str, execution_time: datetime):
+    def is_expired(self, exported_at: t.Optional[datetime]) -> bool:
+        if self.max_export_age is None or exported_at is None:
+            return False
+        return datetime.now() - exported_at > self.max_export_age
+
+    async def load_cache_index(self):
+        """Loads any previously exported tables from the cache index. Expired
+        entries are cleaned after the grace period and tables that were
+        preloaded take precedence over the index."""
+        if not self.cache_index:
+            return
+        entries = await self.cache_index.load()
+        loaded = 0
+        expired = 0
+        now = datetime.now()
+        async with self.exported_map_lock:
+            for entry in entries:
+                if entry.superseded_at is None and self.is_expired(entry.exported_at):
+                    entry = entry.model_copy(update={"superseded_at": now})
+                    expired += 1
+                if entry.superseded_at is not None:
+                    self._schedule_superseded_export_clean(entry)
+                    continue
+                if entry.table in self.exported_map:
+                    continue
+                self.exported_map[entry.table] = entry.export_reference
+                self.exported_at[entry.table] = entry.exported_at
+                loaded += 1
+        self.logger.info(f"loaded {loaded} cached exports from the cache index")
+        if expired:
+            self.logger.info(f"{expired} cached exports in the cache index expired")
+            await self.save_cache_index()
+
+    async def save_cache_index(self):
+        if not self.cache_index:
+            return
+        async with self.cache_index_lock:
+            async with self.exported_map_lock:
+                entries = [
+                    ExportCacheEntry(
+                        table=table,
+                        export_reference=reference,
+                        exported_at=self.exported_at[table],
+                    )
+                    for table, reference in self.exported_map.items()
+                ]
+                entries.extend(self.superseded_exports)
+            await self.cache_index.save(entries)
+
+    async def _export_table_for_cache(
+        self,
+        table: str,
+        execution_time: datetime,
+        requirements: t.Optional[ExportRequirements] = None,
+    ):
         """Triggers an export of a table to a cache location in GCS. This does
         this by using the Hive catalog in trino to create a new table with the
         same schema as the original table, but with a different name. This new
         table is then used as the cache location for the original table."""
 
-        export_reference = await self.export_adapter.export_table(table, execution_time)
+        # The freshness is resolved before the export so that any change to
+        # the table during the export results in the export being stale
+        freshness_token = await self.export_adapter.table_freshness(table)
+        export_reference = await self.export_adapter.export_table(
+            table, execution_time, requirements=requirements
+        )
+        if freshness_token is not None:
+            export_reference.source_metadata["freshness_token"] = freshness_token
+        if requirements and requirements.is_pruned():
+            export_reference.source_metadata["requirements"] = requirements.model_dump(
+                mode="json"
+            )
         self.logger.info(f"exported table: {table} -> {export_reference}")
         return export_reference
 
+    async def invalidate_stale_export_references(self, tables: t.Iterable[str]):
+        """Checks the freshness of the given tables against the freshness of
+        their cached exports. Any stale exports are removed from the cache so
+        that they are re-exported the next time they're requested. The files
+        of the superseded exports are cleaned after a grace period to allow any
+        running jobs to finish with them."""
+        now = datetime.now()
+        tables = {
+            table
+            for table in tables
+            if now - self.freshness_checked_at.get(table, datetime.min)
+            >= self.freshness_check_interval
+        }
+        references: t.Dict[str, ExportReference] = {}
+        async with self.exported_map_lock:
+            for key, reference in self.exported_map.items():
+                if export_cache_key_table(key) in tables:
+                    references[key] = reference
+        if not references:
+            return
+
+        checked_tables = list({export_cache_key_table(key) for key in references})
+        for table in checked_tables:
+            self.freshness_checked_at[table] = now
+        tokens = dict(
+            zip(
+                checked_tables,
+                await asyncio.gather(
+                    *[
+                        self.export_adapter.table_freshness(table)
+                        for table in checked_tables
+                    ]
+                ),
+            )
+        )
+
+        stale: t.Dict[str, ExportReference] = {}
+        async with self.exported_map_lock:
+            for key, reference in references.items():
+                token = tokens[export_cache_key_table(key)]
+                if token is None:
+                    continue
+                if reference.source_metadata.get("freshness_token") == token:
+                    continue
+                # Only remove the reference if it hasn't been replaced
+                if self.exported_map.get(key) is reference:
+                    self.logger.info(f"cached export for {key} is stale")
+                    self._supersede_export_reference(key, now)
+                    stale[key] = reference
+        if not stale:
+            return
+        await self.save_cache_index()
+
+    def _schedule_superseded_export_clean(self, entry: ExportCacheEntry):
+        self.superseded_exports.append(entry)
+        task = asyncio.create_task(self._clean_superseded_export(entry))
+        self.clean_tasks.add(task)
+        task.add_done_callback(self.clean_tasks.discard)
+
+    async def _clean_superseded_export(self, entry: ExportCacheEntry):
+        assert entry.superseded_at is not None
+        clean_at = entry.superseded_at + self.stale_export_grace_period
+        await asyncio.sleep(max(0.0, (clean_at - datetime.now()).total_seconds()))
+        try:
+            await self.export_adapter.clean_export_table(entry.export_reference)
+        except Exception as e:
+            self.logger.error(
+                f"failed to clean superseded export {entry.export_reference.payload}: {e}"
+            )
+            return
+        async with self.exported_map_lock:
+            self.superseded_exports.remove(entry)
+        await self.save_cache_index()
+
     async def resolve_export_references(
-        self, tables: t.List[str], execution_time: datetime
+        self,
+        tables: t.List[str],
+        execution_time: datetime,
+        requirements: t.Optional[t.Dict[str, ExportRequirements]] = None,
     ):
         """Resolves any required export table references or queues up a list of
         tables to be exported to a cache location. Once ready, the map of tables
-        is resolved."""
+        is resolved.
+
+        If requirements are given for a table, an export of just the required
+        columns and time ranges is used. Any cached export that covers the
+        requirements, such as an export of the full table or of a wider time
+        range, is reused."""
         future: asyncio.Future[t.Dict[str, ExportReference]] = (
             asyncio.get_event_loop().create_future()
         )
+        requirements = requirements or {}
 
-        tables_to_export = set(tables)
+        # Ensure we are only comparing unique tables
+        keys_to_tables = {
+            export_cache_key(table, requirements.get(table)): table
+            for table in set(tables)
+        }
+        keys_to_export = set(keys_to_tables.keys())
         registration = None
         export_map: t.Dict[str, ExportReference] = {}
 
-        # Ensure we are only comparing unique tables
-        for table in set(tables):
-            reference = await self.get_export_table_reference(table)
+        await self.invalidate_stale_export_references(keys_to_tables.values())
+
+        for key, table in keys_to_tables.items():
+            reference = await self.get_export_table_reference(key)
+            if reference is None:
+                reference = await self.get_covering_export_table_reference(
+                    table, requirements.get(table)
+                )
             if reference is not None:
+                EXPORTS.labels(result="cached").inc()
                 export_map[table] = reference
-                tables_to_export.remove(table)
-        if len(tables_to_export) == 0:
+                keys_to_export.remove(key)
+        if len(keys_to_export) == 0:
             return export_map
 
-        self.logger.info(f"unknown tables to export: {tables_to_export}")
+        self.logger.info(f"unknown tables to export: {keys_to_export}")
 
         async def handle_exported_table(
             *,
-            table: str,
+            key: str,
             export_reference: t.Optional[ExportReference] = None,
             error: t.Optional[Exception] = None,
         ):
             if not export_reference and not error:
                 raise RuntimeError("export_reference or error must be provided")
 
+            if key not in keys_to_export or future.done():
+                return
+
             # If there was an error send it back to the listener
             if not export_reference:
                 assert error is not None
                 future.set_exception(error)
+                if registration:
+                    self.event_emitter.remove_listener("exported_table", registration)
                 return
 
-            self.logger.info(f"exported table ready: {table} -> {export_reference}")
-            if table in tables_to_export:
-                tables_to_export.remove(table)
-                export_map[table] = export_reference
-                await self.add_export_table_reference(table, export_reference)
-            if len(tables_to_export) == 0:
+            self.logger.info(f"exported table ready: {key} -> {export_reference}")
+            keys_to_export.remove(key)
+            export_map[keys_to_tables[key]] = export_reference
+            if len(keys_to_export) == 0:
                 future.set_result(export_map)
                 if registration:
                     self.event_emitter.remove_listener("exported_table", registration)
@@ -428,8 +1071,13 @@ class CacheExportManager:
         registration = self.event_emitter.add_listener(
             "exported_table", handle_exported_table
         )
-        for table in tables_to_export:
+        for key in keys_to_export:
+            table = keys_to_tables[key]
             self.export_queue.put_nowait(
-                ExportCacheQueueItem(table=table, execution_time=execution_time)
+                ExportCacheQueueItem(
+                    table=table,
+                    execution_time=execution_time,
+                    requirements=requirements.get(table),
+                )
             )
         return await future
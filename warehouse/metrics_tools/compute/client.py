@@ -1,9 +1,10 @@
 """Metrics Calculation Service Client"""
 
+import asyncio
 import logging
 import time
 import typing as t
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
 from urllib.parse import urljoin
 
@@ -15,19 +16,29 @@ from metrics_tools.compute.types import (
     ExportedTableLoadRequest,
     ExportReference,
     InspectCacheResponse,
+    JobStatusDelta,
+    JobStatusMessage,
     JobStatusResponse,
     JobSubmitRequest,
     JobSubmitResponse,
+    QueryBatchMode,
     QueryJobStatus,
+    WorkerCacheMode,
 )
 from metrics_tools.definition import PeerMetricDependencyRef
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from pydantic_core import to_jsonable_python
+from websockets.asyncio.client import ClientConnection
+from websockets.asyncio.client import connect as async_connect
 from websockets.sync.client import connect
 from websockets.sync.connection import Connection
 
 logger = logging.getLogger(__name__)
 
+job_status_message_adapter: TypeAdapter[JobStatusMessage] = TypeAdapter(
+    JobStatusMessage
+)
+
 
 class ResponseObject[T](t.Protocol):
     def model_validate(self, obj: dict) -> T: ...
@@ -62,6 +73,35 @@ class WebsocketsConnector(BaseWebsocketConnector):
         return self.connection.send(data)
 
 
+class AsyncBaseWebsocketConnector:
+    async def receive(self) -> str:
+        raise NotImplementedError()
+
+    async def send(self, data: str):
+        raise NotImplementedError()
+
+
+class AsyncWebsocketConnectFactory(t.Protocol):
+    def __call__(
+        self, *, base_url: str, path: str
+    ) -> t.AsyncContextManager[AsyncBaseWebsocketConnector]: ...
+
+
+class AsyncWebsocketsConnector(AsyncBaseWebsocketConnector):
+    def __init__(self, connection: ClientConnection):
+        self.connection = connection
+
+    async def receive(self):
+        data = await self.connection.recv()
+        if isinstance(data, str):
+            return data
+        else:
+            return data.decode()
+
+    async def send(self, data: str):
+        return await self.connection.send(data)
+
+
 class ClientRetriesExceeded(Exception):
     pass
 
@@ -73,6 +113,60 @@ def default_ws(*, base_url: str, path: str):
         yield WebsocketsConnector(ws)
 
 
+@asynccontextmanager
+async def default_async_ws(*, base_url: str, path: str):
+    url = urljoin(base_url, path)
+    async with async_connect(url) as ws:
+        yield AsyncWebsocketsConnector(ws)
+
+
+def apply_job_status_message(
+    response: t.Optional[JobStatusResponse], raw_message: str
+) -> JobStatusResponse:
+    """Applies a message of the job status stream to the last status. The first
+    message is the full status and the rest are deltas"""
+    message = job_status_message_adapter.validate_json(raw_message)
+    if isinstance(message, JobStatusDelta):
+        assert response is not None, "received a delta before the status"
+        return message.apply(response)
+    return message
+
+
+def raise_for_job_status(
+    job_id: str, final_status: JobStatusResponse, logger: logging.Logger
+):
+    if final_status.status in [QueryJobStatus.FAILED, QueryJobStatus.CANCELLED]:
+        logger.error(f"job[{job_id}] failed with status {final_status.status}")
+        if final_status.exceptions:
+            logger.error(f"job[{job_id}] failed with exceptions")
+
+        for exc in final_status.exceptions:
+            logger.error(f"job[{job_id}] failed with exceptoin {exc}")
+
+        raise Exception(f"job[{job_id}] failed with status {final_status.status}")
+
+    logger.info(f"job[{job_id}] completed with status {final_status.status}")
+
+
+def check_request_error(e: httpx.HTTPError, logger: logging.Logger):
+    """Logs a failed request. Raises the error if the request shouldn't be
+    retried"""
+    if isinstance(e, httpx.NetworkError):
+        logger.error(f"Failed request with network error, {e}")
+    elif isinstance(e, httpx.TimeoutException):
+        logger.error(f"Failed request with timeout, {e}")
+    elif isinstance(e, httpx.HTTPStatusError):
+        logger.error(f"Failed request with response code: {e.response.status_code}")
+        if e.response.status_code >= 500:
+            logger.debug("server error, retrying")
+        elif e.response.status_code == 408:
+            logger.debug("request timeout, retrying")
+        else:
+            raise e
+    else:
+        raise e
+
+
 class Client:
     """A metrics calculation service client"""
 
@@ -133,6 +227,12 @@ class Client:
         cluster_max_size: int = 6,
         job_retries: int = 3,
         execution_time: t.Optional[datetime] = None,
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        batch_mode: QueryBatchMode = QueryBatchMode.PER_DAY,
+        target_task_seconds: t.Optional[float] = None,
+        priority: int = 0,
+        max_running_tasks: t.Optional[int] = None,
+        max_task_failures: t.Optional[int] = None,
     ):
         """Calculate metrics for a given period and write the results to a gcs
         folder. This method is a high level method that triggers all of the
@@ -156,6 +256,12 @@ class Client:
             job_retries (int): The number of retries for a given job in the worker queue. Defaults to 3.
             slots (int): The number of slots to use for the job
             execution_time (t.Optional[datetime]): The execution time for the job
+            cache_mode (WorkerCacheMode): How workers make the dependencies available to queries
+            batch_mode (QueryBatchMode): How workers evaluate the sample dates of a batch
+            target_task_seconds (t.Optional[float]): If set, batches are sized so that each task takes about this long
+            priority (int): Tasks of jobs with a higher priority are run first. Defaults to 0.
+            max_running_tasks (t.Optional[int]): The maximum number of the job's tasks that run at once
+            max_task_failures (t.Optional[int]): If set, the job is aborted once more than this many tasks fail
 
         Returns:
             ExportReference: The export reference for the resulting calculation
@@ -179,6 +285,12 @@ class Client:
             slots=slots,
             job_retries=job_retries,
             execution_time=execution_time,
+            cache_mode=cache_mode,
+            batch_mode=batch_mode,
+            target_task_seconds=target_task_seconds,
+            priority=priority,
+            max_running_tasks=max_running_tasks,
+            max_task_failures=max_task_failures,
         )
         job_id = job_response.job_id
         export_reference = job_response.export_reference
@@ -194,18 +306,7 @@ class Client:
 
         # Wait for the job to be completed
         final_status = self.wait_for_job(job_id, progress_handler)
-
-        if final_status.status == QueryJobStatus.FAILED:
-            self.logger.error(f"job[{job_id}] failed with status {final_status.status}")
-            if final_status.exceptions:
-                self.logger.error(f"job[{job_id}] failed with exceptions")
-
-            for exc in final_status.exceptions:
-                self.logger.error(f"job[{job_id}] failed with exceptoin {exc}")
-
-            raise Exception(f"job[{job_id}] failed with status {final_status.status}")
-
-        self.logger.info(f"job[{job_id}] completed with status {final_status.status}")
+        raise_for_job_status(job_id, final_status, self.logger)
 
         return export_reference
 
@@ -225,13 +326,10 @@ class Client:
         with self.websocket_connect_factory(
             base_url=f"{url.copy_with(scheme="ws")}", path=f"/job/status/{job_id}/ws"
         ) as ws:
+            response: t.Optional[JobStatusResponse] = None
             while True:
-                raw_response = ws.receive()
-                response = JobStatusResponse.model_validate_json(raw_response)
-                if response.status not in [
-                    QueryJobStatus.PENDING,
-                    QueryJobStatus.RUNNING,
-                ]:
+                response = apply_job_status_message(response, ws.receive())
+                if response.is_final:
                     return response
                 progress_handler(response)
 
@@ -250,6 +348,12 @@ class Client:
         slots: int,
         job_retries: t.Optional[int] = None,
         execution_time: t.Optional[datetime] = None,
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        batch_mode: QueryBatchMode = QueryBatchMode.PER_DAY,
+        target_task_seconds: t.Optional[float] = None,
+        priority: int = 0,
+        max_running_tasks: t.Optional[int] = None,
+        max_task_failures: t.Optional[int] = None,
     ):
         """Submit a job to the metrics calculation service
 
@@ -265,6 +369,12 @@ class Client:
             dependent_tables_map (t.Dict[str, str]): The dependent tables map
             slots (int): The number of slots to use for the job
             job_retries (int): The number of retries for a given job in the worker queue. Defaults to 3.
+            cache_mode (WorkerCacheMode): How workers make the dependencies available to queries
+            batch_mode (QueryBatchMode): How workers evaluate the sample dates of a batch
+            target_task_seconds (t.Optional[float]): If set, batches are sized so that each task takes about this long
+            priority (int): Tasks of jobs with a higher priority are run first. Defaults to 0.
+            max_running_tasks (t.Optional[int]): The maximum number of the job's tasks that run at once
+            max_task_failures (t.Optional[int]): If set, the job is aborted once more than this many tasks fail
 
         Returns:
             QueryJobSubmitResponse: The job response from the metrics calculation service
@@ -282,15 +392,31 @@ class Client:
             slots=slots,
             retries=job_retries,
             execution_time=execution_time or datetime.now(),
+            cache_mode=cache_mode,
+            batch_mode=batch_mode,
+            target_task_seconds=target_task_seconds,
+            priority=priority,
+            max_running_tasks=max_running_tasks,
+            max_task_failures=max_task_failures,
         )
         job_response = self.service_post_with_input(
             JobSubmitResponse, "/job/submit", request
         )
         return job_response
 
-    def get_job_status(self, job_id: str):
-        """Get the status of a job"""
-        return self.service_get(JobStatusResponse, f"/job/status/{job_id}")
+    def get_job_status(self, job_id: str, include_stats: bool = False):
+        """Get the status of a job. The stats include the aggregated profiles
+        of the job's tasks"""
+        params = {"include_stats": "true"} if include_stats else None
+        return self.service_get(
+            JobStatusResponse, f"/job/status/{job_id}", params=params
+        )
+
+    def cancel_job(self, job_id: str):
+        """Cancel a job. Returns the status of the job once it is cancelled"""
+        return self.service_request(
+            "POST", JobStatusResponse, f"/job/cancel/{job_id}"
+        )
 
     def run_cache_manual_load(self, map: t.Dict[str, ExportReference]):
         """Load a cache with the provided map. This is useful for testing
@@ -325,20 +451,8 @@ class Client:
                     response = make_request()
                     response.raise_for_status()
                     return response
-                except httpx.NetworkError as e:
-                    self.logger.error(f"Failed request with network error, {e}")
-                except httpx.TimeoutException as e:
-                    self.logger.error(f"Failed request with timeout, {e}")
-                except httpx.HTTPStatusError as e:
-                    self.logger.error(
-                        f"Failed request with response code: {e.response.status_code}"
-                    )
-                    if e.response.status_code >= 500:
-                        self.logger.debug("server error, retrying")
-                    elif e.response.status_code == 408:
-                        self.logger.debug("request timeout, retrying")
-                    else:
-                        raise e
+                except httpx.HTTPError as e:
+                    check_request_error(e, self.logger)
                 time.sleep(2**i)  # Exponential backoff
             raise ClientRetriesExceeded("Request failed after too many retries")
 
@@ -377,3 +491,299 @@ class Client:
             path,
             params=params,
         )
+
+
+class AsyncClient:
+    """An asyncio metrics calculation service client.
+
+    This mirrors `Client` without blocking on requests or on the job status
+    stream so the jobs of several models can be submitted and awaited together
+    (see `calculate_metrics_many`).
+    """
+
+    client: httpx.AsyncClient
+    logger: logging.Logger
+
+    @classmethod
+    def from_url(
+        cls,
+        url: str,
+        retries: int = 5,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        """Create a client from a base url
+
+        Args:
+            url (str): The base url
+            retries (int): The number of retries the client should attempt when connecting
+            log_override (t.Optional[logging.Logger]): An optional logger override
+
+        Returns:
+            AsyncClient: The client instance
+        """
+        return cls(
+            httpx.AsyncClient(base_url=url),
+            retries,
+            default_async_ws,
+            log_override=log_override,
+        )
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        retries: int,
+        websocket_connect_factory: AsyncWebsocketConnectFactory,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.client = client
+        self.retries = retries
+        self.websocket_connect_factory = websocket_connect_factory
+        self.logger = log_override or logger
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def calculate_metrics(
+        self,
+        *,
+        query_str: str,
+        start: datetime,
+        end: datetime,
+        dialect: str,
+        batch_size: int,
+        columns: t.List[t.Tuple[str, str]],
+        ref: PeerMetricDependencyRef,
+        locals: t.Dict[str, t.Any],
+        dependent_tables_map: t.Dict[str, str],
+        slots: int,
+        progress_handler: t.Optional[t.Callable[[JobStatusResponse], None]] = None,
+        cluster_min_size: int = 6,
+        cluster_max_size: int = 6,
+        job_retries: int = 3,
+        execution_time: t.Optional[datetime] = None,
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        batch_mode: QueryBatchMode = QueryBatchMode.PER_DAY,
+        target_task_seconds: t.Optional[float] = None,
+        priority: int = 0,
+        max_running_tasks: t.Optional[int] = None,
+        max_task_failures: t.Optional[int] = None,
+    ) -> ExportReference:
+        """Calculate metrics for a given period. See `Client.calculate_metrics`.
+
+        If this is cancelled while waiting for the job the job is cancelled on
+        the service as well.
+        """
+        status = await self.start_cluster(
+            min_size=cluster_min_size, max_size=cluster_max_size
+        )
+        self.logger.info(f"cluster status: {status}")
+
+        job_response = await self.submit_job(
+            query_str=query_str,
+            start=start,
+            end=end,
+            dialect=dialect,
+            batch_size=batch_size,
+            columns=columns,
+            ref=ref,
+            locals=locals,
+            dependent_tables_map=dependent_tables_map,
+            slots=slots,
+            job_retries=job_retries,
+            execution_time=execution_time,
+            cache_mode=cache_mode,
+            batch_mode=batch_mode,
+            target_task_seconds=target_task_seconds,
+            priority=priority,
+            max_running_tasks=max_running_tasks,
+            max_task_failures=max_task_failures,
+        )
+        job_id = job_response.job_id
+
+        if not progress_handler:
+
+            def _handler(response: JobStatusResponse):
+                self.logger.info(
+                    f"job[{job_id}] status: {response.status}, progress: {response.progress}"
+                )
+
+            progress_handler = _handler
+
+        try:
+            final_status = await self.wait_for_job(job_id, progress_handler)
+        except asyncio.CancelledError:
+            self.logger.info(f"job[{job_id}] no longer awaited. Cancelling the job")
+            try:
+                await asyncio.shield(self.cancel_job(job_id))
+            except Exception as e:
+                self.logger.error(f"job[{job_id}] failed to cancel the job: {e}")
+            raise
+        raise_for_job_status(job_id, final_status, self.logger)
+
+        return job_response.export_reference
+
+    async def calculate_metrics_many(
+        self, calculations: t.Sequence[t.Dict[str, t.Any]]
+    ) -> t.List[ExportReference]:
+        """Calculate the metrics of several models concurrently.
+
+        Each calculation is a dictionary of the keyword arguments of
+        `calculate_metrics`. All of the jobs are submitted at once so the
+        service can schedule their tasks together. Should any of the jobs fail
+        the remaining jobs are cancelled and the error of the first job that
+        failed is raised, like `calculate_metrics` would.
+
+        Returns:
+            t.List[ExportReference]: The export references in the order of the calculations
+        """
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [
+                    group.create_task(self.calculate_metrics(**calculation))
+                    for calculation in calculations
+                ]
+        except ExceptionGroup as e:
+            # The remaining jobs were cancelled because of the first failure so
+            # that's the error callers care about. The group is kept as the cause
+            raise e.exceptions[0] from e
+        return [task.result() for task in tasks]
+
+    async def start_cluster(self, min_size: int, max_size: int):
+        """Start a compute cluster with the given min and max size"""
+        request = ClusterStartRequest(min_size=min_size, max_size=max_size)
+        return await self.service_post_with_input(
+            ClusterStatus, "/cluster/start", request
+        )
+
+    async def wait_for_job(
+        self, job_id: str, progress_handler: t.Callable[[JobStatusResponse], None]
+    ):
+        """Connect to the websocket and listen for job updates"""
+        url = self.client.base_url
+        async with self.websocket_connect_factory(
+            base_url=f"{url.copy_with(scheme="ws")}", path=f"/job/status/{job_id}/ws"
+        ) as ws:
+            response: t.Optional[JobStatusResponse] = None
+            while True:
+                response = apply_job_status_message(response, await ws.receive())
+                if response.is_final:
+                    return response
+                progress_handler(response)
+
+    async def submit_job(
+        self,
+        *,
+        query_str: str,
+        start: datetime,
+        end: datetime,
+        dialect: str,
+        batch_size: int,
+        columns: t.List[t.Tuple[str, str]],
+        ref: PeerMetricDependencyRef,
+        locals: t.Dict[str, t.Any],
+        dependent_tables_map: t.Dict[str, str],
+        slots: int,
+        job_retries: t.Optional[int] = None,
+        execution_time: t.Optional[datetime] = None,
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        batch_mode: QueryBatchMode = QueryBatchMode.PER_DAY,
+        target_task_seconds: t.Optional[float] = None,
+        priority: int = 0,
+        max_running_tasks: t.Optional[int] = None,
+        max_task_failures: t.Optional[int] = None,
+    ) -> JobSubmitResponse:
+        """Submit a job to the metrics calculation service. See `Client.submit_job`."""
+        request = JobSubmitRequest(
+            query_str=query_str,
+            start=start,
+            end=end,
+            dialect=dialect,
+            batch_size=batch_size,
+            columns=columns,
+            ref=ref,
+            locals=locals,
+            dependent_tables_map=dependent_tables_map,
+            slots=slots,
+            retries=job_retries,
+            execution_time=execution_time or datetime.now(),
+            cache_mode=cache_mode,
+            batch_mode=batch_mode,
+            target_task_seconds=target_task_seconds,
+            priority=priority,
+            max_running_tasks=max_running_tasks,
+            max_task_failures=max_task_failures,
+        )
+        return await self.service_post_with_input(
+            JobSubmitResponse, "/job/submit", request
+        )
+
+    async def get_job_status(self, job_id: str, include_stats: bool = False):
+        """Get the status of a job"""
+        params = {"include_stats": "true"} if include_stats else None
+        return await self.service_get(
+            JobStatusResponse, f"/job/status/{job_id}", params=params
+        )
+
+    async def cancel_job(self, job_id: str):
+        """Cancel a job. Returns the status of the job once it is cancelled"""
+        return await self.service_request(
+            "POST", JobStatusResponse, f"/job/cancel/{job_id}"
+        )
+
+    async def inspect_cache(self):
+        """Inspect the cached export tables for the service"""
+        return await self.service_get(InspectCacheResponse, "/cache/inspect")
+
+    async def service_request[
+        T
+    ](
+        self,
+        method: str,
+        factory: ResponseObject[T],
+        path: str,
+        client_retries: t.Optional[int] = None,
+        **kwargs,
+    ) -> T:
+        retries = client_retries or self.retries
+        for i in range(retries):
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                response.raise_for_status()
+                return factory.model_validate(response.json())
+            except httpx.HTTPError as e:
+                check_request_error(e, self.logger)
+            await asyncio.sleep(2**i)  # Exponential backoff
+        raise ClientRetriesExceeded("Request failed after too many retries")
+
+    async def service_post_with_input[
+        T
+    ](
+        self,
+        factory: ResponseObject[T],
+        path: str,
+        input: BaseModel,
+        params: t.Optional[t.Dict[str, t.Any]] = None,
+    ) -> T:
+        return await self.service_request(
+            "POST",
+            factory,
+            path,
+            json=to_jsonable_python(input),
+            params=params,
+        )
+
+    async def service_get[
+        T
+    ](
+        self,
+        factory: ResponseObject[T],
+        path: str,
+        params: t.Optional[t.Dict[str, t.Any]] = None,
+    ) -> T:
+        return await self.service_request("GET", factory, path, params=params)
@@ -206,10 +206,25 @@ class ClusterManager:
         duckdb_path: str,
         cluster_factory: ClusterFactory,
         log_override: t.Optional[logging.Logger] = None,
+        cache_budget_bytes: t.Optional[int] = None,
+        parquet_cache_dir: t.Optional[str] = None,
+        result_row_group_size: t.Optional[int] = None,
+        result_compression: t.Optional[str] = None,
+        explain_slow_queries: bool = False,
+        explain_slow_query_seconds: float = 300.0,
     ):
         def plugin_factory():
             return DuckDBMetricsWorkerPlugin(
-                gcs_bucket, gcs_key_id, gcs_secret, duckdb_path
+                gcs_bucket,
+                gcs_key_id,
+                gcs_secret,
+                duckdb_path,
+                cache_budget_bytes=cache_budget_bytes,
+                parquet_cache_dir=parquet_cache_dir,
+                result_row_group_size=result_row_group_size,
+                result_compression=result_compression,
+                explain_slow_queries=explain_slow_queries,
+                explain_slow_query_seconds=explain_slow_query_seconds,
             )
 
         return cls(plugin_factory, cluster_factory, log_override)
@@ -0,0 +1,107 @@
+"""Runtime metrics of the metrics calculation service.
+
+Components define prometheus_client metrics at module level on the service's
+`REGISTRY` which is rendered by the `/metrics` endpoint. Metrics that can only
+be read from somewhere else (e.g. the dask workers) are refreshed by
+refreshers that run before the metrics are rendered.
+"""
+
+import logging
+import threading
+import typing as t
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+logger = logging.getLogger(__name__)
+
+# Tasks and exports can take from milliseconds to hours
+DEFAULT_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    900.0,
+    1800.0,
+    3600.0,
+    float("inf"),
+)
+
+REGISTRY = CollectorRegistry()
+
+_refreshers: t.List[t.Callable[[], t.Awaitable[None]]] = []
+
+
+def add_refresher(refresher: t.Callable[[], t.Awaitable[None]]) -> t.Callable[[], None]:
+    """Adds a function that updates metrics before they are rendered.
+    Returns a function that removes the refresher."""
+    _refreshers.append(refresher)
+
+    def remove():
+        if refresher in _refreshers:
+            _refreshers.remove(refresher)
+
+    return remove
+
+
+async def refresh_metrics():
+    for refresher in list(_refreshers):
+        try:
+            await refresher()
+        except Exception as e:
+            logger.warning(f"metrics refresher failed: {e}")
+
+
+def render_metrics(registry: CollectorRegistry = REGISTRY) -> bytes:
+    return generate_latest(registry)
+
+
+class WorkerStatsCollector(Collector):
+    """Exposes the statistics last reported by each worker. The hits and
+    misses are counted on the workers so they're exposed as counters with the
+    totals the workers reported. Workers that have left the cluster are no
+    longer exposed."""
+
+    def __init__(self, prefix: str = "mcs_worker_cache"):
+        self.prefix = prefix
+        self._stats: t.Dict[str, t.Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, stats: t.Dict[str, t.Dict[str, float]]):
+        with self._lock:
+            self._stats = {worker: dict(values) for worker, values in stats.items()}
+
+    def collect(self):
+        hits = CounterMetricFamily(
+            f"{self.prefix}_hits",
+            "Dependency exports that were already cached on a worker",
+            labels=["worker"],
+        )
+        misses = CounterMetricFamily(
+            f"{self.prefix}_misses",
+            "Dependency exports that a worker had to load",
+            labels=["worker"],
+        )
+        size_bytes = GaugeMetricFamily(
+            f"{self.prefix}_size_bytes",
+            "Size of the dependency exports cached on a worker",
+            labels=["worker"],
+        )
+        with self._lock:
+            for worker, stats in self._stats.items():
+                if "hits" in stats:
+                    hits.add_metric([worker], stats["hits"])
+                if "misses" in stats:
+                    misses.add_metric([worker], stats["misses"])
+                if "size_bytes" in stats:
+                    size_bytes.add_metric([worker], stats["size_bytes"])
+        yield hits
+        yield misses
+        yield size_bytes
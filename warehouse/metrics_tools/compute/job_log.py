@@ -0,0 +1,54 @@
+"""Spills the full log of each job's updates to local files.
+
+The service only keeps a compact summary of the state of each job in memory.
+If a log directory is configured every update of a job is also appended as a
+json line to a file for that job so the full history can be inspected when
+debugging.
+"""
+
+import logging
+import os
+import typing as t
+
+from .types import QueryJobUpdate
+
+logger = logging.getLogger(__name__)
+
+
+class JobUpdateLog:
+    def __init__(self, path: str, log_override: t.Optional[logging.Logger] = None):
+        self.path = path
+        self._files: t.Dict[str, t.TextIO] = {}
+        self.logger = log_override or logger
+        os.makedirs(path, exist_ok=True)
+
+    def job_path(self, job_id: str):
+        return os.path.join(self.path, f"{job_id}.jsonl")
+
+    def append(self, job_id: str, update: QueryJobUpdate):
+        try:
+            log_file = self._files.get(job_id)
+            if log_file is None:
+                # Line buffered so the log is complete if the service stops
+                log_file = open(self.job_path(job_id), "a", buffering=1)
+                self._files[job_id] = log_file
+            log_file.write(update.model_dump_json() + "\n")
+        except OSError as e:
+            self.logger.warning(f"job[{job_id}] unable to write the update log: {e}")
+
+    def read(self, job_id: str) -> t.Iterator[QueryJobUpdate]:
+        path = self.job_path(job_id)
+        if not os.path.exists(path):
+            return
+        with open(path) as log_file:
+            for line in log_file:
+                yield QueryJobUpdate.model_validate_json(line)
+
+    def close(self, job_id: str):
+        log_file = self._files.pop(job_id, None)
+        if log_file:
+            log_file.close()
+
+    def close_all(self):
+        for job_id in list(self._files.keys()):
+            self.close(job_id)
@@ -0,0 +1,61 @@
+"""Tracks which metrics workers have which dependency exports cached.
+
+Loading a dependency export into a worker's duckdb is far more expensive than
+the queries of a single task. The service uses this to prefer placing a task
+on a worker that already has the task's dependencies cached.
+"""
+
+import typing as t
+
+from .types import ExportReference, ExportType
+
+
+def export_paths(dependencies: t.Dict[str, ExportReference]) -> t.Set[str]:
+    """The gcs paths of the dependency exports"""
+    paths: t.Set[str] = set()
+    for reference in dependencies.values():
+        if reference.type != ExportType.GCS:
+            continue
+        gcs_path = reference.payload.get("gcs_path")
+        if gcs_path:
+            paths.add(gcs_path)
+    return paths
+
+
+class WorkerCacheLocality:
+    def __init__(self):
+        self._workers: t.Dict[str, t.Set[str]] = {}
+
+    def update_inventory(self, inventory: t.Dict[str, t.List[str]]):
+        """Replaces the tracked cache contents with an inventory reported by
+        the workers. Workers missing from the inventory have left the
+        cluster."""
+        self._workers = {worker: set(paths) for worker, paths in inventory.items()}
+
+    def add(self, worker: str, paths: t.Iterable[str]):
+        self._workers.setdefault(worker, set()).update(paths)
+
+    @property
+    def workers(self) -> t.List[str]:
+        return list(self._workers.keys())
+
+    def preferred_workers(self, paths: t.Set[str]) -> t.List[str]:
+        """The workers with the most of the given paths cached. Empty if no
+        worker has any of them cached."""
+        best = 0
+        preferred: t.List[str] = []
+        for worker, cached in self._workers.items():
+            count = len(cached & paths)
+            if count == 0 or count < best:
+                continue
+            if count > best:
+                best = count
+                preferred = []
+            preferred.append(worker)
+        return preferred
+
+    def cold_workers(self, paths: t.Set[str]) -> t.List[str]:
+        """The workers that have none of the given paths cached"""
+        return [
+            worker for worker, cached in self._workers.items() if not cached & paths
+        ]
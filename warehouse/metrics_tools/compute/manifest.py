@@ -0,0 +1,150 @@
+"""Durable records of the batches that metrics jobs have completed.
+
+The state of a job only lives in the memory of the service so a job that is
+interrupted by a restart of the service is submitted again from the start. Each
+batch a job completes is recorded as a small file under a directory keyed by
+the job's query, time range and the identity of the data its dependencies were
+exported from (not the location of the exports, which changes whenever a table
+is exported again). When an identical job is submitted again the recorded
+results of its completed batches are copied to the new job's result path
+instead of being computed again. The manifest of a job is deleted once the job
+completes. The manifests can be stored separately from the results (e.g. on a
+local disk).
+
+Batches are matched by the same key as the batch result cache, so batches that
+are planned differently (e.g. adaptive batches) are only reused if they
+happen to be identical.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import typing as t
+from datetime import datetime
+
+from fsspec import AbstractFileSystem
+from fsspec.core import url_to_fs
+
+from .result_cache import dependencies_identity
+from .types import BatchResultCacheEntry, ExportReference, JobSubmitRequest
+
+logger = logging.getLogger(__name__)
+
+
+def job_key(input: JobSubmitRequest, dependencies: t.Dict[str, ExportReference]) -> str:
+    """A hash of the parts of a job request that determine its batches"""
+    content = {
+        "query": input.query_str,
+        "dialect": input.dialect,
+        "start": input.start.isoformat(),
+        "end": input.end.isoformat(),
+        "ref": input.ref,
+        "locals": input.locals,
+        "columns": input.columns,
+        "batch_mode": input.batch_mode.value,
+        "dependencies": dependencies_identity(dependencies),
+    }
+    encoded = json.dumps(content, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class JobManifest:
+    """The completed batches of a job"""
+
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        path: str,
+        entries: t.Optional[t.Dict[str, BatchResultCacheEntry]] = None,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.fs = fs
+        self.path = path
+        self._entries = entries or {}
+        self.logger = log_override or logger
+
+    def get(self, key: str) -> t.Optional[BatchResultCacheEntry]:
+        return self._entries.get(key)
+
+    async def add(self, key: str, path: str, rows_written: int, bytes_written: int):
+        """Records a completed batch. Each batch is written to its own file so
+        recording a batch doesn't rewrite the whole manifest."""
+        entry = BatchResultCacheEntry(
+            key=key,
+            path=path,
+            rows_written=rows_written,
+            bytes_written=bytes_written,
+            created_at=datetime.now(),
+        )
+        self._entries[key] = entry
+        try:
+            await asyncio.to_thread(
+                self.fs.pipe,
+                os.path.join(self.path, f"{key}.json"),
+                entry.model_dump_json().encode(),
+            )
+        except Exception as e:
+            self.logger.warning(f"unable to record completed batch {key}: {e}")
+
+    async def delete(self):
+        """Deletes the manifest once the job no longer needs to be resumed"""
+        self._entries = {}
+        try:
+            if await asyncio.to_thread(self.fs.exists, self.path):
+                await asyncio.to_thread(self.fs.rm, self.path, recursive=True)
+        except Exception as e:
+            self.logger.warning(f"unable to delete job manifest {self.path}: {e}")
+
+    def paths(self) -> t.Set[str]:
+        """The paths of the recorded results"""
+        return {entry.path for entry in self._entries.values()}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class JobManifestStore:
+    """Stores job manifests on any fsspec filesystem. In production this is a
+    gcs path next to the job results."""
+
+    @classmethod
+    def from_url(cls, url: str, log_override: t.Optional[logging.Logger] = None):
+        fs, path = url_to_fs(url)
+        return cls(fs, path, log_override=log_override)
+
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        path: str,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.fs = fs
+        self.path = path
+        self.logger = log_override or logger
+
+    async def load(self, key: str) -> JobManifest:
+        """Loads the manifest of the job with the given key. The manifest is
+        empty if the job hasn't completed any batches."""
+        path = os.path.join(self.path, key)
+        try:
+            entries = await asyncio.to_thread(self._load, path)
+        except Exception as e:
+            self.logger.warning(f"unable to load job manifest {path}: {e}")
+            entries = {}
+        if entries:
+            self.logger.info(f"loaded {len(entries)} completed batches from {path}")
+        return JobManifest(self.fs, path, entries, log_override=self.logger)
+
+    def _load(self, path: str) -> t.Dict[str, BatchResultCacheEntry]:
+        if not self.fs.exists(path):
+            return {}
+        files = self.fs.find(path)
+        if not files:
+            return {}
+        entries: t.Dict[str, BatchResultCacheEntry] = {}
+        for content in self.fs.cat(files).values():
+            entry = BatchResultCacheEntry.model_validate_json(content)
+            entries[entry.key] = entry
+        return entries
@@ -0,0 +1,222 @@
+"""Derives the parts of dependency tables that a metrics job actually reads so
+that exports can be pruned to those columns and time ranges.
+
+The analysis is intentionally conservative. Anything that can't be understood
+(e.g. a `SELECT *` or a time filter nested in an `OR`) results in the
+requirement being dropped which means the full table is exported.
+"""
+
+import logging
+import typing as t
+from datetime import datetime
+
+import duckdb
+from metrics_tools.utils.tables import resolve_table_fqn
+from sqlglot import exp
+from sqlmesh.core.dialect import parse_one
+
+from .types import ExportRequirements, ExportTimeRange
+
+logger = logging.getLogger(__name__)
+
+Bounds = t.Tuple[t.Optional[datetime], t.Optional[datetime]]
+
+
+def export_requirements_from_queries(
+    queries: t.List[str],
+    tables: t.Iterable[str],
+    dialect: str = "duckdb",
+) -> t.Dict[str, ExportRequirements]:
+    """Returns the export requirements for each of the given tables that is
+    referenced by the queries. The requirements cover every query so the
+    queries of a job can be given to this to get the requirements of the whole
+    job."""
+    table_names = set(tables)
+    conn = duckdb.connect()
+    try:
+        analyzed = [
+            _analyze_query(conn, parse_one(query, dialect=dialect), table_names)
+            for query in queries
+        ]
+    finally:
+        conn.close()
+
+    requirements: t.Dict[str, ExportRequirements] = {}
+    for table in table_names:
+        table_results = [result[table] for result in analyzed if table in result]
+        if not table_results:
+            continue
+
+        columns: t.Optional[t.Set[str]] = set()
+        for table_columns, _ in table_results:
+            if table_columns is None or columns is None:
+                columns = None
+            else:
+                columns.update(table_columns)
+
+        time_ranges = _merge_bounds([bounds for _, bounds in table_results])
+
+        requirements[table] = ExportRequirements(
+            columns=sorted(columns) if columns is not None else None,
+            time_ranges=[
+                ExportTimeRange(column=column, start=start, end=end)
+                for column, (start, end) in sorted(time_ranges.items())
+            ],
+        )
+    return requirements
+
+
+def _merge_bounds(bounds_list: t.List[t.Dict[str, Bounds]]) -> t.Dict[str, Bounds]:
+    """Merges bounds that must all be satisfied by the same export. Only columns
+    bounded in every entry are kept and the union of the ranges is taken."""
+    if not bounds_list:
+        return {}
+    merged = dict(bounds_list[0])
+    for bounds in bounds_list[1:]:
+        for column in list(merged.keys()):
+            if column not in bounds:
+                del merged[column]
+                continue
+            start, end = merged[column]
+            other_start, other_end = bounds[column]
+            merged[column] = (
+                min(start, other_start) if start and other_start else None,
+                max(end, other_end) if end and other_end else None,
+            )
+    return {
+        column: (start, end)
+        for column, (start, end) in merged.items()
+        if start is not None or end is not None
+    }
+
+
+def _analyze_query(
+    conn: duckdb.DuckDBPyConnection,
+    query: exp.Expression,
+    tables: t.Set[str],
+) -> t.Dict[str, t.Tuple[t.Optional[t.Set[str]], t.Dict[str, Bounds]]]:
+    """Returns the referenced columns and the time bounds of each table that
+    is used in the query"""
+    table_nodes: t.Dict[str, t.List[exp.Table]] = {}
+    for table in query.find_all(exp.Table):
+        table_fqn = resolve_table_fqn(table)
+        if table_fqn in tables:
+            table_nodes.setdefault(table_fqn, []).append(table)
+
+    has_star = any(
+        not isinstance(star.parent, exp.Count) for star in query.find_all(exp.Star)
+    )
+    # Columns in a `JOIN ... USING (...)` are identifiers rather than columns and
+    # aren't qualified so they're required from any of the tables
+    using_columns = {
+        identifier.name
+        for join in query.find_all(exp.Join)
+        for identifier in join.args.get("using") or []
+    }
+
+    result: t.Dict[str, t.Tuple[t.Optional[t.Set[str]], t.Dict[str, Bounds]]] = {}
+    for table_fqn, nodes in table_nodes.items():
+        aliases = {node.alias_or_name for node in nodes}
+
+        columns: t.Optional[t.Set[str]] = None
+        if not has_star:
+            columns = {
+                column.name
+                for column in query.find_all(exp.Column)
+                if not column.table or column.table in aliases
+            } | using_columns
+
+        select_bounds: t.List[t.Dict[str, Bounds]] = []
+        for node in nodes:
+            select = node.parent_select
+            if not select:
+                select_bounds.append({})
+                continue
+            select_bounds.append(_select_bounds(conn, select, node))
+
+        result[table_fqn] = (columns, _merge_bounds(select_bounds))
+    return result
+
+
+def _select_bounds(
+    conn: duckdb.DuckDBPyConnection, select: exp.Select, table: exp.Table
+) -> t.Dict[str, Bounds]:
+    """Finds the time bounds applied to the table by the where clause of the
+    select that reads from it. Only top level conjunctions are considered."""
+    where = select.args.get("where")
+    if not where:
+        return {}
+
+    source_count = len(
+        [node for node in select.find_all(exp.Table) if node.parent_select is select]
+    )
+    alias = table.alias_or_name
+
+    def table_column(expression: exp.Expression) -> t.Optional[str]:
+        if not isinstance(expression, exp.Column):
+            return None
+        if expression.table == alias or (not expression.table and source_count == 1):
+            return expression.name
+        return None
+
+    conditions = (
+        where.this.flatten() if isinstance(where.this, exp.And) else [where.this]
+    )
+
+    bounds: t.Dict[str, Bounds] = {}
+
+    def add_bound(
+        column: str, start: t.Optional[exp.Expression], end: t.Optional[exp.Expression]
+    ):
+        current_start, current_end = bounds.get(column, (None, None))
+        start_value = _evaluate_bound(conn, start)
+        end_value = _evaluate_bound(conn, end)
+        # Multiple conditions on the same column narrow the range
+        if start_value and (not current_start or start_value > current_start):
+            current_start = start_value
+        if end_value and (not current_end or end_value < current_end):
+            current_end = end_value
+        bounds[column] = (current_start, current_end)
+
+    for condition in conditions:
+        condition = condition.unnest()
+        if isinstance(condition, exp.Between):
+            column = table_column(condition.this)
+            if column:
+                add_bound(column, condition.args["low"], condition.args["high"])
+        elif isinstance(condition, (exp.GT, exp.GTE, exp.LT, exp.LTE)):
+            left_column = table_column(condition.this)
+            right_column = table_column(condition.expression)
+            lower = isinstance(condition, (exp.GT, exp.GTE))
+            if left_column:
+                if lower:
+                    add_bound(left_column, condition.expression, None)
+                else:
+                    add_bound(left_column, None, condition.expression)
+            elif right_column:
+                if lower:
+                    add_bound(right_column, None, condition.this)
+                else:
+                    add_bound(right_column, condition.this, None)
+    return {
+        column: (start, end)
+        for column, (start, end) in bounds.items()
+        if start is not None or end is not None
+    }
+
+
+def _evaluate_bound(
+    conn: duckdb.DuckDBPyConnection, bound: t.Optional[exp.Expression]
+) -> t.Optional[datetime]:
+    """Evaluates a constant bound expression into a datetime using duckdb"""
+    if bound is None or bound.find(exp.Column):
+        return None
+    cast = exp.cast(bound.copy(), exp.DataType.Type.TIMESTAMP)
+    try:
+        row = conn.execute(f"SELECT {cast.sql(dialect='duckdb')}").fetchone()
+    except duckdb.Error as e:
+        logger.debug(f"unable to evaluate bound {bound.sql()}: {e}")
+        return None
+    if not row or not isinstance(row[0], datetime):
+        return None
+    return row[0]
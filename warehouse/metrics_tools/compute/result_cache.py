@@ -0,0 +1,223 @@
+"""A content addressed cache of the results of query batches.
+
+Jobs from different sqlmesh runs (and retries of the same model) often render
+identical batches over the same dependency exports. Each batch is keyed by a
+hash of its queries, its sample dates and the identity of the data it reads.
+A batch with a cached result is satisfied by copying the previous result file
+to the new job's result path instead of being executed again.
+
+Entries expire after `max_age`. The result files are owned by the jobs that
+wrote them and may be removed by the bucket's lifecycle rules so a missing
+file is treated as a miss. If a `budget_bytes` is given the least recently
+used entries are forgotten once the total size of the cached results exceeds
+it. If an index is given the entries are persisted to it so that the cache
+survives restarts of the service.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import typing as t
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fsspec import AbstractFileSystem
+from fsspec.core import url_to_fs
+
+from .types import BatchResultCacheEntry, BatchResultCacheManifest, ExportReference
+
+logger = logging.getLogger(__name__)
+
+
+def batch_key(
+    queries: t.List[str],
+    sample_dates: t.Optional[t.List[datetime]],
+    dependencies: t.Dict[str, ExportReference],
+) -> str:
+    """A hash of everything that determines the result of a batch"""
+    content = {
+        "queries": queries,
+        "sample_dates": [day.isoformat() for day in sample_dates or []],
+        "dependencies": dependencies_identity(dependencies),
+    }
+    encoded = json.dumps(content, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def dependencies_identity(
+    dependencies: t.Dict[str, ExportReference],
+) -> t.Dict[str, t.Dict[str, t.Any]]:
+    """The parts of the dependency exports that identify their contents. If
+    the freshness of the exported table is known the export is identified by
+    the table and its freshness so that exports of the same data (e.g. after
+    the export cache is cleared) have the same identity. Otherwise the export
+    location is used."""
+    return {
+        ref_name: _dependency_identity(reference)
+        for ref_name, reference in sorted(dependencies.items())
+    }
+
+
+def _dependency_identity(reference: ExportReference) -> t.Dict[str, t.Any]:
+    freshness_token = reference.source_metadata.get("freshness_token")
+    if freshness_token is not None:
+        return {"table": reference.table_fqn(), "freshness_token": freshness_token}
+    return {
+        "table": reference.table_fqn(),
+        "type": reference.type.value,
+        "payload": reference.payload,
+    }
+
+
+class FileBatchResultCacheIndex:
+    """Stores the batch result cache index as a json manifest on any fsspec
+    filesystem. In production this is a gcs path next to the results."""
+
+    @classmethod
+    def from_url(cls, url: str, log_override: t.Optional[logging.Logger] = None):
+        fs, path = url_to_fs(url)
+        return cls(fs, path, log_override=log_override)
+
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        path: str,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.fs = fs
+        self.path = path
+        self.logger = log_override or logger
+
+    async def load(self) -> t.List[BatchResultCacheEntry]:
+        return await asyncio.to_thread(self._load)
+
+    async def save(self, entries: t.List[BatchResultCacheEntry]):
+        await asyncio.to_thread(self._save, entries)
+
+    def _load(self) -> t.List[BatchResultCacheEntry]:
+        if not self.fs.exists(self.path):
+            self.logger.info(f"no batch result cache index found at {self.path}")
+            return []
+        with self.fs.open(self.path, "r") as f:
+            manifest = BatchResultCacheManifest.model_validate_json(f.read())
+        return manifest.entries
+
+    def _save(self, entries: t.List[BatchResultCacheEntry]):
+        manifest = BatchResultCacheManifest(entries=entries)
+        parent = os.path.dirname(self.path)
+        if parent:
+            self.fs.makedirs(parent, exist_ok=True)
+        with self.fs.open(self.path, "w") as f:
+            f.write(manifest.model_dump_json())
+
+
+class BatchResultCache:
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        max_age: timedelta,
+        budget_bytes: t.Optional[int] = None,
+        index: t.Optional[FileBatchResultCacheIndex] = None,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.fs = fs
+        self.max_age = max_age
+        self.budget_bytes = budget_bytes
+        self.index = index
+        self.index_lock = asyncio.Lock()
+        self._entries: t.OrderedDict[str, BatchResultCacheEntry] = OrderedDict()
+        self.logger = log_override or logger
+
+    async def load_index(self):
+        """Loads the entries persisted to the index. Expired entries are
+        dropped and the oldest entries are evicted first."""
+        if not self.index:
+            return
+        try:
+            entries = await self.index.load()
+        except Exception as e:
+            self.logger.warning(f"unable to load the batch result cache index: {e}")
+            return
+        now = datetime.now()
+        for entry in sorted(entries, key=lambda entry: entry.created_at):
+            if now - entry.created_at > self.max_age:
+                continue
+            self._entries[entry.key] = entry
+        self._evict()
+        self.logger.info(f"loaded {len(self._entries)} cached batch results")
+
+    async def save_index(self):
+        if not self.index:
+            return
+        async with self.index_lock:
+            try:
+                await self.index.save(list(self._entries.values()))
+            except Exception as e:
+                self.logger.warning(f"unable to save the batch result cache index: {e}")
+
+    def get(self, key: str) -> t.Optional[BatchResultCacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if datetime.now() - entry.created_at > self.max_age:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def link(
+        self, key: str, destination: str
+    ) -> t.Optional[BatchResultCacheEntry]:
+        """Copies the cached result of a batch to the destination. Returns the
+        cache entry or None if there isn't a usable cached result."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            await asyncio.to_thread(self.fs.copy, entry.path, destination)
+        except Exception as e:
+            self.logger.warning(
+                f"unable to link cached result {entry.path} to {destination}: {e}"
+            )
+            self._entries.pop(key, None)
+            await self.save_index()
+            return None
+        return entry
+
+    async def add(self, key: str, path: str, rows_written: int, bytes_written: int):
+        self._entries[key] = BatchResultCacheEntry(
+            key=key,
+            path=path,
+            rows_written=rows_written,
+            bytes_written=bytes_written,
+            created_at=datetime.now(),
+        )
+        self._entries.move_to_end(key)
+        self._evict()
+        await self.save_index()
+
+    def paths_under(self, prefix: str) -> t.List[str]:
+        """The paths of the cached results stored under the prefix"""
+        prefix = prefix.rstrip("/") + "/"
+        return [
+            entry.path
+            for entry in self._entries.values()
+            if entry.path.startswith(prefix)
+        ]
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(entry.bytes_written for entry in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        if self.budget_bytes is None:
+            return
+        total = self.size_bytes
+        while total > self.budget_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.bytes_written
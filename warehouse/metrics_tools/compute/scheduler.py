@@ -0,0 +1,172 @@
+"""Releases the tasks of metrics jobs to the dask scheduler.
+
+Dask schedules tasks in the order they are submitted so a large backfill that
+submits all of its tasks at once delays every job submitted after it. Instead
+each task waits here for a slot before it is submitted to dask. Slots go to
+the jobs with the highest priority first. Jobs of the same priority share the
+slots fairly by giving the next slot to the job with the fewest running tasks.
+A job can also cap the number of its tasks that run at once.
+"""
+
+import asyncio
+import logging
+import typing as t
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import count
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledJob:
+    def __init__(
+        self, job_id: str, priority: int, max_running: t.Optional[int], order: int
+    ):
+        self.job_id = job_id
+        self.priority = priority
+        self.max_running = max_running
+        self.order = order
+        self.running = 0
+        self.waiting: t.Deque[asyncio.Future[None]] = deque()
+
+    @property
+    def is_eligible(self) -> bool:
+        if not self.waiting:
+            return False
+        return self.max_running is None or self.running < self.max_running
+
+
+class JobTaskScheduler:
+    def __init__(
+        self,
+        max_running_tasks: t.Optional[int] = None,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self.max_running_tasks = max_running_tasks
+        self._jobs: t.Dict[str, ScheduledJob] = {}
+        self._order = count()
+        self._running = 0
+        self.logger = log_override or logger
+
+    def add_job(
+        self, job_id: str, priority: int = 0, max_running: t.Optional[int] = None
+    ):
+        self._jobs[job_id] = ScheduledJob(
+            job_id, priority, max_running, next(self._order)
+        )
+
+    def remove_job(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if not job:
+            return
+        for waiter in job.waiting:
+            waiter.cancel()
+        self._running -= job.running
+        self._dispatch()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def running_for(self, job_id: str) -> int:
+        job = self._jobs.get(job_id)
+        return job.running if job else 0
+
+    @asynccontextmanager
+    async def slot(self, job_id: str):
+        """Waits for a slot for one of the job's tasks and holds it until the
+        context exits"""
+        await self.acquire(job_id)
+        try:
+            yield
+        finally:
+            self.release(job_id)
+
+    async def acquire(self, job_id: str):
+        job = self._jobs.get(job_id)
+        assert job is not None, f"job[{job_id}] is not scheduled"
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        job.waiting.append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted as the waiter was cancelled
+                self.release(job_id)
+            elif waiter in job.waiting:
+                job.waiting.remove(waiter)
+            raise
+
+    def release(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None:
+            # The job was removed which already released its slots
+            return
+        job.running -= 1
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.max_running_tasks is None or self._running < self.max_running_tasks:
+            eligible = [job for job in self._jobs.values() if job.is_eligible]
+            if not eligible:
+                return
+            job = min(eligible, key=lambda job: (-job.priority, job.running, job.order))
+            waiter = job.waiting.popleft()
+            if waiter.cancelled():
+                continue
+            waiter.set_result(None)
+            job.running += 1
+            self._running += 1
+
+
+class JobTaskGroup:
+    """The tasks of a single job. Once more than `max_failures` of the tasks
+    have failed the group is aborted so that the job stops submitting tasks
+    and cancels the ones that are still outstanding. Tasks that are
+    cancelled, or that fail with one of the `cancellation_exceptions` (e.g.
+    when the cluster cancels a task as a worker leaves), don't count as
+    failures."""
+
+    def __init__(
+        self,
+        max_failures: t.Optional[int] = None,
+        cancellation_exceptions: t.Tuple[t.Type[BaseException], ...] = (),
+    ):
+        self.max_failures = max_failures
+        self.cancellation_exceptions = cancellation_exceptions
+        self.failures = 0
+        self.tasks: t.List[asyncio.Task] = []
+
+    def add(self, task: asyncio.Task):
+        self.tasks.append(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        exception = task.exception()
+        if exception is None or isinstance(exception, self.cancellation_exceptions):
+            return
+        self.failures += 1
+
+    @property
+    def aborted(self) -> bool:
+        return self.max_failures is not None and self.failures > self.max_failures
+
+    async def cancel(self) -> int:
+        """Cancels the outstanding tasks and waits for them to finish. Returns
+        the number of tasks that were cancelled."""
+        pending = [task for task in self.tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
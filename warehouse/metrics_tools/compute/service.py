@@ -4,27 +4,57 @@ import asyncio
 import copy
 import logging
 import os
+import time
 import typing as t
 import uuid
-from datetime import datetime
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import aclosing
+from datetime import date, datetime
 
 from dask.distributed import CancelledError
+from fsspec import AbstractFileSystem
 from metrics_tools.compute.result import DBImportAdapter
-from metrics_tools.compute.worker import execute_duckdb_load
+from metrics_tools.compute.worker import (
+    WARM_DEPENDENCIES_METADATA_KEY,
+    execute_duckdb_load,
+    get_cache_inventory,
+    get_worker_metrics,
+    warm_worker_cache,
+)
 from metrics_tools.runner import FakeEngineAdapter, MetricsRunner
+from prometheus_client import Counter, Gauge, Histogram
 from pyee.asyncio import AsyncIOEventEmitter
 
+from .batching import AdaptiveBatchPlanner, day_weights, window_days
 from .cache import CacheExportManager
 from .cluster import ClusterManager
+from .instrumentation import (
+    DEFAULT_BUCKETS,
+    REGISTRY,
+    WorkerStatsCollector,
+    add_refresher,
+)
+from .job_log import JobUpdateLog
+from .locality import WorkerCacheLocality, export_paths
+from .manifest import JobManifest, JobManifestStore, job_key
+from .requirements import export_requirements_from_queries
+from .result_cache import BatchResultCache, batch_key
+from .scheduler import JobTaskGroup, JobTaskScheduler
+from .spine import render_rolling_template
 from .types import (
+    BatchResultCacheEntry,
     ClusterStartRequest,
     ClusterStatus,
     ColumnsDefinition,
     ExportReference,
+    ExportRequirements,
     ExportType,
+    JobStatusDelta,
     JobStatusResponse,
     JobSubmitRequest,
     JobSubmitResponse,
+    QueryBatchMode,
     QueryJobState,
     QueryJobStateUpdate,
     QueryJobStatus,
@@ -32,12 +62,56 @@ from .types import (
     QueryJobTaskUpdate,
     QueryJobUpdate,
     QueryJobUpdateScope,
+    QueryTaskProfile,
+    QueryTaskResult,
     TableReference,
+    WorkerCacheMode,
+    WorkerWarmRequest,
 )
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+JOBS = Counter("mcs_jobs", "Jobs that have finished", ["status"], registry=REGISTRY)
+TASKS = Counter("mcs_tasks", "Tasks that have finished", ["status"], registry=REGISTRY)
+TASK_QUEUED_SECONDS = Histogram(
+    "mcs_task_queued_seconds",
+    "Time tasks waited for a slot in the job scheduler",
+    buckets=DEFAULT_BUCKETS,
+    registry=REGISTRY,
+)
+TASK_SECONDS = Histogram(
+    "mcs_task_seconds",
+    "Time workers spent executing tasks",
+    buckets=DEFAULT_BUCKETS,
+    registry=REGISTRY,
+)
+RUNNING_TASKS = Gauge(
+    "mcs_running_tasks",
+    "Tasks that have been released to the cluster",
+    registry=REGISTRY,
+)
+RESULT_ROWS = Counter(
+    "mcs_result_rows_written", "Rows written to task results", registry=REGISTRY
+)
+RESULT_BYTES = Counter(
+    "mcs_result_bytes_written", "Bytes written to task results", registry=REGISTRY
+)
+RENDER_SECONDS = Histogram(
+    "mcs_render_batch_seconds",
+    "Time spent rendering the queries of a batch",
+    buckets=DEFAULT_BUCKETS,
+    registry=REGISTRY,
+)
+RENDERED_SAMPLE_DATES = Counter(
+    "mcs_rendered_sample_dates",
+    "Sample dates rendered into task batches",
+    registry=REGISTRY,
+)
+WORKERS = Gauge("mcs_workers", "Workers in the cluster", registry=REGISTRY)
+WORKER_STATS = WorkerStatsCollector()
+REGISTRY.register(WORKER_STATS)
+
 
 class JobError(Exception):
     pass
@@ -79,6 +153,18 @@ class JobTaskFailed(JobError):
         super().__init__(f"task failed with exception: {exception}")
 
 
+def render_query_batch(input: JobSubmitRequest, days: t.List[datetime]):
+    """Renders the queries of a job for the given sample dates. This is run in
+    the render process pool so it only depends on picklable arguments."""
+    runner = MetricsRunner.from_engine_adapter(
+        FakeEngineAdapter("duckdb"),
+        input.query_as("duckdb"),
+        input.ref,
+        input.locals,
+    )
+    return [runner.render_query(day, day) for day in days]
+
+
 class MetricsCalculationService:
     id: str
     gcs_bucket: str
@@ -86,6 +172,7 @@ class MetricsCalculationService:
     cache_manager: CacheExportManager
     job_state: t.Dict[str, QueryJobState]
     job_tasks: t.Dict[str, asyncio.Task]
+    job_manifests: t.Dict[str, JobManifest]
     job_state_lock: asyncio.Lock
     logger: logging.Logger
 
@@ -99,7 +186,17 @@ class MetricsCalculationService:
         cache_manager: CacheExportManager,
         import_adapter: DBImportAdapter,
         log_override: t.Optional[logging.Logger] = None,
+        render_workers: int = 0,
+        result_cache: t.Optional[BatchResultCache] = None,
+        max_running_tasks: t.Optional[int] = None,
+        result_fs: t.Optional[AbstractFileSystem] = None,
+        manifest_store: t.Optional[JobManifestStore] = None,
+        update_log: t.Optional[JobUpdateLog] = None,
+        status_interval: float = 1.0,
     ):
+        render_executor = None
+        if render_workers > 0:
+            render_executor = ProcessPoolExecutor(max_workers=render_workers)
         service = cls(
             id,
             gcs_bucket,
@@ -108,6 +205,16 @@ class MetricsCalculationService:
             cache_manager,
             import_adapter=import_adapter,
             log_override=log_override,
+            render_executor=render_executor,
+            render_workers=render_workers,
+            result_cache=result_cache,
+            result_fs=result_fs,
+            manifest_store=manifest_store,
+            update_log=update_log,
+            status_interval=status_interval,
+            task_scheduler=JobTaskScheduler(
+                max_running_tasks, log_override=log_override
+            ),
         )
         return service
 
@@ -120,6 +227,14 @@ class MetricsCalculationService:
         cache_manager: CacheExportManager,
         import_adapter: DBImportAdapter,
         log_override: t.Optional[logging.Logger] = None,
+        render_executor: t.Optional[Executor] = None,
+        render_workers: int = 0,
+        result_cache: t.Optional[BatchResultCache] = None,
+        task_scheduler: t.Optional[JobTaskScheduler] = None,
+        result_fs: t.Optional[AbstractFileSystem] = None,
+        manifest_store: t.Optional[JobManifestStore] = None,
+        update_log: t.Optional[JobUpdateLog] = None,
+        status_interval: float = 1.0,
     ):
         self.id = id
         self.gcs_bucket = gcs_bucket
@@ -129,9 +244,21 @@ class MetricsCalculationService:
         self.import_adapter = import_adapter
         self.job_state = {}
         self.job_tasks = {}
+        self.job_manifests = {}
         self.job_state_lock = asyncio.Lock()
         self.logger = log_override or logger
         self.emitter = AsyncIOEventEmitter()
+        self.render_executor = render_executor
+        self.render_workers = max(render_workers, 1)
+        self.cache_locality = WorkerCacheLocality()
+        self.result_cache = result_cache
+        self.task_scheduler = task_scheduler or JobTaskScheduler()
+        self.result_fs = result_fs or (result_cache.fs if result_cache else None)
+        self.manifest_store = manifest_store
+        self.update_log = update_log
+        self.status_interval = status_interval
+        RUNNING_TASKS.set_function(lambda: self.task_scheduler.running)
+        self._remove_metrics_refresher = add_refresher(self.refresh_worker_metrics)
 
     async def handle_query_job_submit_request(
         self,
@@ -141,13 +268,29 @@ class MetricsCalculationService:
         calculation_export: ExportReference,
         final_export: ExportReference,
     ):
+        self.task_scheduler.add_job(
+            job_id, priority=input.priority, max_running=input.max_running_tasks
+        )
         try:
             await self._handle_query_job_submit_request(
                 job_id, result_path_base, input, calculation_export, final_export
             )
+            JOBS.labels(status=QueryJobStatus.COMPLETED.value).inc()
+        except asyncio.CancelledError:
+            self.logger.info(f"job[{job_id}] cancelled")
+            JOBS.labels(status=QueryJobStatus.CANCELLED.value).inc()
+            await self._remove_partial_results(job_id, result_path_base)
+            await self._notify_job_cancelled(job_id)
         except Exception as e:
             self.logger.error(f"job[{job_id}] failed with exception: {e}")
+            JOBS.labels(status=QueryJobStatus.FAILED.value).inc()
+            await self._remove_partial_results(job_id, result_path_base)
             await self._notify_job_failed(job_id, False, e)
+        finally:
+            self.task_scheduler.remove_job(job_id)
+            self.job_manifests.pop(job_id, None)
+            if self.update_log:
+                self.update_log.close(job_id)
 
     async def _handle_query_job_submit_request(
         self,
@@ -169,32 +312,59 @@ class MetricsCalculationService:
             raise e
         self.logger.debug(f"job[{job_id}] dependencies exported")
 
-        tasks = await self._batch_query_to_scheduler(
-            job_id, result_path_base, input, exported_dependent_tables_map
-        )
+        if self.manifest_store and self.result_fs:
+            # Batches completed by a previous submission of the same job are
+            # reused
+            self.job_manifests[job_id] = await self.manifest_store.load(
+                job_key(input, exported_dependent_tables_map)
+            )
 
-        total = len(tasks)
-        if total != input.batch_count():
-            self.logger.warning(f"job[{job_id}] batch count mismatch")
+        await self._refresh_cache_locality(job_id, input, exported_dependent_tables_map)
 
+        tasks = JobTaskGroup(
+            max_failures=input.max_task_failures,
+            cancellation_exceptions=(JobTaskCancelled,),
+        )
         exceptions = []
         cancellations = []
+        try:
+            await self._batch_query_to_scheduler(
+                job_id, result_path_base, input, exported_dependent_tables_map, tasks
+            )
 
-        for next_task in asyncio.as_completed(tasks):
-            try:
-                await next_task
-            except JobTaskCancelled as e:
-                cancellations.append(e.task_id)
-            except JobTaskFailed as e:
-                exceptions.append(e.exception)
-            except Exception as e:
-                self.logger.error(
-                    f"job[{job_id}] task failed with uncaught exception: {e}"
-                )
-                exceptions.append(e)
-                # Report failure early for any listening clients. The server
-                # will collect all errors for any internal reporting needed
-                await self._notify_job_failed(job_id, True, e)
+            total = len(tasks)
+            if (
+                not input.target_task_seconds
+                and not tasks.aborted
+                and total != input.batch_count()
+            ):
+                self.logger.warning(f"job[{job_id}] batch count mismatch")
+
+            for next_task in asyncio.as_completed(tasks.tasks):
+                try:
+                    await next_task
+                except JobTaskCancelled as e:
+                    cancellations.append(e.task_id)
+                except JobTaskFailed as e:
+                    exceptions.append(e.exception)
+                except Exception as e:
+                    self.logger.error(
+                        f"job[{job_id}] task failed with uncaught exception: {e}"
+                    )
+                    exceptions.append(e)
+                    # Report failure early for any listening clients. The server
+                    # will collect all errors for any internal reporting needed
+                    await self._notify_job_failed(job_id, True, e)
+                if tasks.aborted:
+                    self.logger.error(
+                        f"job[{job_id}] aborting after {tasks.failures} failed tasks"
+                    )
+                    break
+        finally:
+            # Outstanding tasks are cancelled if the job is cancelled or aborted
+            cancelled = await tasks.cancel()
+            if cancelled:
+                self.logger.info(f"job[{job_id}] cancelled {cancelled} tasks")
 
         # If there are any exceptions then we report those as failed and short
         # circuit this method
@@ -205,23 +375,79 @@ class MetricsCalculationService:
         self.logger.info(f"job[{job_id}]: importing final result into the database")
         await self.import_adapter.import_reference(calculation_export, final_export)
 
+        # The job doesn't need to be resumed anymore
+        manifest = self.job_manifests.get(job_id)
+        if manifest:
+            await manifest.delete()
+
         self.logger.debug(f"job[{job_id}]: notifying job completed")
         await self._notify_job_completed(job_id)
 
+    async def _refresh_cache_locality(
+        self,
+        job_id: str,
+        input: JobSubmitRequest,
+        exported_dependent_tables_map: t.Dict[str, ExportReference],
+    ):
+        """Refreshes which workers have which exports cached and starts warming
+        workers that have none of the job's dependencies cached. No more
+        workers are warmed than the job has tasks beyond the warm workers."""
+        paths = export_paths(exported_dependent_tables_map)
+        if not paths:
+            return
+        try:
+            client = await self.cluster_manager.client
+            # Workers that join the cluster while the job runs warm themselves
+            await client.set_metadata(
+                WARM_DEPENDENCIES_METADATA_KEY,
+                WorkerWarmRequest(
+                    dependencies=exported_dependent_tables_map,
+                    cache_mode=input.cache_mode,
+                ).model_dump(mode="json"),
+            )
+            inventory = await client.run(get_cache_inventory)
+            self.cache_locality.update_inventory(inventory)
+
+            cold = self.cache_locality.cold_workers(paths)
+            warm_count = len(self.cache_locality.workers) - len(cold)
+            to_warm = cold[: max(input.batch_count() - warm_count, 0)]
+            self.logger.debug(
+                f"job[{job_id}] {warm_count} warm workers. warming {len(to_warm)} workers"
+            )
+            if to_warm:
+                await client.run(
+                    warm_worker_cache,
+                    exported_dependent_tables_map,
+                    input.cache_mode,
+                    workers=to_warm,
+                    wait=False,
+                )
+        except Exception as e:
+            self.logger.warning(
+                f"job[{job_id}] unable to refresh the worker cache locality: {e}"
+            )
+
     async def _batch_query_to_scheduler(
         self,
         job_id: str,
         result_path_base: str,
         input: JobSubmitRequest,
         exported_dependent_tables_map: t.Dict[str, ExportReference],
+        tasks: JobTaskGroup,
     ):
-        """Given a query job: break down into batches and submit to the scheduler"""
+        """Given a query job: break down into batches and submit to the
+        scheduler. No more batches are submitted once the tasks are aborted."""
+        if input.target_task_seconds:
+            return await self._adaptive_batch_query_to_scheduler(
+                job_id, result_path_base, input, exported_dependent_tables_map, tasks
+            )
 
-        tasks: t.List[asyncio.Task] = []
         count = 0
-        async for batch_id, batch in self.generate_query_batches(
-            input, input.batch_size
-        ):
+        render_started = time.monotonic()
+        async for batch_id, batch, sample_dates in self.generate_task_batches(input):
+            self._observe_render(render_started, batch, sample_dates)
+            if tasks.aborted:
+                break
             if count == 0:
                 await self._notify_job_running(job_id)
 
@@ -239,13 +465,154 @@ class MetricsCalculationService:
                     input.slots,
                     exported_dependent_tables_map,
                     retries=3,
+                    cache_mode=input.cache_mode,
+                    sample_dates=sample_dates,
                 )
             )
-            tasks.append(task)
+            tasks.add(task)
 
             self.logger.debug(f"job[{job_id}]: Submitted task {task_id}")
             count += 1
-        return tasks
+            render_started = time.monotonic()
+
+    async def _adaptive_batch_query_to_scheduler(
+        self,
+        job_id: str,
+        result_path_base: str,
+        input: JobSubmitRequest,
+        exported_dependent_tables_map: t.Dict[str, ExportReference],
+        tasks: JobTaskGroup,
+    ):
+        """Submits the batches of a job as its tasks complete. Each batch is
+        sized by the planner from the durations of the completed tasks so only
+        enough tasks to keep the cluster busy are submitted at once. The job's
+        task count is updated with the planner's estimate as batches are
+        planned."""
+        runner = MetricsRunner.from_engine_adapter(
+            FakeEngineAdapter("duckdb"),
+            input.query_as("duckdb"),
+            input.ref,
+            input.locals,
+        )
+        days = list(runner.iter_query_days(input.start, input.end))
+        if not days:
+            return
+        assert input.target_task_seconds is not None
+
+        weights = await self.estimate_day_weights(input, days)
+        planner = AdaptiveBatchPlanner(
+            days, weights, input.batch_size, input.target_task_seconds
+        )
+        template = None
+        if input.batch_mode == QueryBatchMode.DATE_SPINE and input.ref.get("window"):
+            template = await asyncio.to_thread(
+                render_rolling_template, runner, [days[0], days[-1]]
+            )
+        compiled = None
+        if not template:
+            compiled = await asyncio.to_thread(
+                runner.compile_query, [days[0], days[-1]]
+            )
+
+        await self._notify_job_running(job_id)
+        pending: t.Dict[asyncio.Task, float] = {}
+        while planner.has_remaining or pending:
+            if tasks.aborted:
+                return
+            max_in_flight = await self._max_tasks_in_flight()
+            while planner.has_remaining and len(pending) < max_in_flight:
+                batch_days, weight = planner.next_batch()
+                render_started = time.monotonic()
+                sample_dates: t.Optional[t.List[datetime]] = None
+                if template:
+                    batch = [template]
+                    sample_dates = batch_days
+                elif compiled:
+                    batch = [compiled.render(day) for day in batch_days]
+                else:
+                    batch = await asyncio.to_thread(
+                        render_query_batch, input, batch_days
+                    )
+                self._observe_render(render_started, batch, sample_dates)
+
+                batch_id = len(tasks)
+                task_id = f"{job_id}-{batch_id}"
+                result_path = os.path.join(result_path_base, f"{batch_id}.parquet")
+                self.logger.debug(
+                    f"job[{job_id}]: Submitting task {task_id} with {len(batch_days)} days"
+                )
+                task = asyncio.create_task(
+                    self._submit_query_task_to_scheduler(
+                        job_id,
+                        task_id,
+                        result_path,
+                        batch,
+                        input.slots,
+                        exported_dependent_tables_map,
+                        retries=3,
+                        cache_mode=input.cache_mode,
+                        sample_dates=sample_dates,
+                    )
+                )
+                tasks.add(task)
+                pending[task] = weight
+
+            await self._set_job_tasks_count(
+                job_id, len(tasks) + planner.estimated_remaining_batches()
+            )
+            done, _ = await asyncio.wait(
+                pending.keys(), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                weight = pending.pop(task)
+                if task.cancelled() or task.exception():
+                    continue
+                result = t.cast(QueryTaskResult, task.result())
+                if result.elapsed_seconds:
+                    planner.observe(weight, result.elapsed_seconds)
+            self.logger.debug(
+                f"job[{job_id}]: target batch weight is {planner.target_weight}"
+            )
+
+    async def _max_tasks_in_flight(self) -> int:
+        """The number of adaptive tasks to keep submitted at once"""
+        status = await self.cluster_manager.get_cluster_status()
+        return max(status.workers * 2, 2)
+
+    async def estimate_day_weights(
+        self, input: JobSubmitRequest, days: t.List[datetime]
+    ) -> t.List[float]:
+        """Estimates the relative cost of each sample date from the daily row
+        counts of the job's dependencies. Every day has the same weight if the
+        row counts aren't available."""
+        uniform = [1.0] * len(days)
+        try:
+            requirements = await asyncio.to_thread(
+                self.resolve_export_requirements, input
+            )
+        except Exception as e:
+            self.logger.warning(f"unable to determine export requirements: {e}")
+            return uniform
+
+        row_counts: t.Dict[date, int] = defaultdict(int)
+        for reference_name, table_requirements in requirements.items():
+            # Tables that aren't filtered by time cost the same for every day
+            if not table_requirements.time_ranges:
+                continue
+            time_range = table_requirements.time_ranges[0]
+            counts = await self.cache_manager.daily_row_counts(
+                input.dependent_tables_map[reference_name],
+                time_range.column,
+                time_range.start,
+                time_range.end,
+            )
+            if counts is None:
+                return uniform
+            for day, count in counts.items():
+                row_counts[day] += count
+        if not row_counts:
+            return uniform
+        return day_weights(days, row_counts, window_days(input.ref))
 
     async def _submit_query_task_to_scheduler(
         self,
@@ -256,39 +623,218 @@ class MetricsCalculationService:
         slots: int,
         exported_dependent_tables_map: t.Dict[str, ExportReference],
         retries: int,
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        sample_dates: t.Optional[t.List[datetime]] = None,
     ):
-        """Submit a single query task to the scheduler"""
+        """Submit a single query task to the scheduler. The task prefers the
+        workers that have the most of its dependencies cached but may run on
+        any worker. Returns the result of the task.
+
+        If an identical batch over the same dependency exports has already
+        been computed its result is copied to the task's result path instead."""
+        result_key = None
+        manifest = self.job_manifests.get(job_id)
+        if self.result_cache or manifest:
+            result_key = batch_key(batch, sample_dates, exported_dependent_tables_map)
+            cached = await self._link_completed_result(
+                job_id, result_key, self.bucket_path(result_path)
+            )
+            if cached:
+                self.logger.info(
+                    f"job[{job_id}] task_id={task_id} reused the result at {cached.path}"
+                )
+                TASKS.labels(status="reused").inc()
+                await self._notify_job_task_completed(
+                    job_id,
+                    task_id,
+                    rows_written=cached.rows_written,
+                    bytes_written=cached.bytes_written,
+                )
+                return QueryTaskResult(
+                    task_id=task_id,
+                    rows_written=cached.rows_written,
+                    bytes_written=cached.bytes_written,
+                )
+
         client = await self.cluster_manager.client
 
-        task_future = client.submit(
-            execute_duckdb_load,
-            job_id,
-            task_id,
-            result_path,
-            batch,
-            exported_dependent_tables_map,
-            retries=retries,
-            key=task_id,
-            resources={"slots": slots},
-        )
+        paths = export_paths(exported_dependent_tables_map)
+        placement: t.Dict[str, t.Any] = {}
+        task_future = None
+        preferred_workers = self.cache_locality.preferred_workers(paths)
+        if preferred_workers:
+            placement = dict(workers=preferred_workers, allow_other_workers=True)
 
         try:
-            await task_future
+            # Tasks are only released to dask once the job is given a slot so
+            # that large jobs don't delay jobs submitted after them
+            queued_at = time.monotonic()
+            async with self.task_scheduler.slot(job_id):
+                TASK_QUEUED_SECONDS.observe(time.monotonic() - queued_at)
+                task_future = client.submit(
+                    execute_duckdb_load,
+                    job_id,
+                    task_id,
+                    result_path,
+                    batch,
+                    exported_dependent_tables_map,
+                    cache_mode,
+                    sample_dates,
+                    retries=retries,
+                    key=task_id,
+                    resources={"slots": slots},
+                    **placement,
+                )
+                result = await task_future
             self.logger.info(f"job[{job_id}] task_id={task_id} completed")
-            await self._notify_job_task_completed(job_id, task_id)
+            TASKS.labels(status="succeeded").inc()
+            if isinstance(result, QueryTaskResult):
+                self.logger.info(
+                    f"job[{job_id}] task_id={task_id} wrote {result.rows_written} rows ({result.bytes_written} bytes)"
+                )
+                RESULT_ROWS.inc(result.rows_written)
+                RESULT_BYTES.inc(result.bytes_written)
+                if result.elapsed_seconds is not None:
+                    TASK_SECONDS.observe(result.elapsed_seconds)
+                if result.worker_address:
+                    self.cache_locality.add(result.worker_address, paths)
+                if self.result_cache and result_key:
+                    await self.result_cache.add(
+                        result_key,
+                        self.bucket_path(result_path),
+                        result.rows_written,
+                        result.bytes_written,
+                    )
+                if manifest and result_key:
+                    await manifest.add(
+                        result_key,
+                        self.bucket_path(result_path),
+                        result.rows_written,
+                        result.bytes_written,
+                    )
+                await self._notify_job_task_completed(
+                    job_id,
+                    task_id,
+                    rows_written=result.rows_written,
+                    bytes_written=result.bytes_written,
+                    profile=result.profile,
+                )
+            else:
+                await self._notify_job_task_completed(job_id, task_id)
+                result = QueryTaskResult(task_id=task_id)
+        except asyncio.CancelledError:
+            # The job was cancelled or aborted. The job reports this itself
+            self.logger.debug(f"job[{job_id}] task_id={task_id} cancelled by the job")
+            TASKS.labels(status="cancelled").inc()
+            if task_future is not None:
+                await self._cancel_task_future(job_id, task_future)
+            raise
         except CancelledError as e:
             self.logger.error(f"job[{job_id}] task cancelled {e.args}")
+            TASKS.labels(status="cancelled").inc()
             await self._notify_job_task_cancelled(job_id, task_id)
             raise JobTaskCancelled(task_id)
         except Exception as e:
             self.logger.error(f"job[{job_id}] task failed with exception: {e}")
+            TASKS.labels(status="failed").inc()
             await self._notify_job_task_failed(job_id, task_id, e)
             raise JobTaskFailed(e)
-        return task_id
+        return result
+
+    def _observe_render(
+        self,
+        started: float,
+        batch: t.List[str],
+        sample_dates: t.Optional[t.List[datetime]],
+    ):
+        RENDER_SECONDS.observe(time.monotonic() - started)
+        RENDERED_SAMPLE_DATES.inc(len(sample_dates) if sample_dates else len(batch))
+
+    async def refresh_worker_metrics(self):
+        """Updates the worker metrics from the statistics of each worker"""
+        status = await self.cluster_manager.get_cluster_status()
+        WORKERS.set(status.workers)
+        if not status.is_ready:
+            return
+        client = await self.cluster_manager.client
+        worker_stats = await asyncio.wait_for(
+            client.run(get_worker_metrics), timeout=10
+        )
+        WORKER_STATS.update(worker_stats)
+
+    async def _link_completed_result(
+        self, job_id: str, key: str, destination: str
+    ) -> t.Optional[BatchResultCacheEntry]:
+        """Copies the result of an identical batch to the destination. Batches
+        completed by a previous submission of the job are checked first and
+        then the batch result cache."""
+        manifest = self.job_manifests.get(job_id)
+        if manifest and self.result_fs:
+            entry = manifest.get(key)
+            if entry:
+                try:
+                    await asyncio.to_thread(
+                        self.result_fs.copy, entry.path, destination
+                    )
+                    return entry
+                except Exception as e:
+                    self.logger.warning(
+                        f"job[{job_id}] unable to reuse completed result {entry.path}: {e}"
+                    )
+        if not self.result_cache:
+            return None
+        entry = await self.result_cache.link(key, destination)
+        if entry and manifest:
+            await manifest.add(
+                key, destination, entry.rows_written, entry.bytes_written
+            )
+        return entry
+
+    async def _cancel_task_future(self, job_id: str, task_future: t.Any):
+        try:
+            client = await self.cluster_manager.client
+            await client.cancel([task_future])
+        except Exception as e:
+            self.logger.warning(f"job[{job_id}] unable to cancel dask task: {e}")
+
+    async def _remove_partial_results(self, job_id: str, result_path_base: str):
+        """Removes the results written by the tasks of a job that failed or
+        was cancelled. Results held by the batch result cache or recorded in
+        the job's manifest are kept so that they can be reused when the job is
+        retried."""
+        if not self.result_fs:
+            return
+        fs = self.result_fs
+        path = self.bucket_path(result_path_base)
+        kept: t.List[str] = []
+        if self.result_cache:
+            kept.extend(self.result_cache.paths_under(path))
+        manifest = self.job_manifests.get(job_id)
+        if manifest:
+            kept.extend(manifest.paths())
+        keep = {fs._strip_protocol(kept_path) for kept_path in kept}
+        try:
+            files = await asyncio.to_thread(fs.find, path)
+            partial = [file for file in files if fs._strip_protocol(file) not in keep]
+            if partial:
+                await asyncio.to_thread(fs.rm, partial)
+        except Exception as e:
+            self.logger.warning(f"job[{job_id}] unable to remove partial results: {e}")
+            return
+        self.logger.info(f"job[{job_id}] removed {len(partial)} partial results")
+
+    def bucket_path(self, path: str):
+        """The path of a result file within the gcs bucket"""
+        return f"{self.gcs_bucket}/{path}"
 
     async def close(self):
+        self._remove_metrics_refresher()
         await self.cluster_manager.close()
         await self.cache_manager.stop()
+        if self.render_executor:
+            self.render_executor.shutdown(cancel_futures=True)
+        if self.update_log:
+            self.update_log.close_all()
 
     async def start_cluster(self, start_request: ClusterStartRequest) -> ClusterStatus:
         self.logger.debug("starting cluster")
@@ -351,6 +897,19 @@ class MetricsCalculationService:
             export_reference=final_expected_reference,
         )
 
+    async def cancel_job(self, job_id: str) -> JobStatusResponse:
+        """Cancels a job. This waits for the job's outstanding tasks to be
+        cancelled and its partial results to be removed."""
+        async with self.job_state_lock:
+            task = self.job_tasks.get(job_id)
+        if task is None:
+            raise ValueError(f"Job {job_id} not found")
+        if not task.done():
+            self.logger.info(f"job[{job_id}] cancelling")
+            task.cancel()
+            await asyncio.wait([task])
+        return await self.get_job_status(job_id)
+
     async def _notify_job_pending(self, job_id: str, input: JobSubmitRequest):
         await self._create_job_state(
             job_id,
@@ -368,13 +927,23 @@ class MetricsCalculationService:
             ),
         )
 
-    async def _notify_job_task_completed(self, job_id: str, task_id: str):
+    async def _notify_job_task_completed(
+        self,
+        job_id: str,
+        task_id: str,
+        rows_written: t.Optional[int] = None,
+        bytes_written: t.Optional[int] = None,
+        profile: t.Optional[QueryTaskProfile] = None,
+    ):
         await self._update_job_state(
             job_id,
             QueryJobUpdate.create_task_update(
                 payload=QueryJobTaskUpdate(
                     task_id=task_id,
                     status=QueryJobTaskStatus.SUCCEEDED,
+                    rows_written=rows_written,
+                    bytes_written=bytes_written,
+                    profile=profile,
                 ),
             ),
         )
@@ -415,6 +984,17 @@ class MetricsCalculationService:
             ),
         )
 
+    async def _notify_job_cancelled(self, job_id: str):
+        await self._update_job_state(
+            job_id,
+            QueryJobUpdate.create_job_update(
+                payload=QueryJobStateUpdate(
+                    status=QueryJobStatus.CANCELLED,
+                    has_remaining_tasks=False,
+                ),
+            ),
+        )
+
     async def _notify_job_failed(
         self,
         job_id: str,
@@ -434,26 +1014,30 @@ class MetricsCalculationService:
 
     async def _create_job_state(self, job_id: str, input: JobSubmitRequest):
         async with self.job_state_lock:
-            now = datetime.now()
-            self.job_state[job_id] = QueryJobState(
-                job_id=job_id,
-                created_at=now,
-                tasks_count=input.batch_count(),
-                updates=[
+            state = QueryJobState.start(job_id, input.batch_count())
+            self.job_state[job_id] = state
+            if self.update_log:
+                self.update_log.append(
+                    job_id,
                     QueryJobUpdate(
-                        time=now,
+                        time=state.created_at,
                         scope=QueryJobUpdateScope.JOB,
                         payload=QueryJobStateUpdate(
                             status=QueryJobStatus.PENDING,
                             has_remaining_tasks=True,
                         ),
-                    )
-                ],
-            )
-
-            state = self.job_state[job_id]
+                    ),
+                )
             self.emit_job_state(job_id, state)
 
+    async def _set_job_tasks_count(self, job_id: str, tasks_count: int):
+        """Updates the expected number of tasks of a job with adaptive
+        batches"""
+        async with self.job_state_lock:
+            state = self.job_state.get(job_id)
+            assert state is not None, f"job[{job_id}] not found"
+            state.tasks_count = tasks_count
+
     async def _update_job_state(
         self,
         job_id: str,
@@ -464,10 +1048,12 @@ class MetricsCalculationService:
             state = self.job_state.get(job_id)
             assert state is not None, f"job[{job_id}] not found"
             state.update(update)
-            self.job_state[job_id] = state
+            if self.update_log:
+                self.update_log.append(job_id, update)
             self.emit_job_state(job_id, state)
 
     def emit_job_state(self, job_id: str, state: QueryJobState):
+        # The job state is bounded in size so copying it is cheap
         copied_state = copy.deepcopy(state)
         self.logger.info("emitting job update events")
         self.emitter.emit("job_update", job_id, copied_state)
@@ -480,6 +1066,45 @@ class MetricsCalculationService:
             state = copy.deepcopy(self.job_state.get(job_id))
         return state
 
+    async def generate_task_batches(
+        self, input: JobSubmitRequest
+    ) -> t.AsyncIterator[t.Tuple[int, t.List[str], t.Optional[t.List[datetime]]]]:
+        """Generates the queries for each task of the job. In the `date_spine`
+        batch mode each task gets the rolling template and the sample dates it
+        should evaluate. Jobs that can't be templated fall back to rendering a
+        query per sample date."""
+        if input.batch_mode == QueryBatchMode.DATE_SPINE and input.ref.get("window"):
+            runner = MetricsRunner.from_engine_adapter(
+                FakeEngineAdapter("duckdb"),
+                input.query_as("duckdb"),
+                input.ref,
+                input.locals,
+            )
+            days = list(runner.iter_query_days(input.start, input.end))
+            template = None
+            if days:
+                template = await asyncio.to_thread(
+                    render_rolling_template, runner, [days[0], days[-1]]
+                )
+            if template:
+                for batch_num, start in enumerate(
+                    range(0, len(days), input.batch_size)
+                ):
+                    yield (
+                        batch_num,
+                        [template],
+                        days[start : start + input.batch_size],
+                    )
+                return
+            self.logger.warning(
+                f"unable to create a rolling template for {input.ref['name']}. falling back to per day queries"
+            )
+
+        async for batch_num, batch in self.generate_query_batches(
+            input, input.batch_size
+        ):
+            yield (batch_num, batch, None)
+
     async def generate_query_batches(self, input: JobSubmitRequest, batch_size: int):
         runner = MetricsRunner.from_engine_adapter(
             FakeEngineAdapter("duckdb"),
@@ -488,6 +1113,24 @@ class MetricsCalculationService:
             input.locals,
         )
 
+        if self.render_executor:
+            days = list(runner.iter_query_days(input.start, input.end))
+            compiled = None
+            if days:
+                compiled = await asyncio.to_thread(
+                    runner.compile_query, [days[0], days[-1]]
+                )
+            if days and not compiled:
+                # Closing the renders explicitly cancels any pending renders as
+                # soon as the caller stops consuming the batches rather than
+                # whenever the generator is garbage collected
+                async with aclosing(
+                    self._render_query_batches_in_pool(input, days, batch_size)
+                ) as batches:
+                    async for batch_num, batch in batches:
+                        yield (batch_num, batch)
+                return
+
         batch: t.List[str] = []
         batch_num = 0
 
@@ -502,6 +1145,47 @@ class MetricsCalculationService:
         if len(batch) > 0:
             yield (batch_num, batch)
 
+    async def _render_query_batches_in_pool(
+        self, input: JobSubmitRequest, days: t.List[datetime], batch_size: int
+    ):
+        """Renders each batch of queries in the render process pool. Batches
+        are yielded in order as soon as they and all of the batches before
+        them are rendered. The number of batches being rendered at once is
+        bounded so that a large job doesn't queue all of its renders up
+        front."""
+        assert self.render_executor is not None
+        loop = asyncio.get_running_loop()
+        max_pending = self.render_workers * 2
+        pending: t.Deque[asyncio.Future[t.List[str]]] = deque()
+        batch_starts = iter(range(0, len(days), batch_size))
+        batch_num = 0
+
+        def submit_next():
+            start = next(batch_starts, None)
+            if start is None:
+                return False
+            pending.append(
+                loop.run_in_executor(
+                    self.render_executor,
+                    render_query_batch,
+                    input,
+                    days[start : start + batch_size],
+                )
+            )
+            return True
+
+        try:
+            while len(pending) < max_pending and submit_next():
+                pass
+            while pending:
+                batch = await pending.popleft()
+                submit_next()
+                yield (batch_num, batch)
+                batch_num += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
     async def resolve_dependent_tables(self, input: JobSubmitRequest):
         """Resolve the dependent tables for the given input and returns the
         associate export references"""
@@ -522,9 +1206,25 @@ class MetricsCalculationService:
         # need to resolve the actual table names to the export references
         reverse_dependent_tables_map = {v: k for k, v in dependent_tables_map.items()}
 
+        # Only export the parts of the tables that the job reads
+        requirements: t.Dict[str, ExportRequirements] = {}
+        if input.prune_exports:
+            try:
+                reference_requirements = await asyncio.to_thread(
+                    self.resolve_export_requirements, input
+                )
+            except Exception as e:
+                self.logger.warning(f"unable to determine export requirements: {e}")
+                reference_requirements = {}
+            requirements = {
+                dependent_tables_map[reference_name]: table_requirements
+                for reference_name, table_requirements in reference_requirements.items()
+            }
+            self.logger.debug(f"resolved export requirements: {requirements}")
+
         # First use the cache manager to resolve the export references
         references = await self.cache_manager.resolve_export_references(
-            tables_to_export, input.execution_time
+            tables_to_export, input.execution_time, requirements=requirements
         )
         self.logger.debug(f"resolved references: {references}")
 
@@ -536,6 +1236,29 @@ class MetricsCalculationService:
 
         return exported_dependent_tables_map
 
+    def resolve_export_requirements(
+        self, input: JobSubmitRequest
+    ) -> t.Dict[str, ExportRequirements]:
+        """Determines the columns and time ranges of each dependent table that
+        the job will read. The rendered queries for the first and last day of
+        the job bound the time ranges read by all of the queries in between so
+        only those are rendered."""
+        runner = MetricsRunner.from_engine_adapter(
+            FakeEngineAdapter("duckdb"),
+            input.query_as("duckdb"),
+            input.ref,
+            input.locals,
+        )
+        days = list(runner.iter_query_days(input.start, input.end))
+        if not days:
+            return {}
+        queries = [runner.render_query(days[0], days[0])]
+        if len(days) > 1:
+            queries.append(runner.render_query(days[-1], days[-1]))
+        return export_requirements_from_queries(
+            queries, input.dependent_tables_map.keys(), dialect="duckdb"
+        )
+
     async def get_job_status(
         self, job_id: str, include_stats: bool = False
     ) -> JobStatusResponse:
@@ -544,6 +1267,53 @@ class MetricsCalculationService:
             raise ValueError(f"Job {job_id} not found")
         return state.as_response(include_stats=include_stats)
 
+    async def stream_job_status(
+        self, job_id: str, interval: t.Optional[float] = None
+    ) -> t.AsyncIterator[t.Union[JobStatusResponse, JobStatusDelta]]:
+        """Streams the status of a job until it is final. The first message is
+        the full status and the following messages are the changes since the
+        previous message. Updates are coalesced so that at most one message is
+        sent per interval but final statuses are sent immediately."""
+        if interval is None:
+            interval = self.status_interval
+        loop = asyncio.get_running_loop()
+        latest: t.Optional[JobStatusResponse] = None
+        changed = asyncio.Event()
+
+        async def listener(response: JobStatusResponse):
+            nonlocal latest
+            latest = response
+            changed.set()
+
+        stop_listening = self.listen_for_job_updates(job_id, listener)
+        try:
+            sent = await self.get_job_status(job_id)
+            yield sent
+            sent_at = loop.time()
+            while not sent.is_final:
+                await changed.wait()
+                # Wait out the rest of the interval unless the job is final
+                while latest is not None and not latest.is_final:
+                    remaining = sent_at + interval - loop.time()
+                    if remaining <= 0:
+                        break
+                    changed.clear()
+                    try:
+                        await asyncio.wait_for(changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                changed.clear()
+                # Updates emitted before the first status was read are stale
+                if latest is None or latest.updated_at < sent.updated_at:
+                    continue
+                delta = JobStatusDelta.between(sent, latest)
+                sent = latest
+                if delta.has_changes:
+                    yield delta
+                    sent_at = loop.time()
+        finally:
+            stop_listening()
+
     def listen_for_job_updates(
         self, job_id: str, handler: t.Callable[[JobStatusResponse], t.Awaitable[None]]
     ):
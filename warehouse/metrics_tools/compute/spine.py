@@ -0,0 +1,168 @@
+"""Evaluates a batch of rolling window sample dates with a single query.
+
+A rolling metrics query only depends on the sample date through the
+`start_ds`/`end_ds` variables. The query is rendered once with a sentinel date
+to produce a template. Workers then evaluate the template for every sample date
+of a batch by joining it laterally against a spine of the batch's dates, which
+lets duckdb compute all of the dates in one pass instead of one query per date.
+"""
+
+import logging
+import typing as t
+from datetime import datetime
+
+import sqlglot
+from sqlglot import exp
+
+if t.TYPE_CHECKING:
+    from metrics_tools.runner import MetricsRunner
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DAY = datetime(1111, 11, 11)
+TEMPLATE_DS = TEMPLATE_DAY.strftime("%Y-%m-%d")
+DS_FORMAT = "%Y-%m-%d"
+
+TEMPLATE_DS_LITERAL = f"'{TEMPLATE_DS}'"
+
+SPINE_ALIAS = "metrics_date_spine"
+SPINE_COLUMN = "metrics_spine_date"
+BATCH_ALIAS = "metrics_spine_batch"
+
+
+class CompiledQuery:
+    """A query rendered with the template's sample date. Queries for other
+    sample dates are produced by substituting the date into the rendered sql
+    without evaluating any macros."""
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self._parts = sql.split(TEMPLATE_DS_LITERAL)
+
+    def render(self, day: datetime) -> str:
+        return f"'{day.strftime(DS_FORMAT)}'".join(self._parts)
+
+
+def compile_query(
+    render: t.Callable[[datetime], str], check_days: t.Sequence[datetime]
+) -> t.Optional[CompiledQuery]:
+    """Renders a query once with the template's sample date. None is returned
+    if substituting any of the `check_days` into the compiled query doesn't
+    produce the same sql as rendering it for that day. This happens if a macro
+    derives something from the sample date that can't be substituted
+    afterwards. Callers should check the first and last sample dates of the
+    range they render so that date comparisons in macros are caught."""
+    if not check_days:
+        return None
+    compiled = CompiledQuery(render(TEMPLATE_DAY))
+    for check_day in check_days:
+        if compiled.render(check_day) != render(check_day):
+            logger.debug("compiled query does not match the rendered query")
+            return None
+    return compiled
+
+
+def render_rolling_template(
+    runner: "MetricsRunner",
+    check_days: t.Sequence[datetime],
+    dialect: str = "duckdb",
+) -> t.Optional[str]:
+    """Renders the runner's query as a template for the date spine. None is
+    returned if the query can't be compiled or isn't a single statement."""
+    compiled = runner.compile_query(check_days)
+    if not compiled:
+        return None
+    template = compiled.sql
+    if len(sqlglot.parse(template, dialect=dialect)) != 1:
+        logger.debug("rolling template must be a single statement")
+        return None
+
+    for check_day in check_days:
+        expected = sqlglot.parse_one(compiled.render(check_day), dialect=dialect)
+        if render_template_for_day(template, check_day, dialect) != expected.sql(
+            dialect=dialect
+        ):
+            logger.debug("rolling template does not match the rendered query")
+            return None
+    return template
+
+
+def render_template_for_day(template: str, day: datetime, dialect: str = "duckdb"):
+    """Renders the query for a single sample date from the template"""
+    return replace_template_day(sqlglot.parse_one(template, dialect=dialect), day).sql(
+        dialect=dialect
+    )
+
+
+def contains_template_ds(expression: exp.Expression) -> bool:
+    """Whether the expression depends on the sample date of the template"""
+    return any(_is_template_ds(node) for node in expression.walk())
+
+
+def replace_template_day(expression: exp.Expression, day: datetime) -> exp.Expression:
+    """Replaces the template's sample date with the given day"""
+    ds = day.strftime(DS_FORMAT)
+
+    def transform(node: exp.Expression):
+        if _is_template_ds(node):
+            return exp.Literal.string(ds)
+        return node
+
+    return expression.transform(transform)
+
+
+def replace_template_ds(
+    expression: exp.Expression, sample_date: exp.Expression
+) -> exp.Expression:
+    """Replaces the template's sample date with an expression (such as a
+    column) that evaluates to the sample date as a timestamp"""
+
+    def transform(node: exp.Expression):
+        # Parsing the sample date is replaced with the sample date expression
+        # so that range joins can be planned against it
+        if (
+            isinstance(node, exp.StrToTime)
+            and _is_template_ds(node.this)
+            and node.args.get("format") == exp.Literal.string(DS_FORMAT)
+        ):
+            return sample_date.copy()
+        if _is_template_ds(node):
+            return exp.TimeToStr(
+                this=sample_date.copy(), format=exp.Literal.string(DS_FORMAT)
+            )
+        return node
+
+    return expression.transform(transform)
+
+
+def date_spine_query(
+    template: str, days: t.List[datetime], dialect: str = "duckdb"
+) -> str:
+    """Creates a query that evaluates the template for all of the given sample
+    dates. The results are the same as the union of the template rendered for
+    each of the dates."""
+    query = replace_template_ds(
+        sqlglot.parse_one(template, dialect=dialect),
+        exp.column(SPINE_COLUMN, table=SPINE_ALIAS),
+    )
+    spine = date_spine(days)
+    return (
+        f"SELECT {BATCH_ALIAS}.* FROM {spine.sql(dialect=dialect)}, "
+        f"LATERAL ({query.sql(dialect=dialect)}) AS {BATCH_ALIAS}"
+    )
+
+
+def date_spine(days: t.List[datetime]) -> exp.Values:
+    """A VALUES expression with a timestamp column containing each day"""
+    return exp.values(
+        [
+            (exp.cast(exp.Literal.string(day.strftime(DS_FORMAT)), "TIMESTAMP"),)
+            for day in days
+        ],
+        alias=SPINE_ALIAS,
+        columns=[SPINE_COLUMN],
+    )
+
+
+def _is_template_ds(node: exp.Expression):
+    return isinstance(node, exp.Literal) and node.is_string and node.this == TEMPLATE_DS
@@ -107,6 +107,12 @@ def test_app_with_all_debugging(app_client_with_all_debugging):
         progress_handler=mock_handler,
     )
 
-    # The pending to running update, and the 3 completion updates
-    assert mock_handler.call_count == 4
+    # Progress updates are coalesced so there is at least the initial status
+    assert mock_handler.call_count >= 1
+    progress = [call.args[0].progress.completed for call in mock_handler.call_args_list]
+    assert progress == sorted(progress)
     assert reference is not None
+
+    metrics = app_client_with_all_debugging.get("/metrics")
+    assert metrics.status_code == 200
+    assert 'mcs_jobs_total{status="completed"}' in metrics.text
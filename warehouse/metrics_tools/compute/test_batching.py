@@ -0,0 +1,65 @@
+from datetime import date, datetime, timedelta
+
+from metrics_tools.compute.batching import (
+    AdaptiveBatchPlanner,
+    day_weights,
+    window_days,
+)
+from metrics_tools.definition import PeerMetricDependencyRef
+
+
+def test_day_weights_sum_the_rolling_window():
+    days = [datetime(2024, 1, 1) + timedelta(days=i) for i in range(4)]
+    row_counts = {
+        date(2023, 12, 31): 5,
+        date(2024, 1, 1): 1,
+        date(2024, 1, 2): 2,
+        date(2024, 1, 4): 10,
+    }
+    assert day_weights(days, row_counts, 2) == [6.0, 3.0, 2.0, 10.0]
+    # Empty windows still have a weight
+    assert day_weights(days, {}, 2) == [1.0, 1.0, 1.0, 1.0]
+
+
+def test_window_days():
+    ref = PeerMetricDependencyRef(
+        name="test", entity_type="artifact", window=3, unit="month"
+    )
+    assert window_days(ref) == 90
+    assert (
+        window_days(
+            PeerMetricDependencyRef(
+                name="test", entity_type="artifact", time_aggregation="daily"
+            )
+        )
+        == 1
+    )
+
+
+def test_adaptive_batch_planner():
+    days = [datetime(2024, 1, 1) + timedelta(days=i) for i in range(20)]
+    weights = [1.0] * 10 + [4.0] * 10
+    planner = AdaptiveBatchPlanner(days, weights, 4, target_task_seconds=8)
+
+    # The first batches use the weight of the initial batch size
+    assert planner.target_weight == 10.0
+    first, first_weight = planner.next_batch()
+    assert len(first) == 10
+    assert first_weight == 10.0
+
+    # Tasks that take half the target are coalesced into larger batches
+    planner.observe(first_weight, 4)
+    assert planner.target_weight == 20.0
+    second, second_weight = planner.next_batch()
+    assert len(second) == 5
+    assert second_weight == 20.0
+
+    # Slower tasks split the remaining days into smaller batches
+    planner.observe(second_weight, 24)
+    assert planner.target_weight == 10.0
+    assert planner.estimated_remaining_batches() == 2
+    remaining = []
+    while planner.has_remaining:
+        batch, _ = planner.next_batch()
+        remaining.append(len(batch))
+    assert remaining == [2, 2, 1]
@@ -1,12 +1,22 @@
 import asyncio
-from datetime import datetime
+import typing as t
+import uuid
+from datetime import datetime, timedelta
 from unittest.mock import AsyncMock
 
 import pytest
-from metrics_tools.compute.cache import CacheExportManager, FakeExportAdapter
+from metrics_tools.compute.cache import (
+    CacheExportManager,
+    FakeExportAdapter,
+    FileExportCacheIndex,
+    export_cache_key,
+    export_reference_requirements,
+)
 from metrics_tools.compute.types import (
     ColumnsDefinition,
     ExportReference,
+    ExportRequirements,
+    ExportTimeRange,
     ExportType,
     TableReference,
 )
@@ -66,3 +76,420 @@ async def test_cache_export_manager_fails():
         failed = True
     await cache.stop()
     assert failed, "Expected exception to be raised"
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_exports_concurrently():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def slow_export(table: str, execution_time: datetime, requirements=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.1)
+        in_flight -= 1
+        return ExportReference(
+            table=TableReference(table_name=table),
+            type=ExportType.GCS,
+            columns=ColumnsDefinition(columns=[]),
+            payload={},
+        )
+
+    adapter_mock = AsyncMock(FakeExportAdapter)
+    adapter_mock.export_table = AsyncMock(side_effect=slow_export)
+    cache = await CacheExportManager.setup(adapter_mock, max_concurrent_exports=2)
+    execution_time = datetime.now()
+
+    # Two concurrent requests that share a table should only export that table
+    # once
+    export_map_0, export_map_1 = await asyncio.wait_for(
+        asyncio.gather(
+            cache.resolve_export_references(
+                ["table1", "table2", "table3"], execution_time
+            ),
+            cache.resolve_export_references(["table3", "table4"], execution_time),
+        ),
+        timeout=2,
+    )
+    await cache.stop()
+
+    assert export_map_0.keys() == {"table1", "table2", "table3"}
+    assert export_map_1.keys() == {"table3", "table4"}
+    assert adapter_mock.export_table.call_count == 4
+    assert max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_reloads_from_cache_index(tmp_path):
+    adapter_mock = AsyncMock(FakeExportAdapter)
+    adapter_mock.export_table.return_value = ExportReference(
+        table=TableReference(table_name="test"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(columns=[]),
+        payload={},
+    )
+    adapter_mock.table_freshness.return_value = "snapshot1"
+    index_path = str(tmp_path / "cache" / "index.json")
+    execution_time = datetime.now()
+
+    cache = await CacheExportManager.setup(
+        adapter_mock, cache_index=FileExportCacheIndex.from_url(index_path)
+    )
+    await asyncio.wait_for(
+        cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    await cache.stop()
+    assert adapter_mock.export_table.call_count == 2
+
+    # A new manager using the same index should not export anything again
+    restarted_cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        max_export_age=timedelta(days=1),
+    )
+    export_map = await asyncio.wait_for(
+        restarted_cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    await restarted_cache.stop()
+    assert export_map.keys() == {"table1", "table2"}
+    assert adapter_mock.export_table.call_count == 2
+
+    # Entries older than the max age are ignored
+    expiring_cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        max_export_age=timedelta(seconds=0),
+    )
+    assert await expiring_cache.inspect_export_table_references() == {}
+    await expiring_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_cleans_expired_exports(tmp_path):
+    adapter_mock = stale_exports_adapter({})
+    index_path = str(tmp_path / "cache" / "index.json")
+    execution_time = datetime.now()
+
+    cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        max_export_age=timedelta(milliseconds=100),
+        stale_export_grace_period=timedelta(seconds=0),
+    )
+    export_map_0 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    await asyncio.sleep(0.2)
+
+    # An expired export is exported again and its files are cleaned
+    export_map_1 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1"], execution_time), timeout=1
+    )
+    await asyncio.sleep(0.1)
+    await cache.stop()
+    assert export_map_1["table1"] != export_map_0["table1"]
+    adapter_mock.clean_export_table.assert_awaited_once_with(export_map_0["table1"])
+
+    # The expired export of table2 that was never requested again is cleaned
+    # once the index is loaded after a restart
+    restarted_cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        max_export_age=timedelta(milliseconds=100),
+        stale_export_grace_period=timedelta(seconds=0),
+    )
+    await asyncio.sleep(0.1)
+    await restarted_cache.stop()
+    assert adapter_mock.clean_export_table.await_count == 3
+    cleaned = [call.args[0] for call in adapter_mock.clean_export_table.await_args_list]
+    assert export_map_0["table2"] in cleaned
+    assert export_map_1["table1"] in cleaned
+    assert await FileExportCacheIndex.from_url(index_path).load() == []
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_reexports_stale_tables():
+    freshness = {"table1": "snapshot1"}
+
+    async def table_freshness(table: str):
+        return freshness.get(table)
+
+    async def export_table(table: str, execution_time: datetime, requirements=None):
+        return ExportReference(
+            table=TableReference(table_name=table),
+            type=ExportType.GCS,
+            columns=ColumnsDefinition(columns=[]),
+            payload={"gcs_path": f"gs://bucket/{uuid.uuid4().hex}"},
+        )
+
+    adapter_mock = AsyncMock(FakeExportAdapter)
+    adapter_mock.table_freshness = AsyncMock(side_effect=table_freshness)
+    adapter_mock.export_table = AsyncMock(side_effect=export_table)
+    cache = await CacheExportManager.setup(
+        adapter_mock,
+        stale_export_grace_period=timedelta(seconds=0),
+        freshness_check_interval=timedelta(seconds=0),
+    )
+    execution_time = datetime.now()
+
+    export_map_0 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    assert export_map_0["table1"].source_metadata["freshness_token"] == "snapshot1"
+
+    # Unchanged tables are cache hits
+    export_map_1 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    assert export_map_1 == export_map_0
+    assert adapter_mock.export_table.call_count == 2
+
+    # A new snapshot of table1 forces a new export and cleans the old one
+    freshness["table1"] = "snapshot2"
+    export_map_2 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1", "table2"], execution_time),
+        timeout=1,
+    )
+    await asyncio.sleep(0.1)
+    await cache.stop()
+
+    assert adapter_mock.export_table.call_count == 3
+    assert export_map_2["table1"].source_metadata["freshness_token"] == "snapshot2"
+    assert export_map_2["table1"] != export_map_0["table1"]
+    assert export_map_2["table2"] == export_map_0["table2"]
+    adapter_mock.clean_export_table.assert_awaited_once_with(export_map_0["table1"])
+
+
+def stale_exports_adapter(freshness: t.Dict[str, str]):
+    async def table_freshness(table: str):
+        return freshness.get(table)
+
+    async def export_table(table: str, execution_time: datetime, requirements=None):
+        return ExportReference(
+            table=TableReference(table_name=table),
+            type=ExportType.GCS,
+            columns=ColumnsDefinition(columns=[]),
+            payload={"gcs_path": f"gs://bucket/{uuid.uuid4().hex}"},
+        )
+
+    adapter_mock = AsyncMock(FakeExportAdapter)
+    adapter_mock.table_freshness = AsyncMock(side_effect=table_freshness)
+    adapter_mock.export_table = AsyncMock(side_effect=export_table)
+    return adapter_mock
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_throttles_freshness_checks():
+    freshness = {"table1": "snapshot1"}
+    adapter_mock = stale_exports_adapter(freshness)
+    cache = await CacheExportManager.setup(
+        adapter_mock, freshness_check_interval=timedelta(hours=1)
+    )
+    execution_time = datetime.now()
+
+    export_map_0 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1"], execution_time), timeout=1
+    )
+    for _ in range(3):
+        await asyncio.wait_for(
+            cache.resolve_export_references(["table1"], execution_time), timeout=1
+        )
+    freshness_checks = adapter_mock.table_freshness.call_count
+
+    # The table changed but its freshness was checked within the interval
+    freshness["table1"] = "snapshot2"
+    export_map_1 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1"], execution_time), timeout=1
+    )
+    await cache.stop()
+
+    assert export_map_1 == export_map_0
+    assert adapter_mock.table_freshness.call_count == freshness_checks
+    assert adapter_mock.export_table.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_cleans_superseded_exports_after_restart(
+    tmp_path,
+):
+    freshness = {"table1": "snapshot1"}
+    adapter_mock = stale_exports_adapter(freshness)
+    index_path = str(tmp_path / "cache" / "index.json")
+    execution_time = datetime.now()
+
+    cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        stale_export_grace_period=timedelta(hours=1),
+        freshness_check_interval=timedelta(seconds=0),
+    )
+    export_map_0 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1"], execution_time), timeout=1
+    )
+    freshness["table1"] = "snapshot2"
+    export_map_1 = await asyncio.wait_for(
+        cache.resolve_export_references(["table1"], execution_time), timeout=1
+    )
+    # Stopping within the grace period abandons the cleanup
+    await cache.stop()
+    adapter_mock.clean_export_table.assert_not_awaited()
+
+    # The restarted manager cleans the superseded export once the grace period
+    # has passed and keeps serving the newer export
+    restarted_cache = await CacheExportManager.setup(
+        adapter_mock,
+        cache_index=FileExportCacheIndex.from_url(index_path),
+        stale_export_grace_period=timedelta(seconds=0),
+    )
+    assert await restarted_cache.inspect_export_table_references() == export_map_1
+    await asyncio.sleep(0.1)
+    adapter_mock.clean_export_table.assert_awaited_once_with(export_map_0["table1"])
+    await restarted_cache.stop()
+
+    # Once cleaned the export is no longer recorded in the index
+    final_cache = await CacheExportManager.setup(
+        adapter_mock, cache_index=FileExportCacheIndex.from_url(index_path)
+    )
+    await final_cache.stop()
+    assert final_cache.superseded_exports == []
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_caches_pruned_exports_by_requirements():
+    async def export_table(table: str, execution_time: datetime, requirements=None):
+        return ExportReference(
+            table=TableReference(table_name=table),
+            type=ExportType.GCS,
+            columns=ColumnsDefinition(columns=[]),
+            payload={"gcs_path": f"gs://bucket/{uuid.uuid4().hex}"},
+        )
+
+    adapter_mock = AsyncMock(FakeExportAdapter)
+    adapter_mock.table_freshness.return_value = None
+    adapter_mock.export_table = AsyncMock(side_effect=export_table)
+    cache = await CacheExportManager.setup(adapter_mock)
+    execution_time = datetime.now()
+
+    requirements = ExportRequirements(
+        columns=["bucket_day", "amount"],
+        time_ranges=[
+            ExportTimeRange(
+                column="bucket_day",
+                start=datetime(2024, 1, 1),
+                end=datetime(2024, 2, 1),
+            )
+        ],
+    )
+    other_requirements = ExportRequirements(columns=["bucket_day"])
+
+    pruned_0 = await asyncio.wait_for(
+        cache.resolve_export_references(
+            ["table1"], execution_time, requirements={"table1": requirements}
+        ),
+        timeout=1,
+    )
+    pruned_1 = await asyncio.wait_for(
+        cache.resolve_export_references(
+            ["table1"], execution_time, requirements={"table1": requirements}
+        ),
+        timeout=1,
+    )
+    assert pruned_0 == pruned_1
+    assert adapter_mock.export_table.call_count == 1
+    assert adapter_mock.export_table.call_args.kwargs["requirements"] == requirements
+
+    # Different requirements need a different export
+    other_pruned = await asyncio.wait_for(
+        cache.resolve_export_references(
+            ["table1"], execution_time, requirements={"table1": other_requirements}
+        ),
+        timeout=1,
+    )
+    assert other_pruned["table1"] != pruned_0["table1"]
+    assert adapter_mock.export_table.call_count == 2
+
+    # A full export satisfies any requirements
+    full = await asyncio.wait_for(
+        cache.resolve_export_references(["table2"], execution_time), timeout=1
+    )
+    pruned_full = await asyncio.wait_for(
+        cache.resolve_export_references(
+            ["table2"], execution_time, requirements={"table2": requirements}
+        ),
+        timeout=1,
+    )
+    await cache.stop()
+    assert pruned_full == full
+    assert adapter_mock.export_table.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_cache_export_manager_reuses_covering_pruned_exports():
+    adapter_mock = stale_exports_adapter({})
+    cache = await CacheExportManager.setup(
+        adapter_mock, stale_export_grace_period=timedelta(seconds=0)
+    )
+    execution_time = datetime.now()
+
+    def requirements(columns: t.List[str], start: datetime, end: datetime):
+        return ExportRequirements(
+            columns=columns,
+            time_ranges=[ExportTimeRange(column="bucket_day", start=start, end=end)],
+        )
+
+    async def resolve(table_requirements: ExportRequirements):
+        export_map = await asyncio.wait_for(
+            cache.resolve_export_references(
+                ["table1"], execution_time, requirements={"table1": table_requirements}
+            ),
+            timeout=1,
+        )
+        return export_map["table1"]
+
+    january = await resolve(
+        requirements(
+            ["bucket_day", "amount"], datetime(2024, 1, 1), datetime(2024, 2, 1)
+        )
+    )
+
+    # A narrower range of fewer columns is served by the existing export
+    january_week = await resolve(
+        requirements(["bucket_day"], datetime(2024, 1, 8), datetime(2024, 1, 15))
+    )
+    assert january_week == january
+    assert adapter_mock.export_table.call_count == 1
+
+    # A range that isn't covered needs a new export. Since it covers the
+    # previous export that one is superseded and cleaned
+    first_quarter = await resolve(
+        requirements(
+            ["bucket_day", "amount"], datetime(2024, 1, 1), datetime(2024, 4, 1)
+        )
+    )
+    await asyncio.sleep(0.1)
+    assert first_quarter != january
+    assert adapter_mock.export_table.call_count == 2
+    adapter_mock.clean_export_table.assert_awaited_once_with(january)
+    assert list((await cache.inspect_export_table_references()).values()) == [
+        first_quarter
+    ]
+
+    # Exports that don't cover each other are both kept
+    other_columns = await resolve(
+        requirements(
+            ["bucket_day", "total"], datetime(2024, 1, 1), datetime(2024, 2, 1)
+        )
+    )
+    await cache.stop()
+    assert adapter_mock.export_table.call_count == 3
+    assert adapter_mock.clean_export_table.await_count == 1
+    assert (await cache.inspect_export_table_references()).keys() == {
+        export_cache_key("table1", export_reference_requirements(first_quarter)),
+        export_cache_key("table1", export_reference_requirements(other_columns)),
+    }
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import typing as t
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import httpx
+import pytest
+from metrics_tools.compute.client import AsyncBaseWebsocketConnector, AsyncClient
+from metrics_tools.compute.types import (
+    ClusterStatus,
+    ColumnsDefinition,
+    ExportReference,
+    ExportType,
+    JobStatusDelta,
+    JobStatusResponse,
+    JobSubmitResponse,
+    QueryJobProgress,
+    QueryJobStatus,
+    TableReference,
+)
+from metrics_tools.definition import PeerMetricDependencyRef
+
+
+def job_status(job_id: str, status: QueryJobStatus, completed: int = 0):
+    return JobStatusResponse(
+        job_id=job_id,
+        created_at=datetime(2024, 1, 1),
+        updated_at=datetime(2024, 1, 1),
+        status=status,
+        progress=QueryJobProgress(completed=completed, total=2),
+    )
+
+
+class FakeService:
+    """Serves the http endpoints used by the client and streams the status
+    messages of each job from a queue"""
+
+    def __init__(self):
+        self.submitted: t.List[str] = []
+        self.cancelled: t.List[str] = []
+        self.messages: t.Dict[str, asyncio.Queue[str]] = {}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/cluster/start":
+            status = ClusterStatus(
+                status="ready", is_ready=True, dashboard_url="", workers=1
+            )
+            return httpx.Response(200, json=status.model_dump(mode="json"))
+        if request.url.path == "/job/submit":
+            job_id = json.loads(request.content)["query_str"]
+            self.submitted.append(job_id)
+            response = JobSubmitResponse(
+                job_id=job_id,
+                export_reference=ExportReference(
+                    table=TableReference(table_name=job_id),
+                    type=ExportType.GCS,
+                    columns=ColumnsDefinition(columns=[]),
+                    payload={},
+                ),
+            )
+            return httpx.Response(200, json=response.model_dump(mode="json"))
+        if request.url.path.startswith("/job/cancel/"):
+            job_id = request.url.path.rsplit("/", 1)[-1]
+            self.cancelled.append(job_id)
+            status = job_status(job_id, QueryJobStatus.CANCELLED)
+            return httpx.Response(200, json=status.model_dump(mode="json"))
+        return httpx.Response(404)
+
+    def queue(self, job_id: str):
+        return self.messages.setdefault(job_id, asyncio.Queue())
+
+    @asynccontextmanager
+    async def websocket_connect(self, *, base_url: str, path: str):
+        job_id = path.split("/")[3]
+        yield FakeWebsocketConnector(self.queue(job_id))
+
+
+class FakeWebsocketConnector(AsyncBaseWebsocketConnector):
+    def __init__(self, messages: asyncio.Queue[str]):
+        self.messages = messages
+
+    async def receive(self):
+        return await self.messages.get()
+
+
+@pytest.fixture
+def service():
+    return FakeService()
+
+
+@pytest.fixture
+def client(service: FakeService):
+    return AsyncClient(
+        httpx.AsyncClient(
+            base_url="http://mcs", transport=httpx.MockTransport(service.handle)
+        ),
+        retries=1,
+        websocket_connect_factory=service.websocket_connect,
+    )
+
+
+def calculation(job_id: str, progress: list):
+    return dict(
+        query_str=job_id,
+        start=datetime(2024, 1, 1),
+        end=datetime(2024, 1, 2),
+        dialect="duckdb",
+        batch_size=1,
+        columns=[("bucket_day", "TIMESTAMP")],
+        ref=PeerMetricDependencyRef(
+            name="", entity_type="artifact", window=30, unit="day", cron="@daily"
+        ),
+        locals={},
+        dependent_tables_map={},
+        slots=1,
+        progress_handler=lambda response: progress.append(
+            (response.job_id, response.progress.completed)
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_calculate_metrics_many_awaits_jobs_together(
+    client: AsyncClient, service: FakeService
+):
+    progress = []
+    for job_id in ["first", "second"]:
+        status = job_status(job_id, QueryJobStatus.RUNNING)
+        delta = JobStatusDelta.between(
+            status, job_status(job_id, QueryJobStatus.COMPLETED, completed=2)
+        )
+        service.queue(job_id).put_nowait(status.model_dump_json())
+        service.queue(job_id).put_nowait(delta.model_dump_json(exclude_none=True))
+
+    references = await client.calculate_metrics_many(
+        [calculation("first", progress), calculation("second", progress)]
+    )
+
+    assert [reference.table.table_name for reference in references] == [
+        "first",
+        "second",
+    ]
+    assert sorted(service.submitted) == ["first", "second"]
+    assert sorted(progress) == [("first", 0), ("second", 0)]
+    assert service.cancelled == []
+
+
+@pytest.mark.asyncio
+async def test_calculate_metrics_many_cancels_remaining_jobs_on_failure(
+    client: AsyncClient, service: FakeService
+):
+    progress = []
+    # The first job keeps running while the second job fails
+    service.queue("running").put_nowait(
+        job_status("running", QueryJobStatus.RUNNING).model_dump_json()
+    )
+    service.queue("failing").put_nowait(
+        job_status("failing", QueryJobStatus.FAILED).model_dump_json()
+    )
+
+    with pytest.raises(Exception, match="failed with status") as exc_info:
+        await client.calculate_metrics_many(
+            [calculation("running", progress), calculation("failing", progress)]
+        )
+
+    # The job's own error is raised rather than the task group's
+    assert not isinstance(exc_info.value, ExceptionGroup)
+    assert isinstance(exc_info.value.__cause__, ExceptionGroup)
+    assert service.cancelled == ["running"]
@@ -0,0 +1,74 @@
+import pytest
+from metrics_tools.compute.instrumentation import (
+    WorkerStatsCollector,
+    add_refresher,
+    refresh_metrics,
+    render_metrics,
+)
+from prometheus_client import CollectorRegistry, Gauge
+
+
+def test_worker_stats_collector_exposes_the_last_reported_stats():
+    registry = CollectorRegistry()
+    collector = WorkerStatsCollector()
+    registry.register(collector)
+
+    collector.update(
+        {
+            "tcp://worker-1": {"hits": 3, "misses": 1, "size_bytes": 100},
+            "tcp://worker-2": {"hits": 0, "misses": 2, "size_bytes": 50},
+        }
+    )
+    assert (
+        registry.get_sample_value(
+            "mcs_worker_cache_hits_total", {"worker": "tcp://worker-1"}
+        )
+        == 3
+    )
+    assert (
+        registry.get_sample_value(
+            "mcs_worker_cache_misses_total", {"worker": "tcp://worker-2"}
+        )
+        == 2
+    )
+    rendered = render_metrics(registry).decode()
+    assert "# TYPE mcs_worker_cache_hits_total counter" in rendered
+    assert "# TYPE mcs_worker_cache_size_bytes gauge" in rendered
+
+    # Workers that have left the cluster are no longer exposed
+    collector.update({"tcp://worker-2": {"hits": 1, "misses": 2, "size_bytes": 50}})
+    assert (
+        registry.get_sample_value(
+            "mcs_worker_cache_size_bytes", {"worker": "tcp://worker-1"}
+        )
+        is None
+    )
+    assert (
+        registry.get_sample_value(
+            "mcs_worker_cache_hits_total", {"worker": "tcp://worker-2"}
+        )
+        == 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_refreshers_run_before_rendering():
+    registry = CollectorRegistry()
+    workers = Gauge("workers", "Workers in the cluster", registry=registry)
+
+    async def refresh_workers():
+        workers.set(4)
+
+    async def broken_refresher():
+        raise Exception("unavailable")
+
+    remove = add_refresher(refresh_workers)
+    remove_broken = add_refresher(broken_refresher)
+    await refresh_metrics()
+    assert registry.get_sample_value("workers") == 4
+
+    remove()
+    remove_broken()
+    workers.set(0)
+    await refresh_metrics()
+    assert registry.get_sample_value("workers") == 0
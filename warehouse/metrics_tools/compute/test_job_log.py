@@ -0,0 +1,28 @@
+from metrics_tools.compute.job_log import JobUpdateLog
+from metrics_tools.compute.types import (
+    QueryJobStateUpdate,
+    QueryJobStatus,
+    QueryJobTaskStatus,
+    QueryJobTaskUpdate,
+    QueryJobUpdate,
+)
+
+
+def test_job_update_log(tmp_path):
+    log = JobUpdateLog(str(tmp_path / "updates"))
+    updates = [
+        QueryJobUpdate.create_job_update(
+            QueryJobStateUpdate(status=QueryJobStatus.RUNNING, has_remaining_tasks=True)
+        ),
+        QueryJobUpdate.create_task_update(
+            QueryJobTaskUpdate(status=QueryJobTaskStatus.SUCCEEDED, task_id="task_0")
+        ),
+    ]
+    for update in updates:
+        log.append("job", update)
+
+    # The log can be read while the job is still running
+    assert list(log.read("job")) == updates
+    log.close_all()
+    assert list(log.read("job")) == updates
+    assert list(log.read("other_job")) == []
@@ -0,0 +1,49 @@
+from metrics_tools.compute.locality import WorkerCacheLocality, export_paths
+from metrics_tools.compute.types import (
+    ColumnsDefinition,
+    ExportReference,
+    ExportType,
+    TableReference,
+)
+
+
+def export_reference(path: str, type: ExportType = ExportType.GCS):
+    return ExportReference(
+        table=TableReference(table_name="events"),
+        type=type,
+        columns=ColumnsDefinition(columns=[]),
+        payload={"gcs_path": path},
+    )
+
+
+def test_export_paths_only_includes_gcs_exports():
+    assert export_paths(
+        {
+            "metrics.a": export_reference("gs://bucket/a"),
+            "metrics.b": export_reference("gs://bucket/b"),
+            "metrics.c": export_reference("/tmp/c", ExportType.LOCALFS),
+        }
+    ) == {"gs://bucket/a", "gs://bucket/b"}
+
+
+def test_worker_cache_locality():
+    locality = WorkerCacheLocality()
+    locality.update_inventory(
+        {
+            "tcp://w1": ["gs://bucket/a"],
+            "tcp://w2": ["gs://bucket/a", "gs://bucket/b"],
+            "tcp://w3": [],
+        }
+    )
+    paths = {"gs://bucket/a", "gs://bucket/b"}
+    assert locality.preferred_workers(paths) == ["tcp://w2"]
+    assert locality.cold_workers(paths) == ["tcp://w3"]
+    assert locality.preferred_workers({"gs://bucket/c"}) == []
+
+    locality.add("tcp://w1", ["gs://bucket/b"])
+    assert sorted(locality.preferred_workers(paths)) == ["tcp://w1", "tcp://w2"]
+
+    # Workers that are no longer reported have left the cluster
+    locality.update_inventory({"tcp://w3": ["gs://bucket/a"]})
+    assert locality.preferred_workers(paths) == ["tcp://w3"]
+    assert locality.cold_workers(paths) == []
@@ -0,0 +1,100 @@
+import typing as t
+from datetime import datetime
+
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+from metrics_tools.compute.manifest import JobManifestStore, job_key
+from metrics_tools.compute.types import (
+    ColumnsDefinition,
+    ExportReference,
+    ExportType,
+    JobSubmitRequest,
+    TableReference,
+)
+from metrics_tools.definition import PeerMetricDependencyRef
+
+
+def export_reference(path: str, freshness_token: t.Optional[str] = None):
+    return ExportReference(
+        table=TableReference(table_name="events"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(columns=[]),
+        payload={"gcs_path": path},
+        source_metadata=(
+            {"freshness_token": freshness_token} if freshness_token else {}
+        ),
+    )
+
+
+def job_request(end: datetime, execution_time: datetime):
+    return JobSubmitRequest(
+        query_str="SELECT * FROM ref.events",
+        start=datetime(2024, 1, 1),
+        end=end,
+        dialect="duckdb",
+        batch_size=2,
+        columns=[("col1", "int")],
+        ref=PeerMetricDependencyRef(
+            name="test", entity_type="artifact", window=7, unit="day"
+        ),
+        execution_time=execution_time,
+        locals={},
+        dependent_tables_map={"metrics.events": "metrics.events"},
+    )
+
+
+@pytest.fixture
+def fs():
+    fs = MemoryFileSystem()
+    yield fs
+    if fs.exists("/manifest_test"):
+        fs.rm("/manifest_test", recursive=True)
+
+
+def test_job_key_ignores_execution_time():
+    deps = {"metrics.events": export_reference("gs://bucket/a")}
+    key = job_key(job_request(datetime(2024, 2, 1), datetime(2024, 3, 1)), deps)
+    assert key == job_key(
+        job_request(datetime(2024, 2, 1), datetime(2024, 3, 2)), dict(deps)
+    )
+    assert key != job_key(job_request(datetime(2024, 2, 2), datetime(2024, 3, 1)), deps)
+    assert key != job_key(
+        job_request(datetime(2024, 2, 1), datetime(2024, 3, 1)),
+        {"metrics.events": export_reference("gs://bucket/b")},
+    )
+
+
+def test_job_key_ignores_the_export_location_of_fresh_data():
+    request = job_request(datetime(2024, 2, 1), datetime(2024, 3, 1))
+    key = job_key(
+        request, {"metrics.events": export_reference("gs://bucket/a", "snapshot1")}
+    )
+    # The same data exported again to a different location
+    assert key == job_key(
+        request, {"metrics.events": export_reference("gs://bucket/b", "snapshot1")}
+    )
+    assert key != job_key(
+        request, {"metrics.events": export_reference("gs://bucket/a", "snapshot2")}
+    )
+
+
+@pytest.mark.asyncio
+async def test_manifest_store_records_completed_batches(fs: MemoryFileSystem):
+    store = JobManifestStore(fs, "/manifest_test")
+    manifest = await store.load("job")
+    assert len(manifest) == 0
+
+    await manifest.add("a", "/results/a.parquet", 10, 100)
+    await manifest.add("b", "/results/b.parquet", 20, 200)
+
+    loaded = await store.load("job")
+    assert len(loaded) == 2
+    entry = loaded.get("b")
+    assert entry is not None
+    assert entry.rows_written == 20
+    assert loaded.paths() == {"/results/a.parquet", "/results/b.parquet"}
+    assert len(await store.load("other_job")) == 0
+
+    await loaded.delete()
+    assert len(loaded) == 0
+    assert len(await store.load("job")) == 0
@@ -0,0 +1,91 @@
+from datetime import datetime
+
+from metrics_tools.compute.requirements import export_requirements_from_queries
+
+
+def test_export_requirements_from_queries():
+    queries = [
+        f"""
+        SELECT events.to_artifact_id, COUNT(DISTINCT events.bucket_day) AS amount
+        FROM metrics.events_daily_to_artifact AS events
+        WHERE event_type IN ('COMMIT_CODE')
+            AND events.bucket_day BETWEEN
+                CAST(STRPTIME('{day}', '%Y-%m-%d') AS TIMESTAMP) - INTERVAL '29' DAY
+                AND STRPTIME('{day}', '%Y-%m-%d')
+        GROUP BY 1
+        """
+        for day in ["2024-01-31", "2024-03-31"]
+    ]
+
+    requirements = export_requirements_from_queries(
+        queries, ["metrics.events_daily_to_artifact", "metrics.unused"]
+    )
+
+    assert requirements.keys() == {"metrics.events_daily_to_artifact"}
+    table_requirements = requirements["metrics.events_daily_to_artifact"]
+    assert table_requirements.columns == ["bucket_day", "event_type", "to_artifact_id"]
+    assert len(table_requirements.time_ranges) == 1
+    time_range = table_requirements.time_ranges[0]
+    assert time_range.column == "bucket_day"
+    assert time_range.start == datetime(2024, 1, 2)
+    assert time_range.end == datetime(2024, 3, 31)
+
+
+def test_export_requirements_from_queries_is_conservative():
+    requirements = export_requirements_from_queries(
+        [
+            """
+            SELECT * FROM metrics.events AS events
+            WHERE events.bucket_day > '2024-01-01' OR events.amount > 1
+            """
+        ],
+        ["metrics.events"],
+    )
+
+    table_requirements = requirements["metrics.events"]
+    assert table_requirements.columns is None
+    assert table_requirements.time_ranges == []
+    assert not table_requirements.is_pruned()
+
+
+def test_export_requirements_ignores_unbounded_selects():
+    requirements = export_requirements_from_queries(
+        [
+            """
+            WITH recent AS (
+                SELECT id FROM metrics.events WHERE bucket_day >= '2024-01-01'
+            )
+            SELECT e.id, e.amount FROM metrics.events AS e
+            JOIN recent ON recent.id = e.id
+            """
+        ],
+        ["metrics.events"],
+    )
+
+    table_requirements = requirements["metrics.events"]
+    assert table_requirements.columns == ["amount", "bucket_day", "id"]
+    assert table_requirements.time_ranges == []
+
+
+def test_export_requirements_include_join_using_columns():
+    requirements = export_requirements_from_queries(
+        [
+            """
+            SELECT events.amount, other.total
+            FROM metrics.events AS events
+            JOIN metrics.other AS other USING (to_artifact_id, bucket_day)
+            """
+        ],
+        ["metrics.events", "metrics.other"],
+    )
+
+    assert requirements["metrics.events"].columns == [
+        "amount",
+        "bucket_day",
+        "to_artifact_id",
+    ]
+    assert requirements["metrics.other"].columns == [
+        "bucket_day",
+        "to_artifact_id",
+        "total",
+    ]
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+from metrics_tools.compute.result_cache import (
+    BatchResultCache,
+    FileBatchResultCacheIndex,
+    batch_key,
+)
+from metrics_tools.compute.types import (
+    ColumnsDefinition,
+    ExportReference,
+    ExportType,
+    TableReference,
+)
+
+
+def export_reference(path: str):
+    return ExportReference(
+        table=TableReference(table_name="events"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(columns=[]),
+        payload={"gcs_path": path},
+    )
+
+
+@pytest.fixture
+def fs():
+    fs = MemoryFileSystem()
+    yield fs
+    if fs.exists("/result_cache_test"):
+        fs.rm("/result_cache_test", recursive=True)
+
+
+def test_batch_key_depends_on_queries_dates_and_exports():
+    deps = {"metrics.events": export_reference("gs://bucket/a")}
+    key = batch_key(["SELECT 1"], None, deps)
+    assert key == batch_key(["SELECT 1"], None, dict(deps))
+    assert key != batch_key(["SELECT 2"], None, deps)
+    assert key != batch_key(["SELECT 1"], [datetime(2024, 1, 1)], deps)
+    assert key != batch_key(
+        ["SELECT 1"], None, {"metrics.events": export_reference("gs://bucket/b")}
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_result_cache_links_results(fs: MemoryFileSystem):
+    fs.pipe("/result_cache_test/job1/0.parquet", b"result")
+    cache = BatchResultCache(fs, max_age=timedelta(hours=1))
+    await cache.add("key", "/result_cache_test/job1/0.parquet", 10, 6)
+
+    entry = await cache.link("key", "/result_cache_test/job2/0.parquet")
+    assert entry is not None
+    assert entry.rows_written == 10
+    assert fs.cat("/result_cache_test/job2/0.parquet") == b"result"
+    assert await cache.link("missing", "/result_cache_test/job2/1.parquet") is None
+
+    # A result that no longer exists is forgotten
+    fs.rm("/result_cache_test/job1/0.parquet")
+    assert await cache.link("key", "/result_cache_test/job3/0.parquet") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_result_cache_expires_and_evicts(fs: MemoryFileSystem):
+    cache = BatchResultCache(fs, max_age=timedelta(hours=1), budget_bytes=100)
+    await cache.add("first", "/result_cache_test/first.parquet", 1, 60)
+    await cache.add("second", "/result_cache_test/second.parquet", 1, 30)
+    assert cache.get("first") is not None
+
+    # The second entry was used least recently
+    await cache.add("third", "/result_cache_test/third.parquet", 1, 30)
+    assert cache.get("second") is None
+    assert cache.size_bytes == 90
+
+    expired = cache.get("first")
+    assert expired is not None
+    expired.created_at = datetime.now() - timedelta(hours=2)
+    assert cache.get("first") is None
+
+
+@pytest.mark.asyncio
+async def test_batch_result_cache_persists_its_index(fs: MemoryFileSystem):
+    index_path = "/result_cache_test/index.json"
+    fs.pipe("/result_cache_test/job1/0.parquet", b"result")
+    cache = BatchResultCache(
+        fs,
+        max_age=timedelta(hours=1),
+        index=FileBatchResultCacheIndex(fs, index_path),
+    )
+    await cache.add("key", "/result_cache_test/job1/0.parquet", 10, 6)
+    await cache.add("old", "/result_cache_test/job1/1.parquet", 10, 6)
+    expired = cache.get("old")
+    assert expired is not None
+    expired.created_at = datetime.now() - timedelta(hours=2)
+    await cache.save_index()
+
+    # A restarted cache reuses the results that haven't expired
+    restarted = BatchResultCache(
+        fs,
+        max_age=timedelta(hours=1),
+        index=FileBatchResultCacheIndex(fs, index_path),
+    )
+    await restarted.load_index()
+    assert len(restarted) == 1
+    entry = await restarted.link("key", "/result_cache_test/job2/0.parquet")
+    assert entry is not None
+    assert fs.cat("/result_cache_test/job2/0.parquet") == b"result"
@@ -0,0 +1,120 @@
+import asyncio
+import typing as t
+
+import pytest
+from metrics_tools.compute.scheduler import JobTaskGroup, JobTaskScheduler
+
+
+async def start_tasks(
+    scheduler: JobTaskScheduler, job_id: str, count: int, started: t.List[str]
+):
+    release = asyncio.Event()
+
+    async def run_task():
+        async with scheduler.slot(job_id):
+            started.append(job_id)
+            await release.wait()
+
+    tasks = [asyncio.create_task(run_task()) for _ in range(count)]
+    await asyncio.sleep(0)
+    return release, tasks
+
+
+@pytest.mark.asyncio
+async def test_scheduler_prefers_higher_priority_jobs():
+    scheduler = JobTaskScheduler(max_running_tasks=2)
+    scheduler.add_job("backfill")
+    scheduler.add_job("daily", priority=10)
+    started: t.List[str] = []
+
+    release_backfill, backfill = await start_tasks(scheduler, "backfill", 4, started)
+    assert started == ["backfill", "backfill"]
+
+    release_daily, daily = await start_tasks(scheduler, "daily", 2, started)
+    assert scheduler.running == 2
+
+    # Slots freed by the backfill go to the higher priority job
+    release_backfill.set()
+    await asyncio.sleep(0.01)
+    assert started[2:4] == ["daily", "daily"]
+    assert scheduler.running_for("daily") == 2
+
+    release_daily.set()
+    await asyncio.gather(*backfill, *daily)
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_shares_slots_and_caps_jobs():
+    scheduler = JobTaskScheduler(max_running_tasks=4)
+    scheduler.add_job("first")
+    scheduler.add_job("second")
+    scheduler.add_job("capped", max_running=1)
+    started: t.List[str] = []
+
+    release_first, first = await start_tasks(scheduler, "first", 4, started)
+    release_second, second = await start_tasks(scheduler, "second", 4, started)
+    release_capped, capped = await start_tasks(scheduler, "capped", 4, started)
+    assert scheduler.running_for("first") == 4
+
+    release_first.set()
+    await asyncio.gather(*first)
+
+    # The freed slots are split between the jobs that are waiting
+    assert scheduler.running_for("capped") == 1
+    assert scheduler.running_for("second") == 3
+
+    # Removing a job cancels its waiting tasks and frees its slots
+    scheduler.remove_job("capped")
+    await asyncio.sleep(0)
+    assert scheduler.running_for("second") == 4
+    assert sum(task.cancelled() for task in capped) == 3
+
+    release_second.set()
+    release_capped.set()
+    await asyncio.gather(*second)
+    await asyncio.gather(*capped, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_task_group_aborts_after_max_failures():
+    group = JobTaskGroup(max_failures=1)
+    release = asyncio.Event()
+
+    async def fail():
+        raise Exception("failed")
+
+    async def wait():
+        await release.wait()
+
+    group.add(asyncio.create_task(fail()))
+    group.add(asyncio.create_task(wait()))
+    await asyncio.sleep(0.01)
+    assert not group.aborted
+
+    group.add(asyncio.create_task(fail()))
+    await asyncio.sleep(0.01)
+    assert group.aborted
+
+    # Cancelled tasks aren't counted as failures
+    assert await group.cancel() == 1
+    assert group.failures == 2
+    assert len(group) == 3
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_task_group_ignores_cancellation_exceptions():
+    group = JobTaskGroup(max_failures=0, cancellation_exceptions=(TaskCancelled,))
+
+    async def cancelled():
+        raise TaskCancelled()
+
+    group.add(asyncio.create_task(cancelled()))
+    group.add(asyncio.create_task(cancelled()))
+    await asyncio.sleep(0.01)
+    assert group.failures == 0
+    assert not group.aborted
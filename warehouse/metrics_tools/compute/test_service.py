@@ -1,19 +1,25 @@
 import asyncio
 import typing as t
-from datetime import datetime
+from contextlib import aclosing
+from datetime import datetime, timedelta
 
 import pytest
+from fsspec.implementations.memory import MemoryFileSystem
 from metrics_tools.compute.cache import CacheExportManager, FakeExportAdapter
 from metrics_tools.compute.cluster import ClusterManager, LocalClusterFactory
+from metrics_tools.compute.manifest import JobManifestStore, job_key
 from metrics_tools.compute.result import DummyImportAdapter
+from metrics_tools.compute.result_cache import BatchResultCache, batch_key
 from metrics_tools.compute.service import MetricsCalculationService
 from metrics_tools.compute.types import (
     ClusterStartRequest,
     ColumnsDefinition,
     ExportReference,
     ExportType,
+    JobStatusDelta,
     JobStatusResponse,
     JobSubmitRequest,
+    QueryBatchMode,
     QueryJobStatus,
     TableReference,
 )
@@ -154,3 +160,457 @@ async def test_metrics_calculation_service_using_monthly_cron():
     assert status.status == QueryJobStatus.COMPLETED
 
     await service.close()
+
+
+@pytest.mark.asyncio
+async def test_generate_task_batches_with_date_spine():
+    service = MetricsCalculationService.setup(
+        "someid",
+        "bucket",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+    )
+    request = JobSubmitRequest(
+        query_str="""
+            SELECT @metrics_sample_date() AS metrics_sample_date, COUNT(*) AS amount
+            FROM ref.table123
+            WHERE time BETWEEN @metrics_start('DATE') AND @metrics_end('DATE')
+        """,
+        start=datetime(2021, 1, 1),
+        end=datetime(2021, 1, 10),
+        dialect="duckdb",
+        batch_size=4,
+        columns=[("metrics_sample_date", "date"), ("amount", "int")],
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=30,
+            unit="day",
+            cron="@daily",
+        ),
+        execution_time=datetime.now(),
+        locals={},
+        dependent_tables_map={"source.table123": "source.table123"},
+        batch_mode=QueryBatchMode.DATE_SPINE,
+    )
+
+    batches = [batch async for batch in service.generate_task_batches(request)]
+    assert [len(sample_dates or []) for _, _, sample_dates in batches] == [4, 4, 2]
+    assert all(len(queries) == 1 for _, queries, _ in batches)
+    assert len(batches) == request.batch_count()
+
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_generate_query_batches_with_render_workers():
+    services = [
+        MetricsCalculationService.setup(
+            "someid",
+            "bucket",
+            "result_path_prefix",
+            ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+            await CacheExportManager.setup(FakeExportAdapter()),
+            DummyImportAdapter(),
+            render_workers=render_workers,
+        )
+        for render_workers in [0, 2]
+    ]
+    # The date comparison prevents the query from being compiled once so each
+    # query must be rendered separately
+    request = JobSubmitRequest(
+        query_str="""
+            SELECT @IF(@end_ds > '2021-01-05', 'recent', 'old') AS age,
+              @metrics_sample_date() AS metrics_sample_date
+            FROM ref.table123
+        """,
+        start=datetime(2021, 1, 1),
+        end=datetime(2021, 1, 10),
+        dialect="duckdb",
+        batch_size=3,
+        columns=[("age", "string"), ("metrics_sample_date", "date")],
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=30,
+            unit="day",
+            cron="@daily",
+        ),
+        execution_time=datetime.now(),
+        locals={},
+        dependent_tables_map={"source.table123": "source.table123"},
+    )
+
+    expected, result = [
+        [batch async for batch in service.generate_query_batches(request, 3)]
+        for service in services
+    ]
+    assert [batch_num for batch_num, _ in result] == [0, 1, 2, 3]
+    assert result == expected
+
+    # Pending renders are cancelled as soon as the batches stop being consumed
+    service = services[1]
+    render_batches = service._render_query_batches_in_pool
+    closed = []
+
+    async def tracked_render_batches(*args):
+        try:
+            async for batch in render_batches(*args):
+                yield batch
+        finally:
+            closed.append(True)
+
+    service._render_query_batches_in_pool = tracked_render_batches
+    async with aclosing(service.generate_query_batches(request, 3)) as batches:
+        async for _ in batches:
+            break
+    assert closed == [True]
+
+    for service in services:
+        await service.close()
+
+
+@pytest.mark.asyncio
+async def test_metrics_calculation_service_with_adaptive_batches():
+    service = MetricsCalculationService.setup(
+        "someid",
+        "bucket",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+    )
+    await service.start_cluster(ClusterStartRequest(min_size=1, max_size=1))
+    await service.add_existing_exported_table_references(
+        {
+            "source.table123": ExportReference(
+                table=TableReference(table_name="export_table123"),
+                type=ExportType.GCS,
+                columns=ColumnsDefinition(
+                    columns=[("col1", "INT"), ("col2", "TEXT")], dialect="duckdb"
+                ),
+                payload={"gcs_path": "gs://bucket/result_path_prefix/export_table123"},
+            ),
+        }
+    )
+    # The dummy tasks take a second regardless of their size so the batches
+    # grow once the first tasks complete
+    response = await service.submit_job(
+        JobSubmitRequest(
+            query_str="SELECT * FROM ref.table123",
+            start=datetime(2021, 1, 1),
+            end=datetime(2021, 1, 20),
+            dialect="duckdb",
+            batch_size=1,
+            columns=[("col1", "int"), ("col2", "string")],
+            ref=PeerMetricDependencyRef(
+                name="test",
+                entity_type="artifact",
+                window=30,
+                unit="day",
+                cron="@daily",
+            ),
+            execution_time=datetime.now(),
+            locals={},
+            dependent_tables_map={"source.table123": "source.table123"},
+            target_task_seconds=4,
+        )
+    )
+
+    completed: asyncio.Future[JobStatusResponse] = asyncio.Future()
+
+    async def collect_updates(update: JobStatusResponse):
+        if update.status not in [QueryJobStatus.PENDING, QueryJobStatus.RUNNING]:
+            completed.set_result(update)
+
+    close = service.listen_for_job_updates(response.job_id, collect_updates)
+    await completed
+    close()
+
+    status = await service.get_job_status(response.job_id)
+    assert status.status == QueryJobStatus.COMPLETED
+    assert status.progress.completed == status.progress.total
+    assert status.progress.total < 20
+
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_metrics_calculation_service_reuses_cached_batch_results():
+    fs = MemoryFileSystem()
+    result_cache = BatchResultCache(fs, max_age=timedelta(hours=1))
+    service = MetricsCalculationService.setup(
+        "someid",
+        "service_result_cache_test",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+        result_cache=result_cache,
+    )
+    await service.start_cluster(ClusterStartRequest(min_size=1, max_size=1))
+    export = ExportReference(
+        table=TableReference(table_name="export_table123"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(
+            columns=[("col1", "INT"), ("col2", "TEXT")], dialect="duckdb"
+        ),
+        payload={"gcs_path": "gs://bucket/result_path_prefix/export_table123"},
+    )
+    await service.add_existing_exported_table_references({"source.table123": export})
+    request = JobSubmitRequest(
+        query_str="SELECT * FROM ref.table123",
+        start=datetime(2021, 1, 1),
+        end=datetime(2021, 1, 3),
+        dialect="duckdb",
+        batch_size=1,
+        columns=[("col1", "int"), ("col2", "string")],
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=30,
+            unit="day",
+            cron="@daily",
+        ),
+        execution_time=datetime.now(),
+        locals={},
+        dependent_tables_map={"source.table123": "source.table123"},
+    )
+
+    # Results of a previous job for the same batches
+    async for batch_num, batch in service.generate_query_batches(request, 1):
+        path = f"/service_result_cache_test/previous/{batch_num}.parquet"
+        fs.pipe(path, b"result")
+        await result_cache.add(
+            batch_key(batch, None, {"source.table123": export}), path, 10, 6
+        )
+
+    response = await service.submit_job(request)
+    completed: asyncio.Future[JobStatusResponse] = asyncio.Future()
+
+    async def collect_updates(update: JobStatusResponse):
+        if update.status not in [QueryJobStatus.PENDING, QueryJobStatus.RUNNING]:
+            completed.set_result(update)
+
+    close = service.listen_for_job_updates(response.job_id, collect_updates)
+    status = await completed
+    close()
+
+    assert status.status == QueryJobStatus.COMPLETED
+    linked = fs.glob(f"/service_result_cache_test/**/{response.job_id}/*.parquet")
+    assert len(linked) == 3
+
+    fs.rm("/service_result_cache_test", recursive=True)
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_metrics_calculation_service_cancels_jobs():
+    fs = MemoryFileSystem()
+    service = MetricsCalculationService.setup(
+        "someid",
+        "service_cancel_test",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+        result_fs=fs,
+    )
+    await service.start_cluster(ClusterStartRequest(min_size=1, max_size=1))
+    await service.add_existing_exported_table_references(
+        {
+            "source.table123": ExportReference(
+                table=TableReference(table_name="export_table123"),
+                type=ExportType.GCS,
+                columns=ColumnsDefinition(
+                    columns=[("col1", "INT"), ("col2", "TEXT")], dialect="duckdb"
+                ),
+                payload={"gcs_path": "gs://bucket/result_path_prefix/export_table123"},
+            ),
+        }
+    )
+    execution_time = datetime.now()
+    response = await service.submit_job(
+        JobSubmitRequest(
+            query_str="SELECT * FROM ref.table123",
+            start=datetime(2021, 1, 1),
+            end=datetime(2021, 1, 10),
+            dialect="duckdb",
+            batch_size=1,
+            columns=[("col1", "int"), ("col2", "string")],
+            ref=PeerMetricDependencyRef(
+                name="test",
+                entity_type="artifact",
+                window=30,
+                unit="day",
+                cron="@daily",
+            ),
+            execution_time=execution_time,
+            locals={},
+            dependent_tables_map={"source.table123": "source.table123"},
+            max_running_tasks=1,
+        )
+    )
+
+    first_task: asyncio.Future[None] = asyncio.Future()
+
+    async def wait_for_first_task(update: JobStatusResponse):
+        if update.progress.completed > 0 and not first_task.done():
+            first_task.set_result(None)
+
+    close = service.listen_for_job_updates(response.job_id, wait_for_first_task)
+    await first_task
+    close()
+
+    # A partial result of a task that was running
+    partial = (
+        f"/service_cancel_test/result_path_prefix/"
+        f"{execution_time.strftime('%Y/%m/%d/%H')}/{response.job_id}/5.parquet"
+    )
+    fs.pipe(partial, b"partial")
+
+    status = await service.cancel_job(response.job_id)
+    assert status.status == QueryJobStatus.CANCELLED
+    assert status.progress.completed < 10
+    assert not fs.exists(partial)
+
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_metrics_calculation_service_resumes_completed_batches():
+    fs = MemoryFileSystem()
+    manifest_store = JobManifestStore(fs, "/service_manifest_test/manifests")
+    service = MetricsCalculationService.setup(
+        "someid",
+        "service_manifest_test",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+        result_fs=fs,
+        manifest_store=manifest_store,
+    )
+    await service.start_cluster(ClusterStartRequest(min_size=1, max_size=1))
+    export = ExportReference(
+        table=TableReference(table_name="export_table123"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(
+            columns=[("col1", "INT"), ("col2", "TEXT")], dialect="duckdb"
+        ),
+        payload={"gcs_path": "gs://bucket/result_path_prefix/export_table123"},
+    )
+    await service.add_existing_exported_table_references({"source.table123": export})
+    request = JobSubmitRequest(
+        query_str=(
+            "SELECT @metrics_end('DATE') AS metrics_sample_date, * FROM ref.table123"
+        ),
+        start=datetime(2021, 1, 1),
+        end=datetime(2021, 1, 3),
+        dialect="duckdb",
+        batch_size=1,
+        columns=[("col1", "int"), ("col2", "string")],
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=30,
+            unit="day",
+            cron="@daily",
+        ),
+        execution_time=datetime.now(),
+        locals={},
+        dependent_tables_map={"source.table123": "source.table123"},
+    )
+
+    # Two of the batches were completed by a previous submission of the job
+    manifest = await manifest_store.load(job_key(request, {"source.table123": export}))
+    async for batch_num, batch in service.generate_query_batches(request, 1):
+        if batch_num == 2:
+            continue
+        path = f"/service_manifest_test/previous/{batch_num}.parquet"
+        fs.pipe(path, b"result")
+        await manifest.add(
+            batch_key(batch, None, {"source.table123": export}), path, 10, 6
+        )
+
+    response = await service.submit_job(request)
+    completed: asyncio.Future[JobStatusResponse] = asyncio.Future()
+
+    async def collect_updates(update: JobStatusResponse):
+        if update.status not in [QueryJobStatus.PENDING, QueryJobStatus.RUNNING]:
+            completed.set_result(update)
+
+    close = service.listen_for_job_updates(response.job_id, collect_updates)
+    status = await completed
+    close()
+
+    assert status.status == QueryJobStatus.COMPLETED
+    linked = fs.glob(f"/service_manifest_test/**/{response.job_id}/*.parquet")
+    assert len(linked) == 2
+
+    # The manifest is deleted once the job has completed
+    manifest = await manifest_store.load(job_key(request, {"source.table123": export}))
+    assert len(manifest) == 0
+    assert not fs.exists(manifest.path)
+
+    fs.rm("/service_manifest_test", recursive=True)
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_job_status_coalesces_updates():
+    service = MetricsCalculationService.setup(
+        "someid",
+        "bucket",
+        "result_path_prefix",
+        ClusterManager.with_dummy_metrics_plugin(LocalClusterFactory()),
+        await CacheExportManager.setup(FakeExportAdapter()),
+        DummyImportAdapter(),
+    )
+    request = JobSubmitRequest(
+        query_str="SELECT * FROM ref.table123",
+        start=datetime(2021, 1, 1),
+        end=datetime(2021, 4, 10),
+        dialect="duckdb",
+        batch_size=1,
+        columns=[("col1", "int"), ("col2", "string")],
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=30,
+            unit="day",
+            cron="@daily",
+        ),
+        execution_time=datetime.now(),
+        locals={},
+        dependent_tables_map={"source.table123": "source.table123"},
+    )
+    await service._notify_job_pending("job", request)
+
+    messages: t.List[t.Union[JobStatusResponse, JobStatusDelta]] = []
+
+    async def collect():
+        async for message in service.stream_job_status("job", interval=60):
+            messages.append(message)
+
+    stream = asyncio.create_task(collect())
+    await asyncio.sleep(0.01)
+    await service._notify_job_running("job")
+    for i in range(100):
+        await service._notify_job_task_completed("job", f"task_{i}")
+    await service._notify_job_completed("job")
+    await asyncio.wait_for(stream, timeout=5)
+
+    # The final status is sent without waiting for the interval
+    first = messages[0]
+    assert isinstance(first, JobStatusResponse)
+    assert len(messages) == 2
+    delta = messages[1]
+    assert isinstance(delta, JobStatusDelta)
+    status = delta.apply(first)
+    assert status.status == QueryJobStatus.COMPLETED
+    assert status.progress.completed == 100
+
+    await service.close()
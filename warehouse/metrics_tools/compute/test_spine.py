@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import duckdb
+import pytest
+from metrics_tools.compute.spine import (
+    date_spine_query,
+    render_rolling_template,
+    render_template_for_day,
+)
+from metrics_tools.compute.worker import execute_task_queries
+from metrics_tools.definition import PeerMetricDependencyRef
+from metrics_tools.runner import FakeEngineAdapter, MetricsRunner
+
+ROLLING_QUERY = """
+select @metrics_sample_date() as metrics_sample_date,
+  events.to_artifact_id,
+  @end_ds as end_ds,
+  COUNT(DISTINCT events.bucket_day) as amount
+from metrics.events as events
+where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+group by 1, 2, 3
+"""
+
+
+def create_runner(query: str):
+    return MetricsRunner.from_engine_adapter(
+        FakeEngineAdapter("duckdb"),
+        query,
+        PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=7,
+            unit="day",
+            cron="@daily",
+        ),
+        {},
+    )
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute("CREATE SCHEMA metrics")
+    conn.execute(
+        """
+        CREATE TABLE metrics.events AS
+        SELECT DATE '2024-01-01' + (range % 60)::INT AS bucket_day,
+          (range % 5)::VARCHAR AS to_artifact_id
+        FROM range(5000)
+        WHERE range % 3 != 0
+        """
+    )
+    return conn
+
+
+def test_date_spine_query_matches_per_day_queries(conn: duckdb.DuckDBPyConnection):
+    runner = create_runner(ROLLING_QUERY)
+    days = list(runner.iter_query_days(datetime(2024, 1, 20), datetime(2024, 2, 10)))
+
+    template = render_rolling_template(runner, [days[0], days[-1]])
+    assert template is not None
+    assert render_template_for_day(template, days[3]) == runner.render_query(
+        days[3], days[3]
+    )
+
+    expected = []
+    for day in days:
+        expected.extend(conn.execute(runner.render_query(day, day)).fetchall())
+
+    result = conn.execute(date_spine_query(template, days)).fetchall()
+    assert len(result) == len(expected)
+    assert sorted(result) == sorted(expected)
+
+
+def test_render_rolling_template_rejects_date_dependent_macros():
+    runner = create_runner(
+        """
+        select @IF(@end_ds > '2000-01-01', 'recent', 'old') as age,
+          @metrics_sample_date() as metrics_sample_date
+        from metrics.events
+        """
+    )
+    assert render_rolling_template(runner, [datetime(2024, 1, 1)]) is None
+
+
+def test_execute_task_queries_with_sample_dates(conn: duckdb.DuckDBPyConnection):
+    runner = create_runner(ROLLING_QUERY)
+    days = [datetime(2024, 2, 1), datetime(2024, 2, 2)]
+    template = render_rolling_template(runner, days)
+    assert template is not None
+
+    readers = list(execute_task_queries(conn, [template], days))
+    assert len(readers) == 1
+    result = readers[0].read_all()
+    assert sorted(set(result.column("end_ds").to_pylist())) == [
+        "2024-02-01",
+        "2024-02-02",
+    ]
@@ -7,6 +7,8 @@ from .types import (
     QueryJobTaskStatus,
     QueryJobTaskUpdate,
     QueryJobUpdate,
+    QueryProfile,
+    QueryTaskProfile,
 )
 
 
@@ -162,3 +164,68 @@ def test_query_job_state(
     response = state.as_response()
     assert response.status == expected_status, description
     assert len(response.exceptions) == expected_exceptions_count, description
+
+
+def test_query_job_state_stays_bounded():
+    state = QueryJobState.start("job_id", 1000)
+    state.update(
+        QueryJobUpdate.create_job_update(
+            QueryJobStateUpdate(status=QueryJobStatus.RUNNING, has_remaining_tasks=True)
+        )
+    )
+    for i in range(1000):
+        state.update(
+            QueryJobUpdate.create_task_update(
+                QueryJobTaskUpdate(
+                    status=QueryJobTaskStatus.FAILED,
+                    task_id=f"task_{i}",
+                    exception=f"failed {i}",
+                )
+            )
+        )
+    assert state.tasks_completed == 1000
+    assert state.tasks_failed == 1000
+    assert len(state.recent_exceptions) == QueryJobState.MAX_RECENT_EXCEPTIONS
+
+    response = state.as_response(include_stats=True)
+    assert response.exceptions == [f"failed {i}" for i in range(999, 994, -1)]
+    assert "running_to_failed_seconds" in response.stats
+
+
+def test_query_job_state_aggregates_task_profiles():
+    state = QueryJobState.start("job_id", 10)
+    for i in range(10):
+        state.update(
+            QueryJobUpdate.create_task_update(
+                QueryJobTaskUpdate(
+                    status=QueryJobTaskStatus.SUCCEEDED,
+                    task_id=f"task_{i}",
+                    profile=QueryTaskProfile(
+                        load_seconds=1.0,
+                        queries=[
+                            QueryProfile(seconds=i, rows=100, explain=f"plan {i}")
+                        ],
+                        write_seconds=1.0,
+                        rows=100,
+                        bytes=1000,
+                        process_peak_rss_bytes=i * 1024,
+                    ),
+                )
+            )
+        )
+
+    assert state.as_response().stats == {}
+    assert state.as_response().slow_queries == []
+
+    response = state.as_response(include_stats=True)
+    assert response.stats["profiled_tasks"] == 10
+    assert response.stats["task_load_seconds"] == 10.0
+    assert response.stats["task_query_seconds"] == 45.0
+    assert response.stats["task_mean_seconds"] == 6.5
+    assert response.stats["task_max_seconds"] == 11.0
+    assert response.stats["task_mean_rows"] == 100
+    assert response.stats["worker_process_peak_rss_bytes"] == 9 * 1024
+    assert [query.task_id for query in response.slow_queries] == [
+        f"task_{i}" for i in range(9, 4, -1)
+    ]
+    assert response.slow_queries[0].explain == "plan 9"
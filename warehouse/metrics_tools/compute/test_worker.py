@@ -0,0 +1,468 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import duckdb
+import fsspec
+import pyarrow.parquet as pq
+import pytest
+from metrics_tools.compute.types import (
+    ColumnsDefinition,
+    ExportReference,
+    ExportRequirements,
+    ExportTimeRange,
+    ExportType,
+    TableReference,
+    WorkerCacheMode,
+    WorkerWarmRequest,
+)
+from metrics_tools.compute.worker import (
+    WARM_DEPENDENCIES_METADATA_KEY,
+    CachedParquetFileSystem,
+    DuckDBMetricsWorkerPlugin,
+    DuckDBTableCache,
+    ParquetResultWriter,
+    rewrite_table_references,
+)
+from sqlglot import exp
+
+
+def export_reference(path: str, **source_metadata):
+    return ExportReference(
+        table=TableReference(table_name="events"),
+        type=ExportType.GCS,
+        columns=ColumnsDefinition(columns=[]),
+        payload={"gcs_path": path},
+        source_metadata=source_metadata,
+    )
+
+
+def pruned_requirements(start: datetime, end: datetime):
+    return ExportRequirements(
+        columns=["value"],
+        time_ranges=[ExportTimeRange(column="time", start=start, end=end)],
+    ).model_dump(mode="json")
+
+
+@pytest.fixture
+def exports(tmp_path):
+    conn = duckdb.connect()
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"export_{i}"
+        path.mkdir()
+        conn.execute(
+            f"COPY (SELECT {i} AS export_id, range AS value FROM range(1000)) TO '{path}/data.parquet'"
+        )
+        paths.append(str(path))
+    conn.close()
+    return paths
+
+
+def create_cache(conn: duckdb.DuckDBPyConnection, budget_bytes=None):
+    loads = []
+
+    def loader(
+        table_ref_name: str, path: str, destination: exp.Table, mode: WorkerCacheMode
+    ):
+        loads.append(path)
+        kind = "VIEW" if mode == WorkerCacheMode.VIEW else "TABLE"
+        conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{destination.db}"')
+        conn.execute(
+            f"CREATE {kind} {destination.sql('duckdb')} AS SELECT * FROM read_parquet('{os.path.join(path, '*')}')"
+        )
+
+    cache = DuckDBTableCache(
+        lambda: conn,
+        loader,
+        budget_bytes=budget_bytes,
+        export_size=lambda path: 100,
+    )
+    return cache, loads
+
+
+def test_table_cache_reloads_changed_exports(exports):
+    conn = duckdb.connect()
+    cache, loads = create_cache(conn)
+
+    first = cache.acquire("metrics.events", export_reference(exports[0]))
+    cache.release(first)
+    again = cache.acquire("metrics.events", export_reference(exports[0]))
+    cache.release(again)
+    assert loads == [exports[0]]
+
+    # A new export for the same reference is loaded into a new table
+    changed = cache.acquire("metrics.events", export_reference(exports[1]))
+    query = rewrite_table_references(
+        "SELECT DISTINCT events.export_id FROM metrics.events",
+        {"metrics.events": changed.local_table},
+    )
+    assert conn.execute(query).fetchall() == [(1,)]
+    cache.release(changed)
+    assert loads == [exports[0], exports[1]]
+    assert cache.stats() == {"hits": 1, "misses": 2, "size_bytes": 100}
+
+
+def test_table_cache_drops_superseded_exports_once_unused(exports):
+    conn = duckdb.connect()
+    cache, loads = create_cache(conn)
+
+    first = cache.acquire("metrics.events", export_reference(exports[0]))
+    changed = cache.acquire("metrics.events", export_reference(exports[1]))
+    # The superseded export is kept while a task still uses it
+    assert cache.cached_paths() == sorted([exports[0], exports[1]])
+
+    cache.release(first)
+    cache.release(changed)
+    assert cache.cached_paths() == [exports[1]]
+    tables = {
+        row[0]
+        for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()
+    }
+    assert tables == {changed.local_table.name}
+
+
+def test_table_cache_keeps_pruned_exports_used_by_different_jobs(exports):
+    conn = duckdb.connect()
+    cache, loads = create_cache(conn)
+    january = export_reference(
+        exports[0],
+        freshness_token="snapshot1",
+        requirements=pruned_requirements(datetime(2024, 1, 1), datetime(2024, 2, 1)),
+    )
+    february = export_reference(
+        exports[1],
+        freshness_token="snapshot1",
+        requirements=pruned_requirements(datetime(2024, 2, 1), datetime(2024, 3, 1)),
+    )
+
+    # Two jobs alternate between different pruned exports of the same table
+    for _ in range(3):
+        cache.release(cache.acquire("metrics.events", january))
+        cache.release(cache.acquire("metrics.events", february))
+    assert loads == [exports[0], exports[1]]
+    assert cache.cached_paths() == sorted([exports[0], exports[1]])
+
+    # An export of the whole table covers both of the pruned exports
+    full = export_reference(exports[2], freshness_token="snapshot1")
+    cache.release(cache.acquire("metrics.events", full))
+    assert cache.cached_paths() == [exports[2]]
+
+    # An export of a newer snapshot supersedes it even though it's pruned
+    cache.release(
+        cache.acquire(
+            "metrics.events",
+            export_reference(
+                exports[0],
+                freshness_token="snapshot2",
+                requirements=pruned_requirements(
+                    datetime(2024, 1, 1), datetime(2024, 2, 1)
+                ),
+            ),
+        )
+    )
+    assert cache.cached_paths() == [exports[0]]
+
+
+def test_table_cache_evicts_least_recently_used(exports):
+    conn = duckdb.connect()
+    cache, loads = create_cache(conn, budget_bytes=200)
+
+    first = cache.acquire("metrics.first", export_reference(exports[0]))
+    second = cache.acquire("metrics.second", export_reference(exports[1]))
+    cache.release(second)
+    cache.release(first)
+
+    # The second table was used least recently so it is evicted
+    third = cache.acquire("metrics.third", export_reference(exports[2]))
+    cache.release(third)
+    assert cache.size_bytes == 200
+
+    tables = {
+        row[0]
+        for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()
+    }
+    assert tables == {first.local_table.name, third.local_table.name}
+
+    assert cache.cached_paths() == sorted([exports[0], exports[2]])
+
+    # Evicted tables are loaded again when needed
+    cache.release(cache.acquire("metrics.second", export_reference(exports[1])))
+    assert loads == [exports[0], exports[1], exports[2], exports[1]]
+
+
+def test_table_cache_does_not_evict_tables_in_use(exports):
+    conn = duckdb.connect()
+    cache, _ = create_cache(conn, budget_bytes=100)
+
+    first = cache.acquire("metrics.first", export_reference(exports[0]))
+    second = cache.acquire("metrics.second", export_reference(exports[1]))
+
+    assert cache.size_bytes == 200
+    cache.release(first)
+    cache.release(second)
+
+
+def test_table_cache_loads_different_exports_concurrently(exports):
+    conn = duckdb.connect()
+    barrier = threading.Barrier(2, timeout=5)
+    loads = []
+
+    def loader(
+        table_ref_name: str, path: str, destination: exp.Table, mode: WorkerCacheMode
+    ):
+        loads.append(path)
+        # Both loads must be running at the same time to pass the barrier
+        barrier.wait()
+        conn.cursor().execute(
+            f"CREATE TABLE {destination.sql('duckdb')} AS SELECT 1 AS value"
+        )
+
+    conn.execute("CREATE SCHEMA metrics")
+    cache = DuckDBTableCache(lambda: conn, loader, export_size=lambda path: 100)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(cache.acquire, f"metrics.t{i}", export_reference(path))
+            for i, path in enumerate(exports[:2])
+        ]
+        acquired = [future.result() for future in futures]
+    assert sorted(loads) == exports[:2]
+    assert [cached.in_use for cached in acquired] == [1, 1]
+
+
+def test_table_cache_shares_loads_of_the_same_export(exports):
+    conn = duckdb.connect()
+    started = threading.Event()
+    finish = threading.Event()
+    loads = []
+
+    def loader(
+        table_ref_name: str, path: str, destination: exp.Table, mode: WorkerCacheMode
+    ):
+        loads.append(path)
+        started.set()
+        assert finish.wait(5)
+        raise ValueError("load failed")
+
+    cache = DuckDBTableCache(lambda: conn, loader, export_size=lambda path: 100)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(
+            cache.acquire, "metrics.events", export_reference(exports[0])
+        )
+        assert started.wait(5)
+        second = executor.submit(
+            cache.acquire, "metrics.events", export_reference(exports[0])
+        )
+        finish.set()
+        for future in [first, second]:
+            with pytest.raises(ValueError):
+                future.result()
+    assert loads == [exports[0]]
+    assert cache.size_bytes == 0
+
+
+def test_table_cache_views_do_not_count_towards_budget(exports):
+    conn = duckdb.connect()
+    cache, _ = create_cache(conn, budget_bytes=100)
+
+    table = cache.acquire("metrics.events", export_reference(exports[0]))
+    view = cache.acquire(
+        "metrics.events", export_reference(exports[0]), WorkerCacheMode.VIEW
+    )
+    cache.release(table)
+    cache.release(view)
+
+    assert table.local_table != view.local_table
+    assert cache.size_bytes == 100
+    query = rewrite_table_references(
+        "SELECT COUNT(*) FROM metrics.events WHERE value < 10",
+        {"metrics.events": view.local_table},
+    )
+    assert conn.execute(query).fetchall() == [(10,)]
+
+
+def test_cached_parquet_filesystem_fetches_on_first_read(exports, tmp_path):
+    local_fs = fsspec.filesystem("file")
+    cache_dir = tmp_path / "parquet_cache"
+    conn = duckdb.connect()
+    conn.register_filesystem(CachedParquetFileSystem(local_fs, str(cache_dir)))
+
+    query = f"SELECT SUM(value) FROM read_parquet('parquetcache://{exports[0]}/*')"
+    assert not cache_dir.exists() or not any(cache_dir.iterdir())
+    assert conn.execute(query).fetchall() == [(499500,)]
+    cached_files = [path for path in cache_dir.iterdir() if path.name != "cache"]
+    assert len(cached_files) == 1
+    assert conn.execute(query).fetchall() == [(499500,)]
+
+
+def test_parquet_result_writer_streams_query_results(tmp_path):
+    conn = duckdb.connect()
+    path = tmp_path / "result.parquet"
+    queries = [
+        "SELECT range AS id, 'a' AS name FROM range(2500)",
+        "SELECT range::INTEGER AS id, 'b' AS name FROM range(10)",
+        "SELECT range AS id, 'c' AS name FROM range(0)",
+    ]
+    with open(path, "wb") as f:
+        writer = ParquetResultWriter(f, row_group_size=1000, compression="snappy")
+        for query in queries:
+            writer.write(conn.execute(query).fetch_record_batch(1000))
+        writer.close()
+
+    assert writer.rows_written == 2510
+    assert writer.bytes_written == os.path.getsize(path)
+
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_row_groups == 3
+    assert parquet_file.metadata.row_group(0).column(0).compression == "SNAPPY"
+    result = parquet_file.read()
+    assert str(result.schema.field("id").type) == "int64"
+    assert result.column("name").value_counts().to_pylist() == [
+        {"values": "a", "counts": 2500},
+        {"values": "b", "counts": 10},
+    ]
+
+
+def test_parquet_result_writer_always_writes_a_valid_file(tmp_path):
+    conn = duckdb.connect()
+    empty_path = tmp_path / "empty.parquet"
+    with open(empty_path, "wb") as f:
+        writer = ParquetResultWriter(f)
+        writer.write(
+            conn.execute("SELECT 1 AS id, 'a' AS name WHERE false").fetch_record_batch()
+        )
+        writer.close()
+
+    # Results without rows keep their schema
+    empty = pq.read_table(empty_path)
+    assert empty.num_rows == 0
+    assert empty.schema.names == ["id", "name"]
+
+    unwritten_path = tmp_path / "unwritten.parquet"
+    with open(unwritten_path, "wb") as f:
+        writer = ParquetResultWriter(f)
+        writer.close()
+
+    assert writer.bytes_written == os.path.getsize(unwritten_path) > 0
+    assert pq.read_table(unwritten_path).num_rows == 0
+
+
+def create_plugin(bucket: str, **kwargs):
+    """A duckdb plugin that writes its results to an in memory filesystem"""
+    plugin = DuckDBMetricsWorkerPlugin(
+        bucket, "key", "secret", ":memory:", result_row_group_size=1000, **kwargs
+    )
+    plugin._conn = duckdb.connect()
+    plugin._fs = fsspec.filesystem("memory")
+    return plugin
+
+
+def test_handle_query_returns_a_task_profile(exports):
+    plugin = create_plugin(
+        "bucket", explain_slow_queries=True, explain_slow_query_seconds=0
+    )
+
+    result = plugin.handle_query(
+        "job",
+        "task",
+        "results/task.parquet",
+        [
+            "SELECT value FROM metrics.events WHERE value < 10",
+            "SELECT range AS value FROM range(2500)",
+        ],
+        {"metrics.events": export_reference(exports[0])},
+    )
+
+    profile = result.profile
+    assert profile is not None
+    assert result.rows_written == profile.rows == 2510
+    assert result.bytes_written == profile.bytes > 0
+    assert [query.rows for query in profile.queries] == [10, 2500]
+    assert all("EXPLAIN_ANALYZE" in (query.explain or "") for query in profile.queries)
+    assert profile.load_seconds > 0
+    assert profile.write_seconds > 0
+    assert profile.process_peak_rss_bytes
+    assert plugin.fs.ls("bucket/results", detail=False) == [
+        "/bucket/results/task.parquet"
+    ]
+
+
+def test_handle_query_only_explains_queries_when_enabled(exports):
+    plugin = create_plugin("explain-bucket", explain_slow_query_seconds=0)
+
+    result = plugin.handle_query(
+        "job",
+        "task",
+        "results/task.parquet",
+        ["SELECT range AS value FROM range(10)"],
+        {},
+    )
+
+    assert result.profile is not None
+    assert [query.explain for query in result.profile.queries] == [None]
+
+
+def test_handle_query_does_not_leave_partial_results(exports):
+    plugin = create_plugin("failing-bucket")
+
+    with pytest.raises(duckdb.Error):
+        plugin.handle_query(
+            "job",
+            "task",
+            "results/task.parquet",
+            [
+                "SELECT range AS value FROM range(2500)",
+                "SELECT missing FROM range(10)",
+            ],
+            {},
+        )
+    assert plugin.fs.find("failing-bucket") == []
+
+
+def test_handle_query_rejects_tasks_without_queries(exports):
+    plugin = create_plugin("empty-bucket")
+
+    with pytest.raises(ValueError):
+        plugin.handle_query("job", "task", "results/task.parquet", [], {})
+    assert plugin.fs.find("empty-bucket") == []
+
+
+@pytest.mark.asyncio
+async def test_warm_cache_on_join_loads_the_published_dependencies(exports):
+    plugin = create_plugin("warm-bucket")
+    worker = MagicMock()
+    worker.scheduler.get_metadata = AsyncMock(
+        return_value=WorkerWarmRequest(
+            dependencies={"metrics.events": export_reference(exports[0])},
+        ).model_dump(mode="json")
+    )
+
+    await plugin.warm_cache_on_join(worker)
+
+    worker.scheduler.get_metadata.assert_awaited_once_with(
+        keys=WARM_DEPENDENCIES_METADATA_KEY, default=None
+    )
+    assert plugin.cached_exports() == [exports[0]]
+
+    # Nothing is warmed before any job has published its dependencies and a
+    # failure to warm doesn't fail the worker
+    cold_plugin = create_plugin("cold-bucket")
+    worker.scheduler.get_metadata = AsyncMock(return_value=None)
+    await cold_plugin.warm_cache_on_join(worker)
+    worker.scheduler.get_metadata = AsyncMock(side_effect=OSError("unreachable"))
+    await cold_plugin.warm_cache_on_join(worker)
+    assert cold_plugin.cached_exports() == []
+
+
+def test_rewrite_table_references_keeps_qualified_columns():
+    local_table = exp.to_table('metrics."events__abc"')
+    query = rewrite_table_references(
+        "SELECT events.id, e2.id FROM metrics.events JOIN metrics.events AS e2 ON events.id = e2.id",
+        {"metrics.events": local_table},
+    )
+    assert query == (
+        'SELECT events.id, e2.id FROM metrics."events__abc" AS events '
+        'JOIN metrics."events__abc" AS e2 ON events.id = e2.id'
+    )
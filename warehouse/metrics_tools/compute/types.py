@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import math
 import typing as t
@@ -25,6 +26,26 @@ class ExportType(str, Enum):
     LOCALFS = "localfs"
 
 
+class WorkerCacheMode(str, Enum):
+    """How a worker makes dependency exports available to queries. `table`
+    loads each export into a duckdb table before any query runs while `view`
+    creates a view over the export's parquet files so only the data that the
+    queries read is fetched."""
+
+    TABLE = "table"
+    VIEW = "view"
+
+
+class QueryBatchMode(str, Enum):
+    """How the sample dates of a rolling batch are evaluated on a worker.
+    `per_day` sends a rendered query for every date while `date_spine` sends a
+    single template that the worker evaluates for all of the batch's dates in
+    one query."""
+
+    PER_DAY = "per_day"
+    DATE_SPINE = "date_spine"
+
+
 DUCKDB_TO_PANDAS_TYPE_MAP = {
     "BOOLEAN": "bool",
     "BOOL": "bool",
@@ -112,11 +133,98 @@ class ExportReference(BaseModel):
         return self.table.fqn
 
 
+class WorkerWarmRequest(BaseModel):
+    """The dependency exports that workers load into their cache when they join
+    the cluster"""
+
+    dependencies: t.Dict[str, ExportReference]
+    cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE
+
+
+class ExportTimeRange(BaseModel):
+    """An inclusive time range on a column of an exported table. A missing
+    start or end is unbounded."""
+
+    column: str
+    start: t.Optional[datetime] = None
+    end: t.Optional[datetime] = None
+
+
+class ExportRequirements(BaseModel):
+    """The subset of a table that a job needs from an export. If `columns` is
+    `None` all of the columns are required."""
+
+    columns: t.Optional[t.List[str]] = None
+    time_ranges: t.List[ExportTimeRange] = Field(default_factory=list)
+
+    def is_pruned(self) -> bool:
+        return self.columns is not None or len(self.time_ranges) > 0
+
+    def cache_key(self) -> str:
+        """A stable key for this projection and range"""
+        return hashlib.sha1(self.model_dump_json().encode()).hexdigest()[:16]
+
+    def covers(self, other: "ExportRequirements") -> bool:
+        """Whether an export with these requirements contains everything that
+        is needed by the other requirements"""
+        if self.columns is not None:
+            if other.columns is None or not set(other.columns) <= set(self.columns):
+                return False
+        other_ranges = {
+            time_range.column: time_range for time_range in other.time_ranges
+        }
+        for time_range in self.time_ranges:
+            other_range = other_ranges.get(time_range.column)
+            if other_range is None:
+                return False
+            if time_range.start is not None and (
+                other_range.start is None or other_range.start < time_range.start
+            ):
+                return False
+            if time_range.end is not None and (
+                other_range.end is None or other_range.end > time_range.end
+            ):
+                return False
+        return True
+
+
+class ExportCacheEntry(BaseModel):
+    """A persisted record of a table export. The table is the export cache key
+    which starts with the physical (snapshot) table name that was exported so
+    an entry is never served for a different snapshot of the same model."""
+
+    table: str
+    export_reference: ExportReference
+    exported_at: datetime
+    # Set for exports that were replaced by a newer export. Their files are
+    # cleaned once the grace period after this time has passed
+    superseded_at: t.Optional[datetime] = None
+
+
+class ExportCacheManifest(BaseModel):
+    entries: t.List[ExportCacheEntry] = Field(default_factory=list)
+
+
+class BatchResultCacheEntry(BaseModel):
+    """A previously written result of a query batch"""
+
+    key: str
+    path: str
+    rows_written: int
+    bytes_written: int
+    created_at: datetime
+
+
+class BatchResultCacheManifest(BaseModel):
+    entries: t.List[BatchResultCacheEntry] = Field(default_factory=list)
+
+
 class QueryJobStatus(str, Enum):
     PENDING = "pending"
     RUNNING = "running"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 
 class QueryJobTaskStatus(str, Enum):
@@ -135,11 +243,72 @@ class QueryJobProgress(BaseModel):
     total: int
 
 
+class QueryProfile(BaseModel):
+    """The execution profile of one of the queries of a task"""
+
+    # The time spent executing the query and reading its results. Time spent
+    # writing the results is part of the task's write phase
+    seconds: float
+    rows: int
+    # The output of `EXPLAIN ANALYZE` for queries that were slow enough
+    explain: t.Optional[str] = None
+
+
+class QueryTaskProfile(BaseModel):
+    """Where a worker spent the time of a query task"""
+
+    # The time spent loading the dependencies into the worker's cache
+    load_seconds: float = 0.0
+    queries: t.List[QueryProfile] = Field(default_factory=list)
+    # The time spent concatenating record batches into row groups
+    concat_seconds: float = 0.0
+    # The time spent encoding row groups and streaming them to the result
+    write_seconds: float = 0.0
+    # The time spent finishing the parquet file and completing the upload
+    upload_seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    # The peak resident memory of the worker process over its whole lifetime
+    # as of the end of the task. This includes earlier tasks and the cache so
+    # it's not the memory used by this task
+    process_peak_rss_bytes: t.Optional[int] = None
+
+    @property
+    def query_seconds(self) -> float:
+        return sum(query.seconds for query in self.queries)
+
+    @property
+    def total_seconds(self) -> float:
+        return (
+            self.load_seconds
+            + self.query_seconds
+            + self.concat_seconds
+            + self.write_seconds
+            + self.upload_seconds
+        )
+
+
 class QueryJobTaskUpdate(BaseModel):
     type: t.Literal[QueryJobUpdateScope.TASK] = QueryJobUpdateScope.TASK
     status: QueryJobTaskStatus
     task_id: str
     exception: t.Optional[str] = None
+    rows_written: t.Optional[int] = None
+    bytes_written: t.Optional[int] = None
+    profile: t.Optional[QueryTaskProfile] = None
+
+
+class QueryTaskResult(BaseModel):
+    """The result of a query task that was executed on a worker"""
+
+    task_id: str
+    rows_written: int = 0
+    bytes_written: int = 0
+    # The address of the worker that executed the task
+    worker_address: t.Optional[str] = None
+    # The time the worker spent executing the task
+    elapsed_seconds: t.Optional[float] = None
+    profile: t.Optional[QueryTaskProfile] = None
 
 
 class QueryJobStateUpdate(BaseModel):
@@ -195,6 +364,21 @@ class JobSubmitRequest(BaseModel):
     retries: t.Optional[int] = None
     slots: int = 2
     execution_time: datetime
+    prune_exports: bool = True
+    cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE
+    batch_mode: QueryBatchMode = QueryBatchMode.PER_DAY
+    # When set the service sizes batches so that each task takes about this
+    # long. `batch_size` is then only the size of the first batches
+    target_task_seconds: t.Optional[float] = None
+    # Jobs with a higher priority have their tasks released to the cluster
+    # first. Jobs of the same priority share the cluster fairly
+    priority: int = 0
+    # The maximum number of the job's tasks that run at once
+    max_running_tasks: t.Optional[int] = None
+    # The job is aborted once more than this many of its tasks have failed.
+    # Outstanding tasks are cancelled and no more batches are submitted. If
+    # unset every task is run regardless of failures
+    max_task_failures: t.Optional[int] = None
 
     def query_as(self, dialect: str) -> str:
         return parse_one(self.query_str, self.dialect).sql(dialect=dialect)
@@ -219,6 +403,13 @@ class JobSubmitResponse(BaseModel):
     export_reference: ExportReference
 
 
+class SlowQueryProfile(BaseModel):
+    task_id: str
+    seconds: float
+    rows: int
+    explain: t.Optional[str] = None
+
+
 class JobStatusResponse(BaseModel):
     type: t.Literal["JobStatusResponse"] = "JobStatusResponse"
     job_id: str
@@ -228,16 +419,177 @@ class JobStatusResponse(BaseModel):
     progress: QueryJobProgress
     stats: t.Dict[str, float] = Field(default_factory=dict)
     exceptions: t.List[str] = Field(default_factory=list)
+    # The slowest queries of the job's tasks. Only included with the stats
+    slow_queries: t.List[SlowQueryProfile] = Field(default_factory=list)
+
+    @property
+    def is_final(self) -> bool:
+        return self.status not in [QueryJobStatus.PENDING, QueryJobStatus.RUNNING]
+
+
+class JobStatusDelta(BaseModel):
+    """The parts of a job's status that changed since the previous status that
+    was streamed to a client. Fields that didn't change are None."""
+
+    type: t.Literal["JobStatusDelta"] = "JobStatusDelta"
+    job_id: str
+    updated_at: datetime
+    status: t.Optional[QueryJobStatus] = None
+    progress: t.Optional[QueryJobProgress] = None
+    stats: t.Optional[t.Dict[str, float]] = None
+    exceptions: t.Optional[t.List[str]] = None
+    slow_queries: t.Optional[t.List[SlowQueryProfile]] = None
+
+    FIELDS: t.ClassVar[t.List[str]] = [
+        "status",
+        "progress",
+        "stats",
+        "exceptions",
+        "slow_queries",
+    ]
+
+    @classmethod
+    def between(
+        cls, previous: JobStatusResponse, current: JobStatusResponse
+    ) -> "JobStatusDelta":
+        changes = {
+            field: getattr(current, field)
+            for field in cls.FIELDS
+            if getattr(current, field) != getattr(previous, field)
+        }
+        return cls(job_id=current.job_id, updated_at=current.updated_at, **changes)
+
+    @property
+    def has_changes(self) -> bool:
+        return any(getattr(self, field) is not None for field in self.FIELDS)
+
+    def apply(self, previous: JobStatusResponse) -> JobStatusResponse:
+        changes: t.Dict[str, t.Any] = {"updated_at": self.updated_at}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                changes[field] = value
+        return previous.model_copy(update=changes)
+
+
+# The messages of the job status stream. The first message is the full status
+# of the job and the rest are deltas
+JobStatusMessage = t.Annotated[
+    t.Union[JobStatusResponse, JobStatusDelta], Field(discriminator="type")
+]
+
+
+class JobTaskProfileStats(BaseModel):
+    """Aggregates the execution profiles of a job's tasks"""
+
+    # The number of slow queries that are kept for the job status
+    MAX_SLOW_QUERIES: t.ClassVar[int] = 5
+
+    tasks: int = 0
+    queries: int = 0
+    load_seconds: float = 0.0
+    query_seconds: float = 0.0
+    concat_seconds: float = 0.0
+    write_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    max_task_seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    process_peak_rss_bytes: int = 0
+    # The slowest queries of the job, slowest first
+    slow_queries: t.List[SlowQueryProfile] = Field(default_factory=list)
+
+    def add(self, task_id: str, profile: QueryTaskProfile):
+        self.tasks += 1
+        self.queries += len(profile.queries)
+        self.load_seconds += profile.load_seconds
+        self.query_seconds += profile.query_seconds
+        self.concat_seconds += profile.concat_seconds
+        self.write_seconds += profile.write_seconds
+        self.upload_seconds += profile.upload_seconds
+        self.max_task_seconds = max(self.max_task_seconds, profile.total_seconds)
+        self.rows += profile.rows
+        self.bytes += profile.bytes
+        self.process_peak_rss_bytes = max(
+            self.process_peak_rss_bytes, profile.process_peak_rss_bytes or 0
+        )
+        for query in profile.queries:
+            self._add_slow_query(
+                SlowQueryProfile(
+                    task_id=task_id,
+                    seconds=query.seconds,
+                    rows=query.rows,
+                    explain=query.explain,
+                )
+            )
+
+    def _add_slow_query(self, query: SlowQueryProfile):
+        if (
+            len(self.slow_queries) >= self.MAX_SLOW_QUERIES
+            and query.seconds <= self.slow_queries[-1].seconds
+        ):
+            return
+        self.slow_queries.append(query)
+        self.slow_queries.sort(key=lambda slow: slow.seconds, reverse=True)
+        del self.slow_queries[self.MAX_SLOW_QUERIES :]
+
+    def as_stats(self) -> t.Dict[str, float]:
+        if not self.tasks:
+            return {}
+        total_seconds = (
+            self.load_seconds
+            + self.query_seconds
+            + self.concat_seconds
+            + self.write_seconds
+            + self.upload_seconds
+        )
+        return {
+            "profiled_tasks": self.tasks,
+            "task_load_seconds": self.load_seconds,
+            "task_query_seconds": self.query_seconds,
+            "task_concat_seconds": self.concat_seconds,
+            "task_write_seconds": self.write_seconds,
+            "task_upload_seconds": self.upload_seconds,
+            "task_mean_seconds": total_seconds / self.tasks,
+            "task_max_seconds": self.max_task_seconds,
+            "task_mean_rows": self.rows / self.tasks,
+            "task_mean_bytes": self.bytes / self.tasks,
+            "task_rows_per_second": (
+                self.rows / total_seconds if total_seconds else 0.0
+            ),
+            "query_mean_seconds": (
+                self.query_seconds / self.queries if self.queries else 0.0
+            ),
+            "worker_process_peak_rss_bytes": self.process_peak_rss_bytes,
+        }
 
 
 class QueryJobState(BaseModel):
+    """The state of a job. Updates are folded into counters, the times of the
+    status changes and a bounded list of the most recent exceptions so the
+    size of the state, and the cost of a snapshot, doesn't grow with the number
+    of tasks."""
+
+    # The number of exceptions that are kept for the job status
+    MAX_RECENT_EXCEPTIONS: t.ClassVar[int] = 10
+
     job_id: str
     created_at: datetime
+    updated_at: datetime
     tasks_count: int
     tasks_completed: int = 0
+    tasks_failed: int = 0
     has_remaining_tasks: bool = True
     status: QueryJobStatus = QueryJobStatus.PENDING
-    updates: t.List[QueryJobUpdate]
+    # The last time the job started running
+    running_at: t.Optional[datetime] = None
+    # The last time the job reported that it completed
+    completed_at: t.Optional[datetime] = None
+    # The time of the first failure of the job or any of its tasks
+    failed_at: t.Optional[datetime] = None
+    # The most recent exceptions of the job and its tasks, oldest first
+    recent_exceptions: t.List[str] = Field(default_factory=list)
+    task_profiles: JobTaskProfileStats = Field(default_factory=JobTaskProfileStats)
 
     @classmethod
     def start(cls, job_id: str, tasks_count: int) -> "QueryJobState":
@@ -245,108 +597,85 @@ class QueryJobState(BaseModel):
         return cls(
             job_id=job_id,
             created_at=now,
+            updated_at=now,
             tasks_count=tasks_count,
-            updates=[
-                QueryJobUpdate(
-                    time=now,
-                    scope=QueryJobUpdateScope.JOB,
-                    payload=QueryJobStateUpdate(
-                        status=QueryJobStatus.PENDING,
-                        has_remaining_tasks=True,
-                    ),
-                )
-            ],
         )
 
-    def latest_update(self) -> QueryJobUpdate:
-        return self.updates[-1]
-
     def update(self, update: QueryJobUpdate):
-        """Add an update to the job state and change any relevant job state"""
-        self.updates.append(update)
+        """Fold an update into the job state"""
+        self.updated_at = update.time
         if update.scope == QueryJobUpdateScope.JOB:
             payload = t.cast(QueryJobStateUpdate, update.payload)
             if payload.status == QueryJobStatus.COMPLETED:
                 if self.status != QueryJobStatus.FAILED:
                     self.status = QueryJobStatus.COMPLETED
                 self.has_remaining_tasks = False
+                self.completed_at = update.time
             elif payload.status == QueryJobStatus.FAILED:
                 self.has_remaining_tasks = payload.has_remaining_tasks
                 self.status = payload.status
+                self.failed_at = self.failed_at or update.time
+            elif payload.status == QueryJobStatus.CANCELLED:
+                self.has_remaining_tasks = False
+                self.status = payload.status
             elif payload.status == QueryJobStatus.RUNNING:
                 self.status = payload.status
+                self.running_at = update.time
+            if payload.exception:
+                self._add_exception(payload.exception)
         else:
             payload = t.cast(QueryJobTaskUpdate, update.payload)
             if payload.status == QueryJobTaskStatus.FAILED:
                 self.status = QueryJobStatus.FAILED
+                self.tasks_failed += 1
+                self.failed_at = self.failed_at or update.time
+                if payload.exception:
+                    self._add_exception(payload.exception)
             elif payload.status == QueryJobTaskStatus.CANCELLED:
                 self.status = QueryJobStatus.FAILED
+                self.failed_at = self.failed_at or update.time
+            elif payload.profile:
+                self.task_profiles.add(payload.task_id, payload.profile)
             self.tasks_completed += 1
 
+    def _add_exception(self, exception: str):
+        self.recent_exceptions.append(exception)
+        if len(self.recent_exceptions) > self.MAX_RECENT_EXCEPTIONS:
+            del self.recent_exceptions[0]
+
     def as_response(
         self, include_stats: bool = False, include_exceptions_count: int = 5
     ) -> JobStatusResponse:
-        # Turn update events into stats
         stats = {}
         if include_stats:
             # Calculate the time between each status change
-            pending_to_running = None
-            running_to_completed = None
-            running_to_failed = None
-
-            for update in self.updates:
-                match update.scope:
-                    case QueryJobUpdateScope.JOB:
-                        if update.payload.status == QueryJobStatus.RUNNING:
-                            pending_to_running = update.time
-                        elif update.payload.status == QueryJobStatus.COMPLETED:
-                            running_to_completed = update.time
-                        elif update.payload.status == QueryJobStatus.FAILED:
-                            if running_to_failed is None:
-                                running_to_failed = update.time
-                    case QueryJobUpdateScope.TASK:
-                        if update.payload.status == QueryJobTaskStatus.FAILED:
-                            if running_to_failed is None:
-                                running_to_failed = update.time
-                        elif update.payload.status == QueryJobTaskStatus.CANCELLED:
-                            if running_to_failed is None:
-                                running_to_failed = update.time
-
-            if pending_to_running:
+            if self.running_at:
                 stats["pending_to_running_seconds"] = (
-                    pending_to_running - self.created_at
+                    self.running_at - self.created_at
                 ).total_seconds()
-            if running_to_completed:
+            if self.completed_at:
                 stats["running_to_completed_seconds"] = (
-                    (running_to_completed - pending_to_running).total_seconds()
-                    if pending_to_running
+                    (self.completed_at - self.running_at).total_seconds()
+                    if self.running_at
                     else None
                 )
-            if running_to_failed:
+            if self.failed_at:
                 stats["running_to_failed_seconds"] = (
-                    (running_to_failed - pending_to_running).total_seconds()
-                    if pending_to_running
+                    (self.failed_at - self.running_at).total_seconds()
+                    if self.running_at
                     else None
                 )
+            stats.update(self.task_profiles.as_stats())
         exceptions: t.List[str] = []
         if self.status == QueryJobStatus.FAILED:
-            for update in reversed(self.updates):
-                if update.scope == QueryJobUpdateScope.TASK:
-                    payload = t.cast(QueryJobTaskUpdate, update.payload)
-                    if payload.status == QueryJobTaskStatus.FAILED:
-                        if payload.exception:
-                            exceptions.append(payload.exception)
-                else:
-                    payload = t.cast(QueryJobStateUpdate, update.payload)
-                    if payload.exception:
-                        exceptions.append(payload.exception)
-                if len(exceptions) >= include_exceptions_count:
-                    break
+            exceptions = list(reversed(self.recent_exceptions))[
+                :include_exceptions_count
+            ]
 
         return JobStatusResponse(
             job_id=self.job_id,
             created_at=self.created_at,
-            updated_at=self.latest_update().time,
+            updated_at=self.updated_at,
             status=self.status,
             progress=QueryJobProgress(
                 completed=self.tasks_completed,
@@ -354,6 +683,9 @@ class QueryJobState(BaseModel):
             ),
             stats=stats,
             exceptions=exceptions,
+            slow_queries=(
+                list(self.task_profiles.slow_queries) if include_stats else []
+            ),
         )
 
 
@@ -438,6 +770,20 @@ class ClusterConfig(BaseSettings):
     worker_memory_request: str = "85000Mi"
     worker_pool_type: str = "sqlmesh-worker"
     worker_duckdb_path: str
+    # The maximum size of the dependency tables cached by each worker. 0 means
+    # the cache is unbounded
+    worker_cache_budget_mb: int = 0
+    # A local directory used to cache the parquet files read by workers in the
+    # `view` cache mode. Files are read directly from GCS if this isn't set
+    worker_parquet_cache_dir: str = ""
+    # The settings used when workers write the parquet results of a task
+    worker_result_row_group_size: int = 122880
+    worker_result_compression: str = "zstd"
+    # Re-runs queries that take at least `worker_explain_slow_query_seconds`
+    # with `EXPLAIN ANALYZE` for the job stats. This doubles the cost of those
+    # queries so it's off by default
+    worker_explain_slow_queries: bool = False
+    worker_explain_slow_query_seconds: float = 300.0
 
 
 class GCSConfig(BaseSettings):
@@ -457,12 +803,51 @@ class TrinoCacheExportConfig(BaseSettings):
     trino_catalog: str
     hive_catalog: str = "source"
     hive_schema: str = "export"
+    max_concurrent_exports: int = 4
+
+    # Location of the persisted export cache index. This can be any fsspec
+    # url (e.g. gs://bucket/path/index.json or a local path). If empty the
+    # cache index is only kept in memory.
+    export_cache_index_path: str = ""
+    export_cache_max_age_days: int = 7
+    stale_export_grace_period_minutes: int = 60
+    # How long the freshness of a table is trusted before it's checked again
+    export_freshness_check_seconds: int = 60
+
+    # Results of identical batches are reused for this many hours. 0 disables
+    # the batch result cache
+    result_cache_ttl_hours: int = 0
+    # The maximum total size of the cached batch results. 0 means unbounded
+    result_cache_budget_mb: int = 0
+    # Location of the persisted batch result cache index. This can be any
+    # fsspec url. If empty the cached results are forgotten on restart
+    result_cache_index_path: str = ""
+
+    # Location of the manifests of completed batches that let resubmitted jobs
+    # resume. This can be any fsspec url (e.g. gs://bucket/manifests or a local
+    # path). If empty jobs always start from the beginning
+    job_manifest_path: str = ""
+
+    # A local directory that the full log of each job's updates is written
+    # to. If empty only a summary of each job's state is kept
+    job_update_log_dir: str = ""
+
+    # Job status updates streamed to clients are coalesced over this interval.
+    # Final statuses are always sent immediately
+    job_status_interval_seconds: float = 1.0
+
+    # The maximum number of tasks of all jobs released to the cluster at once.
+    # 0 means unbounded
+    max_running_tasks: int = 0
 
 
 class AppConfig(ClusterConfig, TrinoCacheExportConfig, GCSConfig):
     model_config = SettingsConfigDict(env_prefix="metrics_")
 
     results_path_prefix: str = "mcs-results"
+    # The number of processes used to render the queries of jobs that can't
+    # be compiled once. 0 renders them in a thread of the service process
+    query_render_workers: int = 0
 
     debug_all: bool = False
     debug_with_duckdb: bool = False
@@ -1,24 +1,507 @@
 # The worker initialization
+import asyncio
+import hashlib
 import logging
 import os
+import resource
 import time
 import typing as t
 import uuid
+from concurrent.futures import Future
 from contextlib import contextmanager
+from datetime import datetime
 from threading import Lock
 
 import duckdb
 import gcsfs
-import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dask.distributed import Worker, WorkerPlugin, get_worker
+from fsspec import AbstractFileSystem
+from fsspec.implementations.cached import WholeFileCacheFileSystem
 from google.cloud import storage
-from metrics_tools.compute.types import ExportReference, ExportType
+from metrics_tools.compute.cache import export_reference_requirements
+from metrics_tools.compute.spine import date_spine_query, render_template_for_day
+from metrics_tools.compute.types import (
+    ExportReference,
+    ExportRequirements,
+    ExportType,
+    QueryProfile,
+    QueryTaskProfile,
+    QueryTaskResult,
+    WorkerCacheMode,
+    WorkerWarmRequest,
+)
 from metrics_tools.utils.logging import setup_module_logging
+from metrics_tools.utils.tables import resolve_table_fqn
 from sqlglot import exp
+from sqlmesh.core.dialect import parse_one
 
 logger = logging.getLogger(__name__)
 
-mutex = Lock()
+# The scheduler metadata key of the `WorkerWarmRequest` that workers load when
+# they join the cluster
+WARM_DEPENDENCIES_METADATA_KEY = ["metrics", "warm_dependencies"]
+
+
+def rewrite_table_references(
+    query: str, table_map: t.Dict[str, exp.Table], dialect: str = "duckdb"
+) -> str:
+    """Rewrites the table references in the query to use the tables in the
+    table map. The original table name is kept as an alias so that qualified
+    column references continue to work."""
+    expression = parse_one(query, dialect=dialect)
+    for table in list(expression.find_all(exp.Table)):
+        local_table = table_map.get(resolve_table_fqn(table))
+        if local_table is None:
+            continue
+        replacement = local_table.copy()
+        alias = table.args.get("alias") or exp.TableAlias(
+            this=exp.to_identifier(table.name)
+        )
+        replacement.set("alias", alias)
+        table.replace(replacement)
+    return expression.sql(dialect=dialect)
+
+
+class CachedParquetFileSystem(AbstractFileSystem):
+    """A read only filesystem for duckdb that lists files using the wrapped
+    filesystem but reads them through a local file cache. Files are only
+    downloaded the first time duckdb opens them."""
+
+    protocol = "parquetcache"
+
+    def __init__(self, fs: AbstractFileSystem, cache_storage: str, **kwargs):
+        super().__init__(**kwargs)
+        self.target = fs
+        self.cache = WholeFileCacheFileSystem(fs=fs, cache_storage=cache_storage)
+
+    def ls(self, path, detail=True, **kwargs):
+        return self.target.ls(self._strip_protocol(path), detail=detail, **kwargs)
+
+    def info(self, path, **kwargs):
+        return self.target.info(self._strip_protocol(path), **kwargs)
+
+    def _open(self, path, mode="rb", **kwargs):
+        return self.cache.open(self._strip_protocol(path), mode=mode, **kwargs)
+
+
+class CachedExport:
+    """A dependency export that has been loaded into the worker's duckdb"""
+
+    def __init__(
+        self,
+        table_ref_name: str,
+        gcs_path: str,
+        local_table: exp.Table,
+        mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        freshness_token: t.Optional[str] = None,
+        requirements: t.Optional[ExportRequirements] = None,
+    ):
+        self.table_ref_name = table_ref_name
+        self.gcs_path = gcs_path
+        self.local_table = local_table
+        self.mode = mode
+        # The snapshot of the source table and the subset of it that was
+        # exported. Used to tell whether a newer export replaces this one
+        self.freshness_token = freshness_token
+        self.requirements = requirements or ExportRequirements()
+        self.size_bytes = 0
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        # Resolved once the export has been loaded. Tasks that need an export
+        # that is still being loaded wait on this rather than loading it again
+        self.ready: Future[None] = Future()
+
+
+class DuckDBTableCache:
+    """Tracks the dependency exports loaded into the worker's duckdb.
+
+    Each export is loaded into a table named after the table reference and the
+    export's path. A changed export for the same reference therefore becomes a
+    new table and tasks still using the previous export are unaffected. An
+    export is superseded by a newer export of the same reference if it was
+    taken from a different snapshot of the source table or if the newer export
+    contains everything it does. Pruned exports of different columns or ranges
+    of the same reference are used by different jobs at the same time so they
+    don't supersede each other. The superseded table is dropped as soon as
+    it's no longer in use whatever the budget. Tables that aren't in use are evicted in least recently used order
+    whenever the total size of the cached tables exceeds the budget.
+
+    The cache's lock is only held while the bookkeeping is updated. Exports are
+    loaded outside of it so that different exports load concurrently while
+    concurrent requests for the same export share a single load.
+
+    Exports acquired in the `view` cache mode are only registered as views over
+    the export so they don't count towards the budget.
+    """
+
+    def __init__(
+        self,
+        connection_factory: t.Callable[[], duckdb.DuckDBPyConnection],
+        loader: t.Callable[[str, str, exp.Table, WorkerCacheMode], None],
+        budget_bytes: t.Optional[int] = None,
+        export_size: t.Optional[t.Callable[[str], int]] = None,
+        log_override: t.Optional[logging.Logger] = None,
+    ):
+        self._connection_factory = connection_factory
+        self._loader = loader
+        self._budget_bytes = budget_bytes
+        self._export_size = export_size
+        self._exports: t.Dict[t.Tuple[str, WorkerCacheMode], CachedExport] = {}
+        # The keys of the exports that were replaced by a newer export
+        self._superseded: t.Set[t.Tuple[str, WorkerCacheMode]] = set()
+        self._lock = Lock()
+        self.logger = log_override or logger
+        # Acquired exports that were already loaded or being loaded
+        self.hits = 0
+        # Acquired exports that had to be loaded
+        self.misses = 0
+
+    @staticmethod
+    def local_table_for(
+        table_ref_name: str,
+        gcs_path: str,
+        mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    ) -> exp.Table:
+        ref_table = exp.to_table(table_ref_name)
+        export_hash = hashlib.sha1(gcs_path.encode()).hexdigest()[:12]
+        name = f"{ref_table.name}__{export_hash}"
+        if mode == WorkerCacheMode.VIEW:
+            name = f"{name}__view"
+        return exp.table_(
+            exp.to_identifier(name, quoted=True),
+            db=exp.to_identifier(ref_table.db or "main", quoted=True),
+        )
+
+    def acquire(
+        self,
+        table_ref_name: str,
+        export_reference: ExportReference,
+        mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    ) -> CachedExport:
+        assert export_reference.type == ExportType.GCS, "Only GCS exports are supported"
+        gcs_path = export_reference.payload.get("gcs_path")
+        assert gcs_path is not None, "A gcs_path is required"
+
+        key = (gcs_path, mode)
+        with self._lock:
+            cached = self._exports.get(key)
+            should_load = cached is None
+            if should_load:
+                self.misses += 1
+            else:
+                self.hits += 1
+            if cached is None:
+                cached = CachedExport(
+                    table_ref_name,
+                    gcs_path,
+                    self.local_table_for(table_ref_name, gcs_path, mode),
+                    mode,
+                    freshness_token=export_reference.source_metadata.get(
+                        "freshness_token"
+                    ),
+                    requirements=export_reference_requirements(export_reference),
+                )
+                self._exports[key] = cached
+            cached.in_use += 1
+            cached.last_used = time.monotonic()
+
+        if should_load:
+            try:
+                self._load(cached)
+            except Exception as e:
+                with self._lock:
+                    if self._exports.get(key) is cached:
+                        del self._exports[key]
+                cached.ready.set_exception(e)
+            else:
+                cached.ready.set_result(None)
+
+        try:
+            cached.ready.result()
+        except Exception:
+            self.release(cached)
+            raise
+
+        with self._lock:
+            self._supersede_replaced(cached)
+            self._drop_superseded()
+            self._evict()
+        return cached
+
+    def release(self, cached: CachedExport):
+        with self._lock:
+            cached.in_use -= 1
+            cached.last_used = time.monotonic()
+            self._drop_superseded()
+
+    def _load(self, cached: CachedExport):
+        self._loader(
+            cached.table_ref_name, cached.gcs_path, cached.local_table, cached.mode
+        )
+        if cached.mode == WorkerCacheMode.TABLE:
+            cached.size_bytes = self._table_size_bytes(cached)
+        self.logger.info(
+            f"cached {cached.table_ref_name} from {cached.gcs_path} as {cached.local_table.sql()} [{cached.mode.value}] ({cached.size_bytes} bytes)"
+        )
+
+    def _table_size_bytes(self, cached: CachedExport) -> int:
+        """The size of the table in the duckdb database file. For in memory
+        databases the size of the export is used instead."""
+        conn = self._connection_factory()
+        table_name = cached.local_table.sql(dialect="duckdb").replace("'", "''")
+        blocks = conn.execute(
+            f"""
+            SELECT COUNT(DISTINCT block_id)
+            FROM pragma_storage_info('{table_name}')
+            WHERE persistent
+            """
+        ).fetchone()
+        block_count = blocks[0] if blocks else 0
+        if block_count:
+            block_size = conn.execute(
+                "SELECT block_size FROM pragma_database_size() WHERE database_name = current_database()"
+            ).fetchone()
+            return block_count * (block_size[0] if block_size else 262144)
+        if self._export_size:
+            return self._export_size(cached.gcs_path)
+        return 0
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(cached.size_bytes for cached in self._exports.values())
+
+    def stats(self) -> t.Dict[str, float]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size_bytes": self.size_bytes,
+            }
+
+    def cached_paths(self) -> t.List[str]:
+        """The gcs paths of the exports that are loaded in the cache"""
+        with self._lock:
+            return sorted(
+                {
+                    cached.gcs_path
+                    for cached in self._exports.values()
+                    if cached.ready.done() and not cached.ready.exception()
+                }
+            )
+
+    @staticmethod
+    def _replaces(newer: CachedExport, older: CachedExport) -> bool:
+        if newer.freshness_token != older.freshness_token:
+            return True
+        return newer.requirements.covers(older.requirements)
+
+    def _supersede_replaced(self, newer: CachedExport):
+        """Marks the other exports of the same reference that the newer export
+        replaces as superseded. This must be called with the lock held."""
+        self._superseded.discard((newer.gcs_path, newer.mode))
+        for key, cached in self._exports.items():
+            if (
+                cached is newer
+                or cached.table_ref_name != newer.table_ref_name
+                or cached.mode != newer.mode
+            ):
+                continue
+            if self._replaces(newer, cached):
+                self._superseded.add(key)
+
+    def _is_superseded(self, cached: CachedExport) -> bool:
+        return (cached.gcs_path, cached.mode) in self._superseded
+
+    def _drop(self, conn: duckdb.DuckDBPyConnection, cached: CachedExport):
+        kind = "VIEW" if cached.mode == WorkerCacheMode.VIEW else "TABLE"
+        conn.execute(f"DROP {kind} IF EXISTS {cached.local_table.sql('duckdb')}")
+        del self._exports[(cached.gcs_path, cached.mode)]
+        self._superseded.discard((cached.gcs_path, cached.mode))
+
+    def _drop_superseded(self):
+        """Drops the unused exports that were replaced by a newer export of the
+        same table reference"""
+        superseded = [
+            cached
+            for cached in self._exports.values()
+            if cached.in_use == 0
+            and cached.ready.done()
+            and not cached.ready.exception()
+            and self._is_superseded(cached)
+        ]
+        if not superseded:
+            return
+        conn = self._connection_factory()
+        for cached in superseded:
+            self.logger.info(
+                f"dropping superseded {cached.local_table.sql()} for {cached.table_ref_name} ({cached.size_bytes} bytes)"
+            )
+            self._drop(conn, cached)
+
+    def _evict(self):
+        if self._budget_bytes is None:
+            return
+        total = self.size_bytes
+        if total <= self._budget_bytes:
+            return
+        candidates = sorted(
+            [
+                cached
+                for cached in self._exports.values()
+                if cached.in_use == 0 and cached.size_bytes > 0
+            ],
+            key=lambda cached: cached.last_used,
+        )
+        conn = self._connection_factory()
+        for cached in candidates:
+            if total <= self._budget_bytes:
+                break
+            self.logger.info(
+                f"evicting {cached.local_table.sql()} for {cached.table_ref_name} ({cached.size_bytes} bytes)"
+            )
+            self._drop(conn, cached)
+            total -= cached.size_bytes
+        if total > self._budget_bytes:
+            self.logger.warning(
+                f"worker cache is {total} bytes which exceeds the budget of {self._budget_bytes} bytes"
+            )
+
+
+class ParquetResultWriter:
+    """Streams the results of queries into a single parquet file.
+
+    Record batches are buffered until there are enough rows for a row group so
+    only a single row group of the results is held in memory at a time. All
+    results are cast to the schema of the first result. Results without any
+    rows still produce a valid parquet file with that schema.
+    """
+
+    def __init__(
+        self,
+        file: t.IO[bytes],
+        row_group_size: int = 122880,
+        compression: str = "zstd",
+    ):
+        self._file = file
+        self._row_group_size = row_group_size
+        self._compression = compression
+        self._writer: t.Optional[pq.ParquetWriter] = None
+        self._pending: t.List[pa.Table] = []
+        self._pending_rows = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        # The time spent concatenating batches and writing the row groups
+        self.concat_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def write(self, reader: pa.RecordBatchReader) -> int:
+        """Writes the results of a reader and returns the number of rows read"""
+        rows = 0
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self._file, reader.schema, compression=self._compression
+            )
+        schema = self._writer.schema
+        for batch in reader:
+            if batch.num_rows == 0:
+                continue
+            rows += batch.num_rows
+            table = pa.Table.from_batches([batch])
+            if not table.schema.equals(schema):
+                table = table.cast(schema)
+            self._pending.append(table)
+            self._pending_rows += table.num_rows
+            if self._pending_rows >= self._row_group_size:
+                self._flush()
+        return rows
+
+    def _flush(self):
+        if not self._pending or self._writer is None:
+            return
+        started = time.monotonic()
+        table = pa.concat_tables(self._pending)
+        concatenated = time.monotonic()
+        self._writer.write_table(table, row_group_size=self._row_group_size)
+        self.concat_seconds += concatenated - started
+        self.write_seconds += time.monotonic() - concatenated
+        self.rows_written += table.num_rows
+        self._pending = []
+        self._pending_rows = 0
+
+    def close(self):
+        self._flush()
+        if self._writer is None:
+            # Nothing was written so there's no schema. An empty parquet file is
+            # still written so that readers never see a 0 byte file
+            self._writer = pq.ParquetWriter(
+                self._file, pa.schema([]), compression=self._compression
+            )
+        self._writer.close()
+        self.bytes_written = self._file.tell()
+
+
+def execute_task_queries(
+    conn: duckdb.DuckDBPyConnection,
+    queries: t.List[str],
+    sample_dates: t.Optional[t.List[datetime]] = None,
+    rows_per_batch: int = 122880,
+    log_override: t.Optional[logging.Logger] = None,
+) -> t.Iterator[pa.RecordBatchReader]:
+    """Executes the queries of a task and yields a reader for the results of
+    each query."""
+    for _, reader in iter_task_queries(
+        conn, queries, sample_dates, rows_per_batch, log_override
+    ):
+        yield reader
+
+
+def iter_task_queries(
+    conn: duckdb.DuckDBPyConnection,
+    queries: t.List[str],
+    sample_dates: t.Optional[t.List[datetime]] = None,
+    rows_per_batch: int = 122880,
+    log_override: t.Optional[logging.Logger] = None,
+) -> t.Iterator[t.Tuple[str, pa.RecordBatchReader]]:
+    """Executes the queries of a task and yields each query that was executed
+    along with a reader for its results.
+
+    If sample dates are given the only query is a rolling template which is
+    evaluated for all of the dates with a single date spine query. Should duckdb
+    be unable to run the date spine query the template is evaluated separately
+    for each of the dates instead.
+    """
+    log = log_override or logger
+    if sample_dates:
+        assert len(queries) == 1, "A single rolling template is expected"
+        template = queries[0]
+        spine_query = date_spine_query(template, sample_dates)
+        log.info(f"Executing date spine query {spine_query}")
+        try:
+            reader = conn.execute(spine_query).fetch_record_batch(rows_per_batch)
+        except duckdb.Error as e:
+            log.warning(f"Date spine query failed. Querying each date instead: {e}")
+            queries = [render_template_for_day(template, day) for day in sample_dates]
+        else:
+            yield spine_query, reader
+            return
+
+    for query in queries:
+        log.info(f"Executing query {query}")
+        yield query, conn.execute(query).fetch_record_batch(rows_per_batch)
+
+
+def explain_analyze(conn: duckdb.DuckDBPyConnection, query: str) -> str:
+    """Runs the query again with `EXPLAIN ANALYZE` and returns the profile"""
+    rows = conn.execute(f"EXPLAIN ANALYZE {query}").fetchall()
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def process_peak_rss_bytes() -> int:
+    """The peak resident memory of the current process since it started"""
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 class MetricsWorkerPlugin(WorkerPlugin):
@@ -38,10 +521,50 @@ class MetricsWorkerPlugin(WorkerPlugin):
         result_path: str,
         queries: t.List[str],
         dependencies: t.Dict[str, ExportReference],
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        sample_dates: t.Optional[t.List[datetime]] = None,
     ) -> t.Any:
         """Execute a query on the worker"""
         raise NotImplementedError()
 
+    def cached_exports(self) -> t.List[str]:
+        """The gcs paths of the dependency exports cached on the worker"""
+        return []
+
+    def cache_stats(self) -> t.Dict[str, float]:
+        """Statistics of the worker's dependency cache"""
+        return {}
+
+    def warm_cache(
+        self,
+        dependencies: t.Dict[str, ExportReference],
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    ):
+        """Loads the dependency exports into the worker's cache ahead of the
+        tasks that need them"""
+        pass
+
+    async def warm_cache_on_join(self, worker: Worker):
+        """Warms the cache of a worker that joined the cluster with the
+        dependencies that the service published to the scheduler. Workers that
+        join while a job is running are otherwise cold until the job places
+        tasks on them."""
+        try:
+            warm = await worker.scheduler.get_metadata(
+                keys=WARM_DEPENDENCIES_METADATA_KEY, default=None
+            )
+            if not warm:
+                return
+            request = WorkerWarmRequest.model_validate(warm)
+            self.logger.info(
+                f"warming the cache of a new worker with {len(request.dependencies)} dependencies"
+            )
+            await asyncio.to_thread(
+                self.warm_cache, request.dependencies, request.cache_mode
+            )
+        except Exception as e:
+            self.logger.warning(f"failed to warm the cache of a new worker: {e}")
+
 
 class DummyMetricsWorkerPlugin(MetricsWorkerPlugin):
     def handle_query(
@@ -51,12 +574,14 @@ class DummyMetricsWorkerPlugin(MetricsWorkerPlugin):
         result_path: str,
         queries: t.List[str],
         dependencies: t.Dict[str, ExportReference],
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        sample_dates: t.Optional[t.List[datetime]] = None,
     ) -> t.Any:
         logger.info(f"job[{job_id}][{task_id}]: dummy executing query {queries}")
         logger.info(f"job[{job_id}][{task_id}]: deps received: {dependencies}")
         logger.info(f"job[{job_id}][{task_id}]: result_path: {result_path}")
         time.sleep(1)
-        return task_id
+        return QueryTaskResult(task_id=task_id)
 
 
 class DuckDBMetricsWorkerPlugin(MetricsWorkerPlugin):
@@ -66,14 +591,31 @@ class DuckDBMetricsWorkerPlugin(MetricsWorkerPlugin):
         gcs_key_id: str,
         gcs_secret: str,
         duckdb_path: str,
+        cache_budget_bytes: t.Optional[int] = None,
+        parquet_cache_dir: t.Optional[str] = None,
+        result_row_group_size: t.Optional[int] = None,
+        result_compression: t.Optional[str] = None,
+        explain_slow_queries: bool = False,
+        explain_slow_query_seconds: float = 300.0,
     ):
         self._gcs_bucket = gcs_bucket
         self._gcs_key_id = gcs_key_id
         self._gcs_secret = gcs_secret
         self._duckdb_path = duckdb_path
+        self._parquet_cache_dir = parquet_cache_dir
+        self._result_row_group_size = result_row_group_size or 122880
+        self._result_compression = result_compression or "zstd"
+        self._explain_slow_queries = explain_slow_queries
+        self._explain_slow_query_seconds = explain_slow_query_seconds
         self._conn = None
         self._fs = None
-        self._cache_status: t.Dict[str, bool] = {}
+        self._warm_task: t.Optional[asyncio.Task] = None
+        self._cache = DuckDBTableCache(
+            lambda: self.connection,
+            self.load_using_gcs_parquet,
+            budget_bytes=cache_budget_bytes,
+            export_size=lambda gcs_path: self.fs.du(gcs_path),
+        )
         self._catalog = None
         self._mode = "duckdb"
         self._uuid = uuid.uuid4().hex
@@ -96,7 +638,20 @@ class DuckDBMetricsWorkerPlugin(MetricsWorkerPlugin):
         self._conn.sql(sql)
         self._fs = gcsfs.GCSFileSystem()
 
+        if self._parquet_cache_dir:
+            self._conn.register_filesystem(
+                CachedParquetFileSystem(self._fs, self._parquet_cache_dir)
+            )
+
+        # The plugin is set up on the worker's event loop. Warming runs in the
+        # background so that the worker can accept tasks straight away
+        self._warm_task = asyncio.get_running_loop().create_task(
+            self.warm_cache_on_join(worker)
+        )
+
     def teardown(self, worker: Worker):
+        if self._warm_task:
+            self._warm_task.cancel()
         if self._conn:
             self._conn.close()
 
@@ -109,48 +664,82 @@ class DuckDBMetricsWorkerPlugin(MetricsWorkerPlugin):
         self,
         table_ref_name: str,
         export_reference: ExportReference,
+        mode: WorkerCacheMode = WorkerCacheMode.TABLE,
     ):
-        """Checks if a table is cached in the local duckdb"""
+        """Ensures the export is cached in the local duckdb and returns the
+        cache entry. The caller must release the entry once it's done."""
         logger.info(
-            f"[{self._uuid}] got a cache request for {table_ref_name}:{export_reference.table.table_name}"
+            f"[{self._uuid}] got a {mode.value} cache request for {table_ref_name}:{export_reference.table.table_name}"
         )
-        assert export_reference.type == ExportType.GCS, "Only GCS exports are supported"
-        assert (
-            export_reference.payload.get("gcs_path") is not None
-        ), "A gcs_path is required"
+        return self._cache.acquire(table_ref_name, export_reference, mode)
 
-        if self._cache_status.get(table_ref_name):
-            return
-        with mutex:
-            if self._cache_status.get(table_ref_name):
-                return
-            destination_table = exp.to_table(table_ref_name)
-
-            gcs_path = export_reference.payload["gcs_path"]
+    def cached_exports(self) -> t.List[str]:
+        return self._cache.cached_paths()
 
-            self.load_using_gcs_parquet(table_ref_name, gcs_path, destination_table)
+    def cache_stats(self) -> t.Dict[str, float]:
+        return self._cache.stats()
 
-            self._cache_status[table_ref_name] = True
+    def warm_cache(
+        self,
+        dependencies: t.Dict[str, ExportReference],
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    ):
+        for ref, actual in dependencies.items():
+            self.logger.info(f"[{self._uuid}] warming cache for {ref}:{actual}")
+            self._cache.release(self.get_for_cache(ref, actual, cache_mode))
 
     def load_using_gcs_parquet(
         self,
         table_ref_name: str,
         gcs_path: str,
         destination_table: exp.Table,
+        mode: WorkerCacheMode = WorkerCacheMode.TABLE,
     ):
-        self.connection.execute(f"CREATE SCHEMA IF NOT EXISTS {destination_table.db}")
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{destination_table.db}"')
+
+        if mode == WorkerCacheMode.VIEW:
+            self.create_parquet_view(table_ref_name, gcs_path, destination_table)
+            return
+
         logger.info(f"CACHING TABLE {table_ref_name} WITH PARQUET")
 
         path_to_load = os.path.join(gcs_path, "*")
 
         cache_sql = f"""
-            CREATE TABLE IF NOT EXISTS "{destination_table.db}"."{destination_table.this.this}" AS
+            CREATE OR REPLACE TABLE "{destination_table.db}"."{destination_table.name}" AS
             SELECT * FROM read_parquet('{path_to_load}')
         """
         logger.debug(f"Executing SQL: {cache_sql}")
         self.connection.sql(cache_sql)
         logger.info(f"LOADING EXPORTED TABLE {table_ref_name} COMPLETED")
 
+    def create_parquet_view(
+        self,
+        table_ref_name: str,
+        gcs_path: str,
+        destination_table: exp.Table,
+    ):
+        """Registers a view over the exported parquet files. Nothing is read
+        until a query uses the view which lets duckdb push projections down to
+        the parquet scan and skip row groups using the parquet statistics. The
+        exports aren't partitioned so every file is still opened."""
+        logger.info(f"CREATING VIEW FOR {table_ref_name} OVER PARQUET")
+        path_to_view = os.path.join(self.parquet_read_path(gcs_path), "*")
+        view_sql = f"""
+            CREATE OR REPLACE VIEW "{destination_table.db}"."{destination_table.name}" AS
+            SELECT * FROM read_parquet('{path_to_view}')
+        """
+        logger.debug(f"Executing SQL: {view_sql}")
+        self.connection.sql(view_sql)
+
+    def parquet_read_path(self, gcs_path: str):
+        """The path duckdb should use to read an export. If a local parquet cache
+        is configured the files are read through it."""
+        if not self._parquet_cache_dir:
+            return gcs_path
+        path = gcs_path.split("://", 1)[-1]
+        return f"{CachedParquetFileSystem.protocol}://{path}"
+
     @contextmanager
     def gcs_client(self):
         client = storage.Client()
@@ -184,37 +773,130 @@ class DuckDBMetricsWorkerPlugin(MetricsWorkerPlugin):
         result_path: str,
         queries: t.List[str],
         dependencies: t.Dict[str, ExportReference],
+        cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+        sample_dates: t.Optional[t.List[datetime]] = None,
     ) -> t.Any:
         """Execute a duckdb load on a worker.
 
-        This executes the query with duckdb and writes the results to a gcs
-        path. We need to use polars or pyarrow here because the pandas parquet
-        writer doesn't write the correct datatypes for trino.
+        This executes the query with duckdb and streams the results to a
+        parquet file at a gcs path. We need to use pyarrow here because the
+        pandas parquet writer doesn't write the correct datatypes for trino.
         """
 
-        for ref, actual in dependencies.items():
+        if not queries:
+            # Without a query there's no schema for the result
+            raise ValueError(f"job[{job_id}][{task_id}] has no queries to execute")
+
+        profile = QueryTaskProfile()
+        acquired: t.List[CachedExport] = []
+        try:
+            load_started = time.monotonic()
+            for ref, actual in dependencies.items():
+                self.logger.info(
+                    f"job[{job_id}][{task_id}] Loading cache for {ref}:{actual}"
+                )
+                acquired.append(self.get_for_cache(ref, actual, cache_mode))
+            profile.load_seconds = time.monotonic() - load_started
+            table_map = {
+                cached.table_ref_name: cached.local_table for cached in acquired
+            }
+            conn = self.connection
             self.logger.info(
-                f"job[{job_id}][{task_id}] Loading cache for {ref}:{actual}"
+                f"job[{job_id}][{task_id}]: Streaming results to gcs {result_path}"
             )
-            self.get_for_cache(ref, actual)
-        conn = self.connection
-        results: t.List[pl.DataFrame] = []
-        for query in queries:
-            self.logger.info(f"job[{job_id}][{task_id}]: Executing query {query}")
-            result = conn.execute(query).pl()
-            results.append(result)
-        # Concatenate the results
-        self.logger.info(f"job[{job_id}][{task_id}]: Concatenating results")
-        combined_results = pl.concat(results)
-
-        # Export the results to a parquet file in memory
+            # Results are written to a temporary object that is only moved to
+            # the result path once it's complete so that a failed task never
+            # leaves a partial result behind
+            path = f"{self._gcs_bucket}/{result_path}"
+            temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with self.fs.open(temporary_path, "wb") as f:
+                    writer = self.write_results(
+                        f,
+                        conn,
+                        [
+                            rewrite_table_references(query, table_map)
+                            for query in queries
+                        ],
+                        sample_dates,
+                        profile,
+                    )
+                    upload_started = time.monotonic()
+                    writer.close()
+                self.fs.mv(temporary_path, path)
+            except Exception:
+                self.discard_result(temporary_path)
+                raise
+            profile.upload_seconds = time.monotonic() - upload_started
+        finally:
+            for cached in acquired:
+                self._cache.release(cached)
+        profile.concat_seconds = writer.concat_seconds
+        profile.write_seconds = writer.write_seconds
+        profile.rows = writer.rows_written
+        profile.bytes = writer.bytes_written
+        profile.process_peak_rss_bytes = process_peak_rss_bytes()
+        result = QueryTaskResult(
+            task_id=task_id,
+            rows_written=writer.rows_written,
+            bytes_written=writer.bytes_written,
+            profile=profile,
+        )
         self.logger.info(
-            f"job[{job_id}][{task_id}]: Uploading to gcs {result_path} with polars"
+            f"job[{job_id}][{task_id}]: Upload completed with {result.rows_written} rows ({result.bytes_written} bytes)"
+        )
+        return result
+
+    def write_results(
+        self,
+        file: t.IO[bytes],
+        conn: duckdb.DuckDBPyConnection,
+        queries: t.List[str],
+        sample_dates: t.Optional[t.List[datetime]],
+        profile: QueryTaskProfile,
+    ) -> ParquetResultWriter:
+        """Streams the results of the queries to the file and records the time
+        spent on each query in the profile. The writer is returned unclosed."""
+        writer = ParquetResultWriter(
+            file,
+            row_group_size=self._result_row_group_size,
+            compression=self._result_compression,
+        )
+        readers = iter_task_queries(
+            conn, queries, sample_dates, rows_per_batch=self._result_row_group_size
         )
-        with self.fs.open(f"{self._gcs_bucket}/{result_path}", "wb") as f:
-            combined_results.write_parquet(f)  # type: ignore
-        self.logger.info(f"job[{job_id}][{task_id}]: Upload completed")
-        return task_id
+        # Each query is executed when its reader is requested
+        started = time.monotonic()
+        for query, reader in readers:
+            flushed = writer.concat_seconds + writer.write_seconds
+            rows = writer.write(reader)
+            # Time spent writing the results belongs to the write phase
+            seconds = time.monotonic() - started
+            seconds -= writer.concat_seconds + writer.write_seconds - flushed
+            profile.queries.append(self.profile_query(conn, query, rows, seconds))
+            started = time.monotonic()
+        return writer
+
+    def discard_result(self, path: str):
+        try:
+            self.fs.rm(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f"Failed to remove the partial result {path}: {e}")
+
+    def profile_query(
+        self, conn: duckdb.DuckDBPyConnection, query: str, rows: int, seconds: float
+    ) -> QueryProfile:
+        explain: t.Optional[str] = None
+        # Explaining a query runs it again so this is only done when enabled
+        if self._explain_slow_queries and seconds >= self._explain_slow_query_seconds:
+            self.logger.info(f"Explaining a query that took {seconds:.1f}s")
+            try:
+                explain = explain_analyze(conn, query)
+            except duckdb.Error as e:
+                self.logger.warning(f"Failed to explain a slow query: {e}")
+        return QueryProfile(seconds=seconds, rows=rows, explain=explain)
 
 
 def execute_duckdb_load(
@@ -223,6 +905,8 @@ def execute_duckdb_load(
     result_path: str,
     queries: t.List[str],
     dependencies: t.Dict[str, ExportReference],
+    cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    sample_dates: t.Optional[t.List[datetime]] = None,
 ):
     """Execute a duckdb load on a worker.
 
@@ -232,9 +916,48 @@ def execute_duckdb_load(
 
     # The metrics plugin keeps a record of the cached tables on the worker.
     plugin = t.cast(MetricsWorkerPlugin, worker.plugins["metrics"])
-    plugin.handle_query(job_id, task_id, result_path, queries, dependencies)
+    started = time.monotonic()
+    result = plugin.handle_query(
+        job_id, task_id, result_path, queries, dependencies, cache_mode, sample_dates
+    )
+    if isinstance(result, QueryTaskResult):
+        result.worker_address = worker.address
+        result.elapsed_seconds = time.monotonic() - started
+    return result
 
-    return task_id
+
+def get_cache_inventory(dask_worker: Worker) -> t.List[str]:
+    """Lists the dependency exports cached on a worker.
+
+    Used with `Client.run` so the service can place tasks on warm workers.
+    """
+    plugin = t.cast(MetricsWorkerPlugin, dask_worker.plugins["metrics"])
+    return plugin.cached_exports()
+
+
+def get_worker_metrics(dask_worker: Worker) -> t.Dict[str, float]:
+    """Collects the statistics of a worker's dependency cache.
+
+    Used with `Client.run` to expose the worker metrics from the service.
+    """
+    plugin = t.cast(MetricsWorkerPlugin, dask_worker.plugins["metrics"])
+    return plugin.cache_stats()
+
+
+async def warm_worker_cache(
+    dependencies: t.Dict[str, ExportReference],
+    cache_mode: WorkerCacheMode = WorkerCacheMode.TABLE,
+    dask_worker: t.Optional[Worker] = None,
+):
+    """Loads the dependencies into a worker's cache.
+
+    Used with `Client.run` to warm workers in the background before tasks are
+    placed on them. Dask only supports not waiting on coroutines so the load
+    runs in a thread to keep the worker's event loop free.
+    """
+    assert dask_worker is not None
+    plugin = t.cast(MetricsWorkerPlugin, dask_worker.plugins["metrics"])
+    await asyncio.to_thread(plugin.warm_cache, dependencies, cache_mode)
 
 
 def bad_execute(*args, **kwargs):
@@ -57,18 +57,28 @@ def generated_rolling_query(
         runner = MetricsRunner.from_sqlmesh_context(
             context, query, ref, context._variables.copy()
         )
-        df = runner.run_rolling(start, end)
+        chunk_rows = env.ensure_int("SQLMESH_ROLLING_CHUNK_ROWS", 0)
+        parallelism = env.ensure_int("SQLMESH_ROLLING_PARALLELISM", 1)
+        incremental = env.ensure_bool("SQLMESH_ROLLING_INCREMENTAL", False)
         # If the rolling window is empty we need to yield from an empty tuple
         # otherwise sqlmesh fails. See:
         # https://sqlmesh.readthedocs.io/en/latest/concepts/models/python_models/#returning-empty-dataframes
         total = 0
-        if df.empty:
-            yield from ()
-        else:
+        for df in runner.iter_rolling(
+            start,
+            end,
+            chunk_rows=chunk_rows or None,
+            incremental=incremental,
+            parallelism=parallelism,
+        ):
+            if df.empty:
+                continue
             count = len(df)
             total += count
             logger.debug(f"table={table_name} yielding rows {count}")
             yield df
+        if total == 0:
+            yield from ()
         logger.debug(f"table={table_name} yielded rows{total}")
     else:
         logger.info("metrics calculation service enabled")
@@ -83,6 +93,9 @@ def generated_rolling_query(
             ].items()
         ]
 
+        # A negative value runs every task regardless of failures
+        max_task_failures = env.ensure_int("SQLMESH_MCS_MAX_TASK_FAILURES", -1)
+
         response = mcs_client.calculate_metrics(
             query_str=rendered_query_str,
             start=start,
@@ -99,6 +112,10 @@ def generated_rolling_query(
             job_retries=env.ensure_int("SQLMESH_MCS_JOB_RETRIES", 5),
             cluster_min_size=env.ensure_int("SQLMESH_MCS_CLUSTER_MIN_SIZE", 0),
             cluster_max_size=env.ensure_int("SQLMESH_MCS_CLUSTER_MAX_SIZE", 30),
+            target_task_seconds=(
+                env.ensure_int("SQLMESH_MCS_TARGET_TASK_SECONDS", 0) or None
+            ),
+            max_task_failures=max_task_failures if max_task_failures >= 0 else None,
         )
 
         column_names = list(map(lambda col: col[0], columns))
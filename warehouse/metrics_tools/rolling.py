@@ -0,0 +1,688 @@
+"""Incrementally evaluates rolling metrics queries.
+
+Rolling metrics are normally evaluated by running the query once for every
+sample date which costs O(days x window). For queries of a supported shape this
+instead fetches partial aggregates for every day of the range once and slides
+the window over them, adding the day that enters the window and retracting the
+day that leaves it. The partials are fetched a slice of sample dates at a time
+as the window advances.
+
+Supported queries select from a single table, limit it to the rolling window
+with a `BETWEEN` on a time column and only use SUM, COUNT and COUNT(DISTINCT)
+aggregates. `IncrementalRollingQuery.from_template` returns None for anything
+else so that callers can fall back to evaluating each sample date. SUMs are
+only exact when they're over integers (see `has_exact_sums`).
+"""
+
+import logging
+import typing as t
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+import duckdb
+import pandas as pd
+import sqlglot
+from metrics_tools.compute.spine import (
+    SPINE_ALIAS,
+    SPINE_COLUMN,
+    contains_template_ds,
+    date_spine,
+    replace_template_day,
+    replace_template_ds,
+)
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.annotate_types import annotate_types
+from sqlglot.optimizer.qualify import qualify
+from sqlmesh import EngineAdapter
+
+logger = logging.getLogger(__name__)
+
+# Days used to check that the window bounds of a query describe a fixed number
+# of days. They are a month apart so monthly windows are rejected.
+WINDOW_CHECK_DAYS = [datetime(2024, 2, 1), datetime(2024, 3, 1)]
+
+# The minimum number of sample dates whose partials are fetched at once. Each
+# fetch also reads the rows of the window before the slice.
+PARTIALS_SLICE_DAYS = 30
+
+ENTER_COLUMN = "_rolling_enter"
+LEAVE_COLUMN = "_rolling_leave"
+ROWS_COLUMN = "_rolling_rows"
+DISTINCT_VALUE_COLUMN = "_rolling_distinct_value"
+
+
+@dataclass
+class RollingAggregate:
+    """An aggregate of the query that can be maintained incrementally"""
+
+    kind: t.Literal["sum", "count", "count_star", "count_distinct"]
+    expression: t.Optional[exp.Expression]
+    index: int
+
+
+@dataclass
+class RollingGroupState:
+    """The aggregates of a single group for the current window"""
+
+    values: t.Tuple[t.Any, ...]
+    rows: int = 0
+    sums: t.Dict[int, t.Any] = field(default_factory=dict)
+    sum_counts: t.Dict[int, int] = field(default_factory=dict)
+    counts: t.Dict[int, int] = field(default_factory=dict)
+    distinct: t.Dict[int, Counter] = field(default_factory=dict)
+
+
+class IncrementalRollingQuery:
+    def __init__(
+        self,
+        select: exp.Select,
+        dialect: str,
+        window: int,
+        time_column: exp.Expression,
+        bounds: t.Tuple[exp.Expression, exp.Expression],
+        filters: t.List[exp.Expression],
+        keys: t.List[int],
+        day_constants: t.List[int],
+        aggregates: t.List[RollingAggregate],
+    ):
+        self._select = select
+        self._dialect = dialect
+        self._window = window
+        self._time_column = time_column
+        self._bounds = bounds
+        self._filters = filters
+        self._keys = keys
+        self._day_constants = day_constants
+        self._aggregates = aggregates
+
+    @classmethod
+    def from_template(
+        cls, template: str, dialect: str
+    ) -> t.Optional["IncrementalRollingQuery"]:
+        """Analyzes a rolling template (see `metrics_tools.compute.spine`) and
+        returns None if it can't be evaluated incrementally"""
+        select = sqlglot.parse_one(template, dialect=dialect)
+        if not isinstance(select, exp.Select):
+            return None
+        # Ordering and limits apply to the results of each sample date which
+        # can't be derived from the partial aggregates
+        for arg in [
+            "with",
+            "joins",
+            "laterals",
+            "having",
+            "qualify",
+            "distinct",
+            "order",
+            "limit",
+            "offset",
+        ]:
+            if select.args.get(arg):
+                return None
+        from_ = select.args.get("from")
+        if not from_ or not isinstance(from_.this, exp.Table):
+            return None
+        if select.find(exp.Window) or len(list(select.find_all(exp.Select))) > 1:
+            return None
+
+        where = select.args.get("where")
+        if not where:
+            return None
+        conditions = (
+            list(where.this.flatten())
+            if isinstance(where.this, exp.And)
+            else [where.this]
+        )
+        window_conditions = [
+            condition for condition in conditions if contains_template_ds(condition)
+        ]
+        if len(window_conditions) != 1:
+            return None
+        window_condition = window_conditions[0].unnest()
+        if not isinstance(window_condition, exp.Between):
+            return None
+        low = window_condition.args["low"]
+        high = window_condition.args["high"]
+        if low.find(exp.Column) or high.find(exp.Column):
+            return None
+        window = _window_days(low, high, dialect)
+        if window is None:
+            return None
+
+        keys: t.List[int] = []
+        day_constants: t.List[int] = []
+        aggregates: t.List[RollingAggregate] = []
+        for index, projection in enumerate(select.expressions):
+            if not projection.alias_or_name:
+                return None
+            expression = projection.unalias()
+            if expression.find(exp.AggFunc):
+                aggregate = _rolling_aggregate(expression, index)
+                if aggregate is None:
+                    return None
+                aggregates.append(aggregate)
+            elif contains_template_ds(expression):
+                if expression.find(exp.Column):
+                    return None
+                day_constants.append(index)
+            else:
+                keys.append(index)
+        if not aggregates:
+            return None
+
+        group = select.args.get("group")
+        for item in group.expressions if group else []:
+            if contains_template_ds(item) or item.find(exp.AggFunc):
+                return None
+            if isinstance(item, exp.Literal) and not item.is_string:
+                position = int(item.this) - 1
+                if position not in keys and position not in day_constants:
+                    return None
+
+        return cls(
+            select,
+            dialect,
+            window,
+            window_condition.this,
+            (low, high),
+            [
+                condition
+                for condition in conditions
+                if condition is not window_conditions[0]
+            ],
+            keys,
+            day_constants,
+            aggregates,
+        )
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def table(self) -> exp.Table:
+        """The table that the query aggregates"""
+        table = t.cast(exp.Table, self._select.args["from"].this).copy()
+        table.set("alias", None)
+        return table
+
+    @property
+    def has_sums(self) -> bool:
+        return any(aggregate.kind == "sum" for aggregate in self._aggregates)
+
+    def has_exact_sums(self, columns: t.Dict[str, exp.DataType]) -> bool:
+        """Whether every SUM of the query is over integers given the types of
+        the columns of its table. Sums of floats depend on the order that the
+        values are added in so a running total drifts away from the SUM of
+        each window. Decimal sums are fetched as floats so they drift too."""
+        sums = [aggregate for aggregate in self._aggregates if aggregate.kind == "sum"]
+        if not sums:
+            return True
+        table = t.cast(exp.Table, self._select.args["from"].this)
+        schema: t.Dict[str, t.Any] = {
+            name: dtype.sql(dialect=self._dialect) for name, dtype in columns.items()
+        }
+        for part in [table.name, table.db, table.catalog]:
+            if part:
+                schema = {part: schema}
+        select = exp.select(
+            *[
+                exp.alias_(t.cast(exp.Expression, aggregate.expression).copy(), f"_{i}")
+                for i, aggregate in enumerate(sums)
+            ]
+        ).from_(table.copy())
+        try:
+            annotated = annotate_types(
+                qualify(select, schema=schema, dialect=self._dialect), schema=schema
+            )
+        except SqlglotError as e:
+            logger.debug(f"unable to determine the types of the rolling sums: {e}")
+            return False
+        return all(
+            projection.type is not None
+            and projection.type.is_type(*exp.DataType.INTEGER_TYPES)
+            for projection in annotated.expressions
+        )
+
+    def partials_query(
+        self,
+        first_day: datetime,
+        last_day: datetime,
+        distinct_index: t.Optional[int] = None,
+        enter_from: t.Optional[datetime] = None,
+    ) -> str:
+        """The query for the partial aggregates of every group and day between
+        the first and last sample dates. If a distinct index is given the
+        query returns the distinct values of that aggregate instead. If
+        `enter_from` is given only the partials that enter the window on or
+        after that sample date are returned."""
+        select = self._select.copy()
+
+        projections: t.List[exp.Expression] = []
+        for index, projection in enumerate(select.expressions):
+            if index in self._keys or index in self._day_constants:
+                projections.append(projection)
+            else:
+                # Placeholders keep the positions of the other projections
+                projections.append(exp.alias_(exp.null(), f"_rolling_agg_{index}"))
+
+        # Group by items are also selected as they may refer to columns of the
+        # table rather than the projection with the same name
+        group = select.args.get("group")
+        group_items = list(group.expressions) if group else []
+        for index, item in enumerate(group_items):
+            if isinstance(item, exp.Literal) and not item.is_string:
+                continue
+            projections.append(exp.alias_(item.copy(), f"_rolling_group_{index}"))
+
+        enter, leave = self._membership_expressions()
+        projections.append(exp.alias_(enter.copy(), ENTER_COLUMN))
+        projections.append(exp.alias_(leave.copy(), LEAVE_COLUMN))
+        group_items.extend([enter.copy(), leave.copy()])
+
+        if distinct_index is None:
+            projections.append(exp.alias_(exp.Count(this=exp.Star()), ROWS_COLUMN))
+            for aggregate in self._aggregates:
+                if aggregate.kind == "sum":
+                    assert aggregate.expression is not None
+                    projections.append(
+                        exp.alias_(
+                            exp.Sum(this=aggregate.expression.copy()),
+                            f"_rolling_sum_{aggregate.index}",
+                        )
+                    )
+                if aggregate.kind in ["sum", "count"]:
+                    assert aggregate.expression is not None
+                    projections.append(
+                        exp.alias_(
+                            exp.Count(this=aggregate.expression.copy()),
+                            f"_rolling_count_{aggregate.index}",
+                        )
+                    )
+        else:
+            aggregate = self._aggregates[distinct_index]
+            assert aggregate.expression is not None
+            projections.append(
+                exp.alias_(aggregate.expression.copy(), DISTINCT_VALUE_COLUMN)
+            )
+            group_items.append(aggregate.expression.copy())
+
+        low, high = self._bounds
+        conditions = [condition.copy() for condition in self._filters]
+        conditions.append(
+            exp.Between(
+                this=self._time_column.copy(),
+                low=replace_template_day(low.copy(), first_day),
+                high=replace_template_day(high.copy(), last_day),
+            )
+        )
+        if distinct_index is not None:
+            expression = self._aggregates[distinct_index].expression
+            assert expression is not None
+            conditions.append(
+                exp.Not(this=exp.Is(this=expression.copy(), expression=exp.null()))
+            )
+        if enter_from is not None:
+            conditions.append(
+                exp.GTE(
+                    this=enter.copy(),
+                    expression=exp.cast(
+                        exp.Literal.string(enter_from.strftime("%Y-%m-%d")), "DATE"
+                    ),
+                )
+            )
+        select.set("expressions", projections)
+        select.set("where", exp.Where(this=exp.and_(*conditions)))
+        select.set("group", exp.Group(expressions=group_items))
+        return select.sql(dialect=self._dialect)
+
+    def schema_query(self, day: datetime) -> str:
+        """The query for a single sample date without any rows. The types of
+        its columns are used for the results."""
+        select = replace_template_day(self._select.copy(), day)
+        return t.cast(exp.Select, select).limit(0).sql(dialect=self._dialect)
+
+    def day_constants_query(self, days: t.List[datetime]) -> str:
+        """The query for the values of the projections that only depend on the
+        sample date"""
+        spine_date = exp.column(SPINE_COLUMN, table=SPINE_ALIAS)
+        projections: t.List[exp.Expression] = [
+            exp.alias_(spine_date.copy(), "_rolling_day")
+        ]
+        for index in self._day_constants:
+            projection = self._select.expressions[index]
+            projections.append(
+                exp.alias_(
+                    replace_template_ds(projection.unalias().copy(), spine_date),
+                    f"_rolling_constant_{index}",
+                )
+            )
+        query = exp.select(*projections).from_(date_spine(days))
+        return query.sql(dialect=self._dialect)
+
+    def run(
+        self, engine_adapter: EngineAdapter, days: t.List[datetime]
+    ) -> pd.DataFrame:
+        """Evaluates the query for each of the given consecutive sample dates"""
+        names = [projection.alias_or_name for projection in self._select.expressions]
+        results = list(self.iter_days(engine_adapter, days))
+        if not results:
+            return pd.DataFrame(columns=names)
+        return pd.concat(results)
+
+    def iter_days(
+        self,
+        engine_adapter: EngineAdapter,
+        days: t.List[datetime],
+        slice_days: t.Optional[int] = None,
+    ) -> t.Iterator[pd.DataFrame]:
+        """Evaluates the query for each of the given consecutive sample dates
+        and yields the results of each sample date as a separate dataframe.
+
+        The partials are fetched for `slice_days` sample dates at a time (by
+        default the larger of the window and `PARTIALS_SLICE_DAYS`) as the
+        window advances. Only the partials of the current slice and the
+        window, and the state of the current window, are held in memory."""
+        names = [projection.alias_or_name for projection in self._select.expressions]
+        if not days:
+            return
+        # The results use the same types as the results of per-day queries
+        schema = engine_adapter.fetchdf(self.schema_query(days[0]))
+
+        first_day = days[0]
+        day_count = len(days)
+        slice_days = max(1, slice_days or max(self._window, PARTIALS_SLICE_DAYS))
+
+        # Partials are added on the first day whose window contains them and
+        # retracted on the day after the last
+        additions: t.Dict[int, t.List[t.Tuple[t.Tuple, t.Tuple]]] = defaultdict(list)
+        removals: t.Dict[int, t.List[t.Tuple[t.Tuple, t.Tuple]]] = defaultdict(list)
+
+        def schedule_partials(
+            df: pd.DataFrame,
+            to_partial: t.Callable[[t.Tuple, t.Dict[str, int]], t.Tuple],
+        ):
+            columns = {name: position for position, name in enumerate(df.columns)}
+            hidden = [
+                position
+                for name, position in columns.items()
+                if name.startswith("_rolling_group_")
+            ]
+            for row in df.itertuples(index=False, name=None):
+                enter = _to_date(row[columns[ENTER_COLUMN]])
+                leave = _to_date(row[columns[LEAVE_COLUMN]])
+                start = max(0, (enter - first_day.date()).days)
+                end = min(day_count - 1, (leave - first_day.date()).days)
+                if start > end:
+                    continue
+                key = (
+                    tuple(_group_key_value(row[index]) for index in self._keys),
+                    tuple(_group_key_value(row[position]) for position in hidden),
+                )
+                partial = to_partial(row, columns)
+                additions[start].append((key, partial))
+                if end + 1 < day_count:
+                    removals[end + 1].append((key, partial))
+
+        def main_partial(row: t.Tuple, columns: t.Dict[str, int]):
+            values = []
+            for aggregate in self._aggregates:
+                index = aggregate.index
+                if aggregate.kind == "sum":
+                    values.append(
+                        (
+                            row[columns[f"_rolling_sum_{index}"]],
+                            row[columns[f"_rolling_count_{index}"]],
+                        )
+                    )
+                elif aggregate.kind == "count":
+                    values.append((None, row[columns[f"_rolling_count_{index}"]]))
+                else:
+                    values.append((None, 0))
+            return ("main", row[columns[ROWS_COLUMN]], values)
+
+        def fetch_partials(slice_start: int, slice_end: int):
+            """Fetches the partials that enter the window on the sample dates
+            of the slice. The first slice also includes the partials that
+            entered the window before the first sample date."""
+            enter_from = days[slice_start] if slice_start > 0 else None
+            schedule_partials(
+                engine_adapter.fetchdf(
+                    self.partials_query(
+                        days[slice_start], days[slice_end], enter_from=enter_from
+                    )
+                ),
+                main_partial,
+            )
+            for distinct_index, aggregate in enumerate(self._aggregates):
+                if aggregate.kind != "count_distinct":
+                    continue
+                schedule_partials(
+                    engine_adapter.fetchdf(
+                        self.partials_query(
+                            days[slice_start],
+                            days[slice_end],
+                            distinct_index,
+                            enter_from=enter_from,
+                        )
+                    ),
+                    lambda row, columns, index=aggregate.index: (
+                        "distinct",
+                        index,
+                        row[columns[DISTINCT_VALUE_COLUMN]],
+                    ),
+                )
+
+        constants: t.Dict[int, t.List[t.Any]] = {}
+        if self._day_constants:
+            constants_df = engine_adapter.fetchdf(self.day_constants_query(days))
+            for index in self._day_constants:
+                constants[index] = list(constants_df[f"_rolling_constant_{index}"])
+
+        groups: t.Dict[t.Tuple, RollingGroupState] = {}
+        has_group_by = bool(self._select.args.get("group"))
+        if not has_group_by:
+            # Aggregates without a group by always return a single row
+            groups[((), ())] = RollingGroupState(values=())
+
+        for day_index in range(day_count):
+            if day_index % slice_days == 0:
+                fetch_partials(day_index, min(day_count, day_index + slice_days) - 1)
+            # Partials that left the window are no longer needed
+            for key, partial in removals.pop(day_index, []):
+                self._apply(groups, key, partial, -1)
+            for key, partial in additions.pop(day_index, []):
+                self._apply(groups, key, partial, 1)
+
+            results: t.List[t.List[t.Any]] = []
+            for key, state in list(groups.items()):
+                if state.rows == 0 and has_group_by:
+                    del groups[key]
+                    continue
+                results.append(self._result_row(state, constants, day_index))
+            yield _cast_like(pd.DataFrame(results, columns=names), schema)
+
+    def _membership_expressions(self) -> t.Tuple[exp.Expression, exp.Expression]:
+        """Expressions for the first and last sample date whose window contains
+        a row. Rows at midnight enter on that day, later rows the next day."""
+        time_column = self._time_column
+        day = exp.cast(time_column.copy(), "DATE")
+        has_time = exp.GT(
+            this=exp.cast(time_column.copy(), "TIMESTAMP"),
+            expression=exp.cast(day.copy(), "TIMESTAMP"),
+        )
+        enter = exp.Case(
+            ifs=[
+                exp.If(
+                    this=has_time,
+                    true=exp.DateAdd(
+                        this=day.copy(),
+                        expression=exp.Literal.number(1),
+                        unit=exp.Var(this="DAY"),
+                    ),
+                )
+            ],
+            default=day.copy(),
+        )
+        leave = exp.DateAdd(
+            this=day.copy(),
+            expression=exp.Literal.number(self._window - 1),
+            unit=exp.Var(this="DAY"),
+        )
+        return (enter, leave)
+
+    def _apply(
+        self,
+        groups: t.Dict[t.Tuple, RollingGroupState],
+        key: t.Tuple,
+        partial: t.Tuple,
+        sign: int,
+    ):
+        state = groups.get(key)
+        if state is None:
+            state = RollingGroupState(values=key[0])
+            groups[key] = state
+        if partial[0] == "distinct":
+            _, index, value = partial
+            counter = state.distinct.setdefault(index, Counter())
+            counter[value] += sign
+            if counter[value] == 0:
+                del counter[value]
+            return
+
+        _, rows, values = partial
+        state.rows += sign * int(rows)
+        for aggregate, (value, count) in zip(self._aggregates, values):
+            index = aggregate.index
+            if aggregate.kind == "sum":
+                # Only sums of integers are maintained incrementally. They're
+                # kept as python integers so the running total is exact
+                if not pd.isna(value):
+                    state.sums[index] = state.sums.get(index, 0) + sign * int(value)
+                state.sum_counts[index] = state.sum_counts.get(index, 0) + sign * int(
+                    count
+                )
+            elif aggregate.kind == "count":
+                state.counts[index] = state.counts.get(index, 0) + sign * int(count)
+
+    def _result_row(
+        self,
+        state: RollingGroupState,
+        constants: t.Dict[int, t.List[t.Any]],
+        day_index: int,
+    ) -> t.List[t.Any]:
+        row: t.List[t.Any] = [None] * len(self._select.expressions)
+        for value, index in zip(state.values, self._keys):
+            row[index] = value
+        for index, values in constants.items():
+            row[index] = values[day_index]
+        for aggregate in self._aggregates:
+            index = aggregate.index
+            if aggregate.kind == "sum":
+                row[index] = (
+                    state.sums.get(index, 0) if state.sum_counts.get(index) else None
+                )
+            elif aggregate.kind == "count":
+                row[index] = state.counts.get(index, 0)
+            elif aggregate.kind == "count_star":
+                row[index] = state.rows
+            else:
+                row[index] = len(state.distinct.get(index, ()))
+        return row
+
+
+def _rolling_aggregate(
+    expression: exp.Expression, index: int
+) -> t.Optional[RollingAggregate]:
+    if isinstance(expression, exp.Sum):
+        argument = expression.this
+        kind = "sum"
+    elif isinstance(expression, exp.Count):
+        argument = expression.this
+        if isinstance(argument, exp.Star):
+            return RollingAggregate(kind="count_star", expression=None, index=index)
+        if isinstance(argument, exp.Distinct):
+            if len(argument.expressions) != 1:
+                return None
+            argument = argument.expressions[0]
+            kind = "count_distinct"
+        else:
+            kind = "count"
+    else:
+        return None
+    if argument is None or argument.find(exp.AggFunc) or contains_template_ds(argument):
+        return None
+    return RollingAggregate(kind=t.cast(t.Any, kind), expression=argument, index=index)
+
+
+def _window_days(
+    low: exp.Expression, high: exp.Expression, dialect: str
+) -> t.Optional[int]:
+    """The number of days in the window if the bounds are the start of a fixed
+    number of days before the sample date and the sample date itself"""
+    conn = duckdb.connect()
+    try:
+        windows = set()
+        for day in WINDOW_CHECK_DAYS:
+            bounds = []
+            for bound in [low, high]:
+                expression = exp.cast(
+                    replace_template_day(bound.copy(), day), "TIMESTAMP"
+                )
+                try:
+                    row = conn.execute(
+                        f"SELECT {expression.sql(dialect='duckdb')}"
+                    ).fetchone()
+                except duckdb.Error as e:
+                    logger.debug(
+                        f"unable to evaluate window bound {bound.sql(dialect=dialect)}: {e}"
+                    )
+                    return None
+                if not row or not isinstance(row[0], datetime):
+                    return None
+                bounds.append(row[0])
+            start, end = bounds
+            if (
+                end != day
+                or start > end
+                or start != start.replace(hour=0, minute=0, second=0, microsecond=0)
+            ):
+                return None
+            windows.add((end - start).days + 1)
+    finally:
+        conn.close()
+    if len(windows) != 1:
+        return None
+    return windows.pop()
+
+
+def _group_key_value(value: t.Any) -> t.Any:
+    """NULL group keys are fetched as NaN, NaT or NA. As NaN is never equal to
+    itself they are replaced with None so that the partials of a group with a
+    NULL key are added to the same group."""
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    return value
+
+
+def _cast_like(df: pd.DataFrame, schema: pd.DataFrame) -> pd.DataFrame:
+    """Casts the columns of the dataframe to the types of the schema. Columns
+    that can't be cast (e.g. integers with NULL values) are left as they are."""
+    for name, dtype in schema.dtypes.items():
+        if name not in df.columns or df[name].dtype == dtype:
+            continue
+        try:
+            df[name] = df[name].astype(dtype)
+        except (TypeError, ValueError):
+            logger.debug(f"unable to cast rolling column {name} to {dtype}")
+    return df
+
+
+def _to_date(value: t.Any) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.Timestamp(value).date()
@@ -3,16 +3,25 @@
 import abc
 import asyncio
 import logging
+import threading
 import typing as t
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 import arrow
 import duckdb
 import pandas as pd
+from metrics_tools.compute.spine import (
+    CompiledQuery,
+    compile_query,
+    render_rolling_template,
+)
 from metrics_tools.definition import PeerMetricDependencyRef, RollingCronOptions
 from metrics_tools.intermediate import run_macro_evaluator
 from metrics_tools.macros import metrics_end, metrics_sample_date, metrics_start
 from metrics_tools.models import create_unregistered_macro_registry
+from metrics_tools.rolling import IncrementalRollingQuery
 from metrics_tools.utils.glot import str_or_expressions
 from sqlglot import exp
 from sqlmesh import EngineAdapter
@@ -139,6 +148,9 @@ class MetricsRunner:
         self._query = query
         self._ref = ref
         self._locals = locals or {}
+        self._compiled_queries: t.Dict[
+            t.Tuple[datetime, ...], t.Optional[CompiledQuery]
+        ] = {}
 
     def run(self, start: datetime, end: datetime):
         """Run metrics for a given period and return the results as pandas dataframes"""
@@ -152,29 +164,156 @@ class MetricsRunner:
         logger.debug("executing time aggregation", extra={"query": rendered_query})
         return self._context.engine_adapter.fetchdf(rendered_query)
 
-    def run_rolling(self, start: datetime, end: datetime):
-        df: pd.DataFrame = pd.DataFrame()
+    def run_rolling(self, start: datetime, end: datetime, incremental: bool = False):
+        chunks = list(self.iter_rolling(start, end, incremental=incremental))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks)
+
+    def iter_rolling(
+        self,
+        start: datetime,
+        end: datetime,
+        chunk_rows: t.Optional[int] = None,
+        incremental: bool = False,
+        parallelism: int = 1,
+    ) -> t.Iterator[pd.DataFrame]:
+        """Runs the rolling query and yields the results in chunks. The
+        results of each sample date are collected until there are at least
+        `chunk_rows` rows and then yielded as a single dataframe. Without
+        `chunk_rows` all of the results are yielded as one dataframe.
+
+        If `incremental` is set, supported queries are evaluated by sliding
+        the window over partial aggregates (see `metrics_tools.rolling`).
+
+        On duckdb, `parallelism` sample dates are queried at once, each on its
+        own cursor of the runner's connection."""
         logger.debug(
             f"run_rolling[{self._ref['name']}]: called with start={start} and end={end}"
         )
-        count = 0
+        day_results = self._iter_day_results(start, end, incremental, parallelism)
+
+        chunk: t.List[pd.DataFrame] = []
+        chunk_size = 0
         total_rows = 0
-        for rendered_query in self.render_rolling_queries(start, end):
-            count += 1
-            logger.debug(
-                f"run_rolling[{self._ref['name']}]: executing rolling window: {rendered_query}",
-                extra={"query": rendered_query},
-            )
-            day_result = self._context.engine_adapter.fetchdf(rendered_query)
+        for day_result in day_results:
             day_rows = len(day_result)
             total_rows += day_rows
             logger.debug(
                 f"run_rolling[{self._ref['name']}]: rolling window period resulted in {day_rows} rows"
             )
-            df = pd.concat([df, day_result])
+            chunk.append(day_result)
+            chunk_size += day_rows
+            if chunk_rows and chunk_size >= chunk_rows:
+                yield pd.concat(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield pd.concat(chunk)
         logger.debug(f"run_rolling[{self._ref['name']}]: total rows {total_rows}")
 
-        return df
+    def _iter_day_results(
+        self, start: datetime, end: datetime, incremental: bool, parallelism: int
+    ) -> t.Iterator[pd.DataFrame]:
+        """The results of each sample date"""
+        if incremental:
+            days = list(self.iter_query_days(start, end))
+            incremental_query = self.incremental_rolling_query(days)
+            if incremental_query:
+                logger.debug(
+                    f"run_rolling[{self._ref['name']}]: running incrementally over a {incremental_query.window} day window"
+                )
+                return incremental_query.iter_days(self._context.engine_adapter, days)
+
+        queries = self.render_rolling_queries(start, end)
+        if parallelism > 1 and isinstance(
+            self._context.engine_adapter, DuckDBEngineAdapter
+        ):
+            return self._fetch_rolling_parallel(queries, parallelism)
+        return (
+            self._fetch_rolling(self._context.engine_adapter.fetchdf, query)
+            for query in queries
+        )
+
+    def _fetch_rolling(
+        self, fetchdf: t.Callable[[str], pd.DataFrame], rendered_query: str
+    ) -> pd.DataFrame:
+        logger.debug(
+            f"run_rolling[{self._ref['name']}]: executing rolling window: {rendered_query}",
+            extra={"query": rendered_query},
+        )
+        return fetchdf(rendered_query)
+
+    def _fetch_rolling_parallel(
+        self, queries: t.Iterable[str], parallelism: int
+    ) -> t.Iterator[pd.DataFrame]:
+        """Executes the queries in a thread pool and yields the results in
+        order. Other processes can't open a duckdb database that is already
+        open for writing so each thread uses a cursor of the runner's
+        connection instead. duckdb doesn't hold the GIL while executing so the
+        queries still run on separate cores. The number of queries in flight
+        is bounded so that memory stays bounded when the results are chunked."""
+        connection = t.cast(
+            duckdb.DuckDBPyConnection, self._context.engine_adapter.connection
+        )
+        local = threading.local()
+        cursors: t.List[duckdb.DuckDBPyConnection] = []
+        cursors_lock = threading.Lock()
+
+        def fetchdf(query: str) -> pd.DataFrame:
+            cursor = getattr(local, "cursor", None)
+            if cursor is None:
+                with cursors_lock:
+                    cursor = connection.cursor()
+                    cursors.append(cursor)
+                local.cursor = cursor
+            return cursor.execute(query).fetchdf()
+
+        pending: t.Deque[Future[pd.DataFrame]] = deque()
+        queries_iter = iter(queries)
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            try:
+                for query in queries_iter:
+                    pending.append(executor.submit(self._fetch_rolling, fetchdf, query))
+                    if len(pending) >= parallelism * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)
+                for cursor in cursors:
+                    cursor.close()
+
+    def incremental_rolling_query(
+        self, days: t.List[datetime]
+    ) -> t.Optional[IncrementalRollingQuery]:
+        """Returns the incremental form of the rolling query for the given
+        sample dates or None if the query must be evaluated for each sample
+        date"""
+        if self._ref.get("cron") != "@daily" or self._ref.get("time_aggregation"):
+            return None
+        if not days:
+            return None
+        dialect = self._context.engine_adapter.dialect
+        template = render_rolling_template(self, [days[0], days[-1]], dialect=dialect)
+        if not template:
+            return None
+        query = IncrementalRollingQuery.from_template(template, dialect)
+        if query is None or not query.has_sums:
+            return query
+        try:
+            columns = self._context.engine_adapter.columns(query.table)
+        except Exception as e:
+            logger.debug(f"unable to get the columns of {query.table.sql()}: {e}")
+            return None
+        if not query.has_exact_sums(columns):
+            logger.debug(
+                f"run_rolling[{self._ref['name']}]: sums aren't over integers so each sample date is evaluated"
+            )
+            return None
+        return query
 
     def render_query(self, start: datetime, end: datetime) -> str:
         variables: t.Dict[str, t.Any] = {
@@ -213,12 +352,37 @@ class MetricsRunner:
         )
         return "\n".join(rendered_parts)
 
+    def compile_query(
+        self, check_days: t.Sequence[datetime]
+    ) -> t.Optional[CompiledQuery]:
+        """Evaluates the macros of the rolling query once and caches the
+        result. None is returned if the query can't be rendered for the
+        `check_days` by substitution, in which case it must be rendered for
+        each sample date."""
+        key = tuple(check_days)
+        if key not in self._compiled_queries:
+            compiled = None
+            if not self._ref.get("time_aggregation"):
+                compiled = compile_query(
+                    lambda day: self.render_query(day, day), check_days
+                )
+            if not compiled:
+                logger.debug(
+                    f"compile_query[{self._ref['name']}]: query must be rendered for each sample date"
+                )
+            self._compiled_queries[key] = compiled
+        return self._compiled_queries[key]
+
     def render_rolling_queries(self, start: datetime, end: datetime) -> t.Iterator[str]:
         # Given a rolling input render all the rolling queries
         logger.debug(f"render_rolling_queries called with start={start} and end={end}")
-        for day in self.iter_query_days(start, end):
-            rendered_query = self.render_query(day, day)
-            yield rendered_query
+        days = list(self.iter_query_days(start, end))
+        compiled = self.compile_query([days[0], days[-1]]) if days else None
+        for day in days:
+            if compiled:
+                yield compiled.render(day)
+            else:
+                yield self.render_query(day, day)
 
     def iter_query_days(self, start: datetime, end: datetime):
         cron = self._ref.get("cron")
@@ -237,9 +401,16 @@ class MetricsRunner:
         logger.debug(
             f"render_rolling_queries_async called with start={start} and end={end}"
         )
-        for day in self.iter_query_days(start, end):
-            rendered_query = await asyncio.to_thread(self.render_query, day, day)
-            yield rendered_query
+        days = list(self.iter_query_days(start, end))
+        compiled: t.Optional[CompiledQuery] = None
+        if days:
+            compiled = await asyncio.to_thread(self.compile_query, [days[0], days[-1]])
+        for day in days:
+            if compiled:
+                yield compiled.render(day)
+            else:
+                rendered_query = await asyncio.to_thread(self.render_query, day, day)
+                yield rendered_query
 
     def commit(self, start: datetime, end: datetime, destination: str):
         """Like run but commits the result to the database"""
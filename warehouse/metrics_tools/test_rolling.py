@@ -0,0 +1,286 @@
+from datetime import datetime
+
+import duckdb
+import pandas as pd
+import pytest
+from metrics_tools.definition import PeerMetricDependencyRef
+from metrics_tools.runner import MetricsRunner
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute("CREATE SCHEMA metrics")
+    conn.execute(
+        """
+        CREATE TABLE metrics.events AS
+        SELECT
+          DATE '2024-01-01' + (range % 50)::INT AS bucket_day,
+          TIMESTAMP '2024-01-01' + to_hours((range * 7) % 1200) AS time,
+          CASE WHEN range % 4 = 0 THEN 'COMMIT_CODE' ELSE 'STARRED' END AS event_type,
+          (range % 5)::VARCHAR AS to_artifact_id,
+          (range % 11)::VARCHAR AS from_artifact_id,
+          CASE WHEN range % 9 = 0 THEN NULL ELSE (range % 13)::BIGINT END AS amount,
+          (range % 17) * 0.1::DOUBLE + 1 / (range + 3) AS score
+        FROM range(3000)
+        WHERE range % 7 != 0
+        """
+    )
+    return conn
+
+
+def create_runner(conn: duckdb.DuckDBPyConnection, query: str, window: int = 7):
+    return MetricsRunner.create_duckdb_execution_context(
+        conn,
+        query,
+        PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=window,
+            unit="day",
+            cron="@daily",
+        ),
+        {},
+    )
+
+
+def assert_same_results(runner: MetricsRunner, start: datetime, end: datetime):
+    expected = runner.run_rolling(start, end, incremental=False)
+    result = runner.run_rolling(start, end, incremental=True)
+
+    assert list(result.columns) == list(expected.columns)
+    sort_by = list(expected.columns)
+    expected = expected.sort_values(sort_by).reset_index(drop=True)
+    result = result.sort_values(sort_by).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # Aggregates over a date column with a positional group by
+        """
+        select @metrics_sample_date() as metrics_sample_date,
+          events.to_artifact_id,
+          '' as from_artifact_id,
+          'test' as metric,
+          SUM(events.amount) as amount,
+          COUNT(*) as event_count,
+          COUNT(events.amount) as amount_count,
+          COUNT(DISTINCT events.from_artifact_id) as developers
+        from metrics.events as events
+        where event_type in ('COMMIT_CODE')
+          and events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, to_artifact_id, from_artifact_id, metric
+        """,
+        # Times within a day only enter the window the day after
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          to_artifact_id,
+          COUNT(DISTINCT bucket_day) as active_days
+        from metrics.events
+        where time between @metrics_start('DATE') and @metrics_end('DATE')
+        group by to_artifact_id
+        """,
+        # Aggregates without a group by return a row for every sample date
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          SUM(amount) as amount,
+          COUNT(*) as event_count
+        from metrics.events
+        where event_type = 'STARRED'
+          and bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        """,
+        # NULL group keys are a single group
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          amount,
+          COUNT(*) as event_count
+        from metrics.events
+        where bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, amount
+        """,
+    ],
+)
+def test_incremental_rolling_matches_per_day_results(
+    conn: duckdb.DuckDBPyConnection, query: str
+):
+    runner = create_runner(conn, query)
+    start = datetime(2023, 12, 28)
+    end = datetime(2024, 3, 1)
+    assert runner.incremental_rolling_query([start, end]) is not None
+    assert_same_results(runner, start, end)
+
+
+def test_incremental_rolling_fetches_partials_in_slices(
+    conn: duckdb.DuckDBPyConnection,
+):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          to_artifact_id,
+          SUM(amount) as amount,
+          COUNT(DISTINCT from_artifact_id) as developers
+        from metrics.events
+        where time between @metrics_start('DATE') and @metrics_end('DATE')
+        group by to_artifact_id
+        """,
+    )
+    start = datetime(2023, 12, 28)
+    end = datetime(2024, 3, 1)
+    days = list(runner.iter_query_days(start, end))
+    query = runner.incremental_rolling_query(days)
+    assert query is not None
+
+    sort_by = ["metrics_sample_date", "to_artifact_id"]
+    expected = (
+        runner.run_rolling(start, end, incremental=False)
+        .sort_values(sort_by)
+        .reset_index(drop=True)
+    )
+    for slice_days in [1, 3, 30]:
+        result = pd.concat(
+            query.iter_days(runner._context.engine_adapter, days, slice_days)
+        )
+        pd.testing.assert_frame_equal(
+            result.sort_values(sort_by).reset_index(drop=True),
+            expected,
+            check_exact=True,
+        )
+
+
+def test_incremental_rolling_falls_back_for_float_sums(
+    conn: duckdb.DuckDBPyConnection,
+):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          to_artifact_id,
+          SUM(score) as score,
+          SUM(amount / 3) as amount
+        from metrics.events
+        where bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        """,
+        window=3,
+    )
+    # The windows at the end of the range are empty
+    start = datetime(2024, 2, 10)
+    end = datetime(2024, 3, 1)
+    assert runner.incremental_rolling_query([start, end]) is None
+    assert_same_results(runner, start, end)
+
+
+def test_incremental_rolling_falls_back_for_limited_queries(
+    conn: duckdb.DuckDBPyConnection,
+):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          events.to_artifact_id,
+          SUM(events.amount) as amount
+        from metrics.events as events
+        where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        order by amount desc
+        limit 2
+        """,
+    )
+    start = datetime(2024, 1, 10)
+    end = datetime(2024, 1, 20)
+    assert runner.incremental_rolling_query([start, end]) is None
+    assert len(runner.run_rolling(start, end)) == 11 * 2
+
+
+def test_incremental_rolling_falls_back_for_unsupported_queries(
+    conn: duckdb.DuckDBPyConnection,
+):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          events.to_artifact_id,
+          MAX(events.amount) as amount
+        from metrics.events as events
+        where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        """,
+    )
+    start = datetime(2024, 1, 10)
+    end = datetime(2024, 1, 20)
+    assert runner.incremental_rolling_query([start, end]) is None
+    assert len(runner.run_rolling(start, end)) == 11 * 5
+
+
+def test_iter_rolling_chunks_results(conn: duckdb.DuckDBPyConnection):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          events.to_artifact_id,
+          MAX(events.amount) as amount
+        from metrics.events as events
+        where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        """,
+    )
+    start = datetime(2024, 1, 10)
+    end = datetime(2024, 1, 20)
+    chunks = list(runner.iter_rolling(start, end, chunk_rows=12))
+    assert [len(chunk) for chunk in chunks] == [15, 15, 15, 10]
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks), runner.run_rolling(start, end), check_dtype=False
+    )
+
+
+def test_iter_rolling_in_parallel(conn: duckdb.DuckDBPyConnection):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          events.to_artifact_id,
+          MAX(events.amount) as amount
+        from metrics.events as events
+        where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        """,
+    )
+    start = datetime(2024, 1, 1)
+    end = datetime(2024, 2, 15)
+    chunks = list(runner.iter_rolling(start, end, chunk_rows=40, parallelism=4))
+    assert all(len(chunk) >= 40 for chunk in chunks[:-1])
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks).reset_index(drop=True),
+        runner.run_rolling(start, end).reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+def test_iter_rolling_chunks_incremental_results(conn: duckdb.DuckDBPyConnection):
+    runner = create_runner(
+        conn,
+        """
+        select @metrics_end('DATE') as metrics_sample_date,
+          events.to_artifact_id,
+          SUM(events.amount) as amount
+        from metrics.events as events
+        where events.bucket_day between @metrics_start('DATE') and @metrics_end('DATE')
+        group by 1, 2
+        """,
+    )
+    start = datetime(2024, 1, 10)
+    end = datetime(2024, 1, 20)
+    assert runner.incremental_rolling_query([start, end]) is not None
+    chunks = list(runner.iter_rolling(start, end, chunk_rows=12, incremental=True))
+    assert [len(chunk) for chunk in chunks] == [15, 15, 15, 10]
+    sort_by = ["metrics_sample_date", "to_artifact_id"]
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks).sort_values(sort_by).reset_index(drop=True),
+        runner.run_rolling(start, end, incremental=False)
+        .sort_values(sort_by)
+        .reset_index(drop=True),
+        check_dtype=False,
+    )
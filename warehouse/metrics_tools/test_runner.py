@@ -26,3 +26,53 @@ def test_runner_rendering():
     end = datetime.strptime("2024-12-31", "%Y-%m-%d")
     rendered = list(runner.render_rolling_queries(start, end))
     assert len(rendered) == 12
+
+
+def test_runner_compiled_rendering_matches_rendered_queries():
+    runner = MetricsRunner.create_duckdb_execution_context(
+        conn=duckdb.connect(),
+        query="""
+        select @metrics_sample_date() as metrics_sample_date, @end_ds as end_ds
+        from foo
+        where time between @metrics_start('DATE') and @metrics_end('DATE')
+        """,
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=7,
+            unit="day",
+            cron="@daily",
+        ),
+        locals={},
+    )
+    start = datetime.strptime("2024-01-01", "%Y-%m-%d")
+    end = datetime.strptime("2024-01-20", "%Y-%m-%d")
+    rendered = list(runner.render_rolling_queries(start, end))
+    assert runner.compile_query([start, end]) is not None
+    assert rendered == [
+        runner.render_query(day, day) for day in runner.iter_query_days(start, end)
+    ]
+
+
+def test_runner_compiled_rendering_falls_back_for_date_dependent_macros():
+    runner = MetricsRunner.create_duckdb_execution_context(
+        conn=duckdb.connect(),
+        query="""
+        select @IF(@end_ds > '2024-01-10', 'recent', 'old') as age
+        from foo
+        """,
+        ref=PeerMetricDependencyRef(
+            name="test",
+            entity_type="artifact",
+            window=7,
+            unit="day",
+            cron="@daily",
+        ),
+        locals={},
+    )
+    start = datetime.strptime("2024-01-01", "%Y-%m-%d")
+    end = datetime.strptime("2024-01-20", "%Y-%m-%d")
+    rendered = list(runner.render_rolling_queries(start, end))
+    assert runner.compile_query([start, end]) is None
+    assert "'old'" in rendered[0]
+    assert "'recent'" in rendered[-1]